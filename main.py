@@ -3,13 +3,12 @@ from dotenv import load_dotenv
 # 在最开始的时候加载 .env，不要挪到下面
 load_dotenv()
 
-from multiprocessing import Process
-from src.http_server import app
-from src.worker import conductor_client
-from src.queue import consume_task_forever, PROCESS_FILE_QUEUE_NAME
+# 解析进程和消费者进程使用 spawn 启动，会把本文件作为 __mp_main__ 重新导入一遍，
+# 所以除了加载 .env 之外的导入和初始化都要放在 __main__ 中，避免子进程创建 conductor 客户端、注册信号处理函数
 
 
 def start_http_server():
+    from src.http_server import app
     npu_available = False
     try:
         from transformers import is_npu_available
@@ -23,10 +22,24 @@ def start_http_server():
         app.run(host='0.0.0.0', port=8899)
 
 if __name__ == '__main__':
+    import signal
+    from multiprocessing import Process
+    from src.worker import conductor_client, signal_handler
+    from src.queue import PROCESS_FILE_QUEUE_NAME
+    from src.queue.consumer_pool import create_consumer_pool
+
     http_server_process = Process(target=start_http_server, args=())
     http_server_process.start()
 
-    consume_task_process = Process(target=consume_task_forever, args=(PROCESS_FILE_QUEUE_NAME,))
-    consume_task_process.start()
+    consumer_pool = create_consumer_pool(PROCESS_FILE_QUEUE_NAME)
+    consumer_pool.start()
+
+    def shutdown(signum, frame):
+        # 先等待消费者处理完正在进行的导入任务
+        consumer_pool.stop()
+        signal_handler(signum, frame)
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
 
     conductor_client.start_polling()
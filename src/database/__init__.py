@@ -1,9 +1,14 @@
+import re
 import time
 import os
+from datetime import datetime, timezone
 
-from pymongo import MongoClient
+from pymongo import MongoClient, ASCENDING
 
 MONGO_URL = os.environ.get("MONGO_URL")
+# 导入任务的断点记录保留的天数，任务成功完成时立即删除，中断或者有失败文件的任务保留这么久以便重新执行
+FILE_IMPORT_CHECKPOINT_TTL_DAYS = os.environ.get('FILE_IMPORT_CHECKPOINT_TTL_DAYS', '7')
+FILE_IMPORT_CHECKPOINT_TTL_DAYS = int(FILE_IMPORT_CHECKPOINT_TTL_DAYS)
 
 client = MongoClient(MONGO_URL)
 db = client.vines
@@ -25,7 +30,8 @@ class CollectionTable:
             logo,
             embedding_model,
             dimension,
-            metadata_fields
+            metadata_fields,
+            vector_index=None
     ):
         timestamp = int(time.time())
         metadata_fields = metadata_fields or [
@@ -71,6 +77,7 @@ class CollectionTable:
             "embeddingModel": embedding_model,
             "dimension": dimension,
             "metadataFields": metadata_fields,
+            "vectorIndex": vector_index,
             "authorizedTargets": [],
             "assetType": "text-collection"
         })
@@ -258,6 +265,140 @@ class FileRecord:
             "splitConfig": split_config
         })
 
+    def upsert_record(self, team_id, collection_name, file_url, split_config):
+        """
+        同一个文件（不是通过 OSS 导入的）只保留一条记录，重新导入时更新切分配置
+        """
+        timestamp = int(time.time())
+        self.collection.update_one(
+            {
+                "teamId": team_id,
+                "collectionName": collection_name,
+                "fileUrl": file_url,
+                "isDeleted": False,
+                "ossKey": {
+                    "$exists": False
+                }
+            },
+            {
+                "$set": {
+                    "updatedTimestamp": timestamp,
+                    "splitConfig": split_config
+                },
+                "$setOnInsert": {
+                    "createdTimestamp": timestamp
+                }
+            },
+            upsert=True
+        )
+
+    @staticmethod
+    def _oss_bucket_filter(bucket):
+        # 之前的版本没有记录 bucket，这些记录在重新导入时会补上 bucket
+        return {
+            "$or": [
+                {"ossBucket": bucket},
+                {"ossBucket": {"$exists": False}}
+            ]
+        }
+
+    def upsert_oss_object_record(self, team_id, collection_name, file_url, oss_object, split_config,
+                                 bucket=None, base_folder=None):
+        """
+        记录通过 OSS 导入的文件，同一个 bucket 中的同一个对象只保留一条记录，etag、大小和修改时间用于增量同步
+        :param bucket: 对象所在的 bucket 的地址，如 tos://bucket/
+        :param base_folder: 导入时指定的根目录
+        """
+        timestamp = int(time.time())
+        self.collection.update_one(
+            {
+                "teamId": team_id,
+                "collectionName": collection_name,
+                "ossKey": oss_object['key'],
+                "isDeleted": False,
+                **self._oss_bucket_filter(bucket)
+            },
+            {
+                "$set": {
+                    "updatedTimestamp": timestamp,
+                    "fileUrl": file_url,
+                    "ossBucket": bucket,
+                    "ossBaseFolder": base_folder or '',
+                    "etag": oss_object.get('etag'),
+                    "size": oss_object.get('size'),
+                    "lastModified": oss_object.get('last_modified'),
+                    "splitConfig": split_config
+                },
+                "$setOnInsert": {
+                    "createdTimestamp": timestamp
+                }
+            },
+            upsert=True
+        )
+
+    def get_oss_object_records(self, team_id, collection_name, bucket=None, prefix=''):
+        """
+        :param bucket: 只返回这个 bucket 中的对象的记录（包括没有记录 bucket 的旧记录）
+        :param prefix: 只返回 key 以 prefix 开头的对象的记录
+        :return: dict，oss key -> 文件记录
+        """
+        records = self.collection.find({
+            "teamId": team_id,
+            "collectionName": collection_name,
+            "isDeleted": False,
+            "ossKey": {
+                "$exists": True,
+                "$regex": f"^{re.escape(prefix or '')}"
+            },
+            **self._oss_bucket_filter(bucket)
+        })
+        return {
+            record['ossKey']: record for record in records
+        }
+
+    def set_oss_object_records_bucket(self, team_id, collection_name, keys, bucket, base_folder=None):
+        """
+        为没有记录 bucket 的旧记录补上 bucket，key 需要是这次在 bucket 中列举到的对象
+        """
+        return self.collection.update_many(
+            {
+                "teamId": team_id,
+                "collectionName": collection_name,
+                "isDeleted": False,
+                "ossKey": {
+                    "$in": list(keys)
+                },
+                "ossBucket": {
+                    "$exists": False
+                }
+            },
+            {
+                "$set": {
+                    "ossBucket": bucket,
+                    "ossBaseFolder": base_folder or ''
+                }
+            }
+        )
+
+    def delete_oss_object_records(self, team_id, collection_name, keys, bucket=None):
+        return self.collection.update_many(
+            {
+                "teamId": team_id,
+                "collectionName": collection_name,
+                "isDeleted": False,
+                "ossKey": {
+                    "$in": list(keys)
+                },
+                "ossBucket": bucket
+            },
+            {
+                "$set": {
+                    "isDeleted": True,
+                    "updatedTimestamp": int(time.time())
+                }
+            }
+        )
+
     def get_file_count(self, team_id, collection_name):
         return self.collection.count_documents({
             "teamId": team_id,
@@ -266,6 +407,58 @@ class FileRecord:
         })
 
 
+class FileImportCheckpointTable:
+    """
+    记录 OSS 导入任务中已经完成的文件，任务中断后重新执行时跳过这些文件
+    """
+
+    # 已经创建过索引的集合，每个进程只创建一次
+    _indexed_collections = set()
+
+    def __init__(self, app_id):
+        self.app_id = app_id
+        self.collection = db[self.app_id + "-" + "vector-file-import-checkpoints"]
+        self._ensure_indexes()
+
+    def _ensure_indexes(self):
+        if self.collection.name in self._indexed_collections:
+            return
+        self.collection.create_index([("taskId", ASCENDING), ("key", ASCENDING)], unique=True)
+        # TTL 索引只支持日期类型的字段
+        self.collection.create_index("createdAt", expireAfterSeconds=FILE_IMPORT_CHECKPOINT_TTL_DAYS * 24 * 3600)
+        self._indexed_collections.add(self.collection.name)
+
+    def mark_file_done(self, task_id, key):
+        timestamp = int(time.time())
+        self.collection.update_one(
+            {
+                "taskId": task_id,
+                "key": key
+            },
+            {
+                "$set": {
+                    "updatedTimestamp": timestamp
+                },
+                "$setOnInsert": {
+                    "createdTimestamp": timestamp,
+                    "createdAt": datetime.now(timezone.utc)
+                }
+            },
+            upsert=True
+        )
+
+    def delete_task(self, task_id):
+        """
+        任务完成后删除它的断点记录
+        """
+        return self.collection.delete_many({"taskId": task_id})
+
+    def get_done_files(self, task_id):
+        return set(
+            item['key'] for item in self.collection.find({"taskId": task_id}, {"key": 1})
+        )
+
+
 class FileProcessProgressTable:
 
     def __init__(self, app_id):
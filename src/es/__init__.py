@@ -4,13 +4,22 @@ import elasticsearch
 from elasticsearch import Elasticsearch, helpers
 from elasticsearch.helpers import BulkIndexError
 import os
+import shutil
+import socket
+import threading
 import traceback
+import uuid
+from collections import deque
+from contextlib import contextmanager, nullcontext
 from vines_worker_sdk.utils.files import ensure_directory_exists
 
 from src.database import FileProcessProgressTable, FileRecord
 from src.oss import oss_client
-from src.utils import generate_md5, generate_embedding_of_model, chunk_list
-from src.utils.document_loader import load_documents
+from src.utils import generate_md5, generate_embedding_of_model, chunk_list, generate_pk, download_cache
+from src.utils.document_loader import iter_load_documents, get_chunk_location
+from src.utils.pipeline import batched, prefetch
+from src.utils.near_dedup import create_near_duplicate_filter
+from src.es.bulk_writer import BulkWriter, MAX_ERRORS_IN_SUMMARY
 
 ELASTICSEARCH_URL = os.environ.get("ELASTICSEARCH_URL")
 ELASTICSEARCH_USERNAME = os.environ.get("ELASTICSEARCH_USERNAME")
@@ -19,6 +28,48 @@ ELASTICSEARCH_KNN_NUM_CANDIDATES = os.environ.get('ELASTICSEARCH_KNN_NUM_CANDIDA
 ELASTICSEARCH_KNN_NUM_CANDIDATES = int(ELASTICSEARCH_KNN_NUM_CANDIDATES)
 ELASTICSEARCH_BATCH_SIZE = os.environ.get('ELASTICSEARCH_BATCH_SIZE', '1000')
 ELASTICSEARCH_BATCH_SIZE = int(ELASTICSEARCH_BATCH_SIZE)
+# 每个 bulk 请求的最大字节数，向量占了文档的大部分体积，按条数分批时请求大小随向量维度变化很大
+ELASTICSEARCH_BULK_MAX_MB = os.environ.get('ELASTICSEARCH_BULK_MAX_MB', '10')
+ELASTICSEARCH_BULK_MAX_MB = int(ELASTICSEARCH_BULK_MAX_MB)
+# 大批量导入期间关闭索引的自动 refresh，导入完成后恢复。
+# 作用于整个知识库的索引：期间其他途径写入的数据也要等到导入结束才能被搜索到，默认关闭，只适合离线的首次导入
+ELASTICSEARCH_BULK_INGEST_MODE = os.environ.get('ELASTICSEARCH_BULK_INGEST_MODE', 'false').lower() == 'true'
+# 单个文件超过这个大小时才切换到大批量导入模式，OSS 导入除增量同步外始终切换
+ELASTICSEARCH_BULK_INGEST_MIN_FILE_MB = os.environ.get('ELASTICSEARCH_BULK_INGEST_MIN_FILE_MB', '10')
+ELASTICSEARCH_BULK_INGEST_MIN_FILE_MB = int(ELASTICSEARCH_BULK_INGEST_MIN_FILE_MB)
+# 大批量导入模式的租约秒数，切换设置的进程被杀死后，租约过期之后的导入任务会恢复索引原来的设置
+ELASTICSEARCH_BULK_INGEST_LEASE_SECONDS = os.environ.get('ELASTICSEARCH_BULK_INGEST_LEASE_SECONDS', '300')
+ELASTICSEARCH_BULK_INGEST_LEASE_SECONDS = int(ELASTICSEARCH_BULK_INGEST_LEASE_SECONDS)
+BULK_INGEST_META_KEY = 'bulkIngest'
+# 导入完成后是否 force merge 索引
+ELASTICSEARCH_BULK_INGEST_FORCE_MERGE = os.environ.get('ELASTICSEARCH_BULK_INGEST_FORCE_MERGE', 'false').lower() == 'true'
+INGEST_EMBEDDING_BATCH_SIZE = os.environ.get('INGEST_EMBEDDING_BATCH_SIZE', '256')
+INGEST_EMBEDDING_BATCH_SIZE = int(INGEST_EMBEDDING_BATCH_SIZE)
+INGEST_PIPELINE_QUEUE_SIZE = os.environ.get('INGEST_PIPELINE_QUEUE_SIZE', '2')
+INGEST_PIPELINE_QUEUE_SIZE = int(INGEST_PIPELINE_QUEUE_SIZE)
+# 片段 id 为内容的 md5，向量化之前先批量查询 ES，已存在的片段不再重新生成向量
+INGEST_SKIP_EXISTING = os.environ.get('INGEST_SKIP_EXISTING', 'true').lower() == 'true'
+# 已存在的片段是否用本次导入的 metadata 做局部更新（不修改向量），metadata 没有变化时 ES 不会重新索引
+INGEST_UPDATE_EXISTING_METADATA = os.environ.get('INGEST_UPDATE_EXISTING_METADATA', 'true').lower() == 'true'
+
+# 新建索引时向量字段的默认配置，向量已经归一化为单位长度，dot_product 和 cosine 的结果相同但计算更快；
+# int8_hnsw 把 HNSW 中的向量量化为 int8，内存占用约为 float 的 1/4
+VECTOR_SIMILARITIES = ('dot_product', 'cosine', 'l2_norm')
+VECTOR_INDEX_TYPES = ('int8_hnsw', 'hnsw')
+ELASTICSEARCH_VECTOR_SIMILARITY = os.environ.get('ELASTICSEARCH_VECTOR_SIMILARITY', 'dot_product')
+ELASTICSEARCH_VECTOR_INDEX_TYPE = os.environ.get('ELASTICSEARCH_VECTOR_INDEX_TYPE', 'int8_hnsw')
+ELASTICSEARCH_HNSW_M = os.environ.get('ELASTICSEARCH_HNSW_M', '16')
+ELASTICSEARCH_HNSW_M = int(ELASTICSEARCH_HNSW_M)
+ELASTICSEARCH_HNSW_EF_CONSTRUCTION = os.environ.get('ELASTICSEARCH_HNSW_EF_CONSTRUCTION', '100')
+ELASTICSEARCH_HNSW_EF_CONSTRUCTION = int(ELASTICSEARCH_HNSW_EF_CONSTRUCTION)
+# metadata 中的字符串字段的 keyword 子字段的最大长度，超过之后不会被索引（默认的动态映射为 256，文件链接经常超过这个长度）
+METADATA_KEYWORD_IGNORE_ABOVE = 8191
+
+# 重新导入同一个文件时：diff 只为新增的片段生成向量，并删除新版本中已不存在的片段；append 保留旧版本的所有片段。
+# 片段 id 只由内容决定，不同文件中内容相同的片段在 ES 中是同一条数据，metadata 中只记录了其中一个文件，
+# diff 模式删除旧片段时无法知道其他文件是否还包含这个片段，可能删除其他文件仍然需要的片段，所以默认使用 append
+REINDEX_MODES = ('diff', 'append')
+DEFAULT_REINDEX_MODE = 'append'
 
 # 连接到 Elasticsearch
 es = Elasticsearch(
@@ -34,33 +85,92 @@ def get_index_name(app_id, index_name):
     return (app_id + "-" + index_name).lower()
 
 
+def get_vector_index_config(vector_index=None):
+    """
+    补全向量字段的配置
+    :param vector_index: {"similarity": ..., "indexType": ..., "m": ..., "efConstruction": ...}，缺少的使用默认值
+    """
+    vector_index = vector_index or {}
+    return {
+        "similarity": vector_index.get('similarity') or ELASTICSEARCH_VECTOR_SIMILARITY,
+        "indexType": vector_index.get('indexType') or ELASTICSEARCH_VECTOR_INDEX_TYPE,
+        "m": vector_index.get('m') or ELASTICSEARCH_HNSW_M,
+        "efConstruction": vector_index.get('efConstruction') or ELASTICSEARCH_HNSW_EF_CONSTRUCTION
+    }
+
+
+def source_hash_of(source):
+    """
+    文档来源的 md5，保存在文档的 sourceHash 字段中，按来源查找文档时不受 keyword 长度限制
+    """
+    return generate_md5(source)
+
+
+def _metadata_keyword_mapping():
+    # 和默认的动态映射一样保留分词索引的主字段，全文检索传入的 match / prefix / wildcard 等条件直接作用于 metadata.<field>，
+    # 精确匹配使用 metadata.<field>.keyword，只放宽 keyword 子字段的长度限制
+    return {
+        "type": "text",
+        "fields": {
+            "keyword": {
+                "type": "keyword",
+                "ignore_above": METADATA_KEYWORD_IGNORE_ABOVE
+            }
+        }
+    }
+
+
 class ESClient:
     def __init__(self, app_id, index_name):
         self.app_id = app_id
         self.index_name_with_no_suffix = index_name
         self.index_name = get_index_name(app_id, index_name)
 
-    def create_es_index(self, dimension: int):
+    def create_es_index(self, dimension: int, vector_index=None, metadata_fields=None):
+        """
+        :param vector_index: 向量字段的配置，见 get_vector_index_config
+        :param metadata_fields: 数据集的 metadataFields，其中的字段（createdAt 除外）显式映射为 keyword，
+            之后新增的字符串字段通过 dynamic_templates 使用相同的映射
+        """
+        vector_index = get_vector_index_config(vector_index)
+        metadata_properties = {
+            "createdAt": {
+                "type": "date"
+            }
+        }
+        field_names = ['userId', 'workflowId', 'fileUrl', 'source', 'filename']
+        field_names += [field['name'] for field in metadata_fields or []]
+        for field_name in field_names:
+            if field_name not in metadata_properties:
+                metadata_properties[field_name] = _metadata_keyword_mapping()
+
         es.indices.create(index=self.index_name, mappings={
+            "dynamic_templates": [
+                {
+                    "metadata_strings": {
+                        "path_match": "metadata.*",
+                        "match_mapping_type": "string",
+                        "mapping": _metadata_keyword_mapping()
+                    }
+                }
+            ],
             "properties": {
                 "page_content": {"type": "text"},
-                "embeddings": {"type": "dense_vector", "dims": dimension, "similarity": "l2_norm"},
+                "sourceHash": {"type": "keyword"},
+                "embeddings": {
+                    "type": "dense_vector",
+                    "dims": dimension,
+                    "index": True,
+                    "similarity": vector_index['similarity'],
+                    "index_options": {
+                        "type": vector_index['indexType'],
+                        "m": vector_index['m'],
+                        "ef_construction": vector_index['efConstruction']
+                    }
+                },
                 "metadata": {
                     "type": "object",
-                    "properties": {
-                        "createdAt": {
-                            "type": "date"
-                        },
-                        "userId": {
-                            "type": "text"
-                        },
-                        "workflowId": {
-                            "type": "text"
-                        },
-                        "fileUrl": {
-                            "type": "text"
-                        }
-                    },
+                    "properties": metadata_properties
                 }
             }
         })
@@ -84,28 +194,369 @@ class ESClient:
             _source['metadata']['createdAt'] = int(time.time())
         return _source
 
-    def upsert_documents_batch(self, all_documents):
-        # 准备批量数据
-        chunks = chunk_list(all_documents, ELASTICSEARCH_BATCH_SIZE)
-        for chunk in chunks:
-            documents = [
-                {
-                    "_index": self.index_name,
-                    "_id": document['_id'],
-                    "_source": self.__add_created_metadata_if_not_exists(document['_source'])
-                } for document in chunk
-            ]
+    def _get_bulk_ingest_state(self):
+        """
+        :return: 切换到大批量导入模式的任务保存在索引 _meta 中的状态 {"owner", "leaseExpiresAt", "original"}，没有时返回 None
+        """
+        mappings = es.indices.get_mapping(index=self.index_name)[self.index_name]['mappings']
+        return mappings.get('_meta', {}).get(BULK_INGEST_META_KEY)
+
+    def _put_bulk_ingest_state(self, state):
+        """
+        写入（state 为 None 时删除）大批量导入模式的状态，put_mapping 会整体替换 _meta，保留其他的字段
+        """
+        mappings = es.indices.get_mapping(index=self.index_name)[self.index_name]['mappings']
+        meta = dict(mappings.get('_meta', {}))
+        if state is None:
+            meta.pop(BULK_INGEST_META_KEY, None)
+        else:
+            meta[BULK_INGEST_META_KEY] = state
+        es.indices.put_mapping(index=self.index_name, meta=meta)
+
+    def _restore_bulk_ingest_settings(self, original, force_merge=False):
+        # 原来没有设置 refresh_interval 时为 None，恢复为 ES 的默认值
+        settings = {"refresh_interval": original.get('refresh_interval')}
+        # 之前的版本还会去掉副本，恢复这些版本保存的状态时一并恢复副本数
+        if 'number_of_replicas' in original:
+            settings["number_of_replicas"] = original['number_of_replicas']
+        es.indices.put_settings(index=self.index_name, settings={"index": settings})
+        self._put_bulk_ingest_state(None)
+        es.indices.refresh(index=self.index_name)
+        if force_merge:
+            es.indices.forcemerge(index=self.index_name, max_num_segments=1, wait_for_completion=False)
+
+    def restore_expired_bulk_ingest_settings(self):
+        """
+        之前切换到大批量导入模式的任务的租约已过期（进程被杀死、节点被回收，没有来得及恢复）时，恢复索引原来的设置
+        """
+        if not ELASTICSEARCH_BULK_INGEST_MODE:
+            return
+        try:
+            state = self._get_bulk_ingest_state()
+            if state and state.get('leaseExpiresAt', 0) < time.time():
+                print(f"索引 {self.index_name} 的大批量导入模式已过期（owner={state.get('owner')}），恢复原来的设置")
+                self._restore_bulk_ingest_settings(state.get('original', {}))
+        except elasticsearch.NotFoundError:
+            pass
+        except Exception:
+            print(f"恢复索引 {self.index_name} 的设置失败：")
+            traceback.print_exc()
+
+    @contextmanager
+    def bulk_ingest_mode(self, force_merge=ELASTICSEARCH_BULK_INGEST_FORCE_MERGE):
+        """
+        大批量导入期间把索引切换为 refresh_interval: -1，退出时（包括异常退出）恢复原来的设置并 refresh，
+        不修改副本数，索引在导入期间可能还在提供搜索，去掉副本后节点故障会丢失整个索引。
+        force_merge 为 True 时再合并分段。
+
+        切换之前先把原来的设置、owner 和租约到期时间保存在索引的 _meta 中，导入期间定时续约：
+        - 其他任务的租约未过期时（正在导入）不做任何修改，由切换设置的任务负责恢复
+        - 租约已过期时（之前的任务没有来得及恢复）接管，结束时恢复 _meta 中保存的原来的设置
+        - 没有保存的状态、索引却已经是 refresh_interval: -1 时，是手动设置的，不做任何修改
+        """
+        if not ELASTICSEARCH_BULK_INGEST_MODE:
+            yield
+            return
+        try:
+            response = es.indices.get_settings(index=self.index_name, flat_settings=True)
+            state = self._get_bulk_ingest_state()
+        except elasticsearch.NotFoundError:
+            yield
+            return
+        if state and state.get('leaseExpiresAt', 0) >= time.time():
+            yield
+            return
+        if state:
+            print(f"索引 {self.index_name} 的大批量导入模式已过期（owner={state.get('owner')}），由本次导入接管")
+            original = state.get('original', {})
+        else:
+            settings = response[self.index_name]['settings']
+            if settings.get('index.refresh_interval') == '-1':
+                yield
+                return
+            original = {
+                "refresh_interval": settings.get('index.refresh_interval')
+            }
+
+        owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+        def renew():
+            self._put_bulk_ingest_state({
+                "owner": owner,
+                "leaseExpiresAt": time.time() + ELASTICSEARCH_BULK_INGEST_LEASE_SECONDS,
+                "original": original
+            })
+
+        renew()
+        # 两个任务同时切换时 _meta 中只会保留后写入的 owner，另一个任务不再负责恢复
+        if (self._get_bulk_ingest_state() or {}).get('owner') != owner:
+            yield
+            return
+        es.indices.put_settings(index=self.index_name, settings={
+            "index": {
+                "refresh_interval": "-1"
+            }
+        })
+
+        stopped = threading.Event()
+
+        def keep_alive():
+            while not stopped.wait(ELASTICSEARCH_BULK_INGEST_LEASE_SECONDS / 3):
+                try:
+                    renew()
+                except Exception as e:
+                    print(f"续约索引 {self.index_name} 的大批量导入模式失败：{e}")
+
+        keep_alive_thread = threading.Thread(target=keep_alive, daemon=True, name="bulk-ingest-lease")
+        keep_alive_thread.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            # 等待正在进行的续约完成，避免恢复之后又写入状态
+            keep_alive_thread.join()
             try:
-                helpers.bulk(es, documents)
-            except BulkIndexError as e:
-                print(f"An error occurred: {e}")
-                for i, error in enumerate(e.errors):
-                    # 输出每个失败文档的详细错误信息
-                    print(f"Document {i} failed: {error}")
-                raise e
-            except elasticsearch.ConnectionError as e:
+                self._restore_bulk_ingest_settings(original, force_merge=force_merge)
+            except Exception:
+                print(f"恢复索引 {self.index_name} 的设置失败，租约过期后的导入任务会重新恢复：")
                 traceback.print_exc()
-                raise Exception("写入数据超时")
+
+    def _create_bulk_writer(self):
+        return BulkWriter(es, chunk_size=ELASTICSEARCH_BATCH_SIZE, max_chunk_bytes=ELASTICSEARCH_BULK_MAX_MB * 1024 * 1024)
+
+    def upsert_documents_batch(self, all_documents, raise_on_error=True):
+        """
+        :param raise_on_error: 重试之后仍有写入失败的文档时是否抛出 BulkIndexError
+        :return: 写入结果的汇总 {"succeeded": ..., "failed": ..., "retried": ..., "errors": [...]}
+        """
+        writer = self._create_bulk_writer()
+        actions = (
+            {
+                "_index": self.index_name,
+                "_id": document['_id'],
+                "_source": self.__add_created_metadata_if_not_exists(document['_source'])
+            } for document in all_documents
+        )
+        try:
+            for _ in writer.write(actions):
+                pass
+        except (elasticsearch.ConnectionError, elasticsearch.ConnectionTimeout) as e:
+            traceback.print_exc()
+            raise Exception("写入数据超时")
+        summary = writer.summary()
+        if summary['failed']:
+            print(f"写入失败 {summary['failed']} 条数据：")
+            for i, error in enumerate(summary['errors']):
+                # 输出每个失败文档的详细错误信息
+                print(f"Document {i} failed: {error}")
+            if raise_on_error:
+                raise BulkIndexError(f"{summary['failed']} document(s) failed to index.", summary['errors'])
+        return summary
+
+    def upsert_documents_stream(self, documents, on_progress=None, on_failed=None):
+        """
+        流式并发写入，documents 可以是一个生成器，写入的同时上游可以继续生成数据。
+        单条文档写入失败不会中断写入，重试之后仍然失败的文档回调 on_failed
+        :param documents: 可迭代的 {"_id": ..., "_source": ...}，可以带有 "_op_type"：
+            update 表示已存在的文档，只用 _source 做局部更新；none 表示已存在的文档，不需要写入，只计入进度
+        :param on_progress: 每处理一批数据之后回调 on_progress(已处理的条数)，按 documents 的顺序计数
+        :param on_failed: 写入失败的文档回调 on_failed(文档 id, 错误信息)，在计入这条文档的 on_progress 之前调用
+        :return: 处理的条数（包括不需要写入和写入失败的文档）
+        """
+        # 每个已发送但还没有返回结果的文档后面紧跟着的、不需要写入的文档数，
+        # 保证回调的条数之前的文档都已经确实写入完成
+        pending = deque()
+        state = {"processed": 0, "reported": 0}
+
+        def advance(count):
+            state["processed"] += count
+            if on_progress and state["processed"] - state["reported"] >= ELASTICSEARCH_BATCH_SIZE:
+                state["reported"] = state["processed"]
+                on_progress(state["processed"])
+
+        def actions():
+            for document in documents:
+                op_type = document.get('_op_type', 'index')
+                if op_type == 'none':
+                    if pending:
+                        pending[-1] += 1
+                    else:
+                        advance(1)
+                    continue
+                pending.append(0)
+                if op_type == 'update':
+                    yield {
+                        "_op_type": "update",
+                        "_index": self.index_name,
+                        "_id": document['_id'],
+                        "doc": document['_source']
+                    }
+                else:
+                    yield {
+                        "_index": self.index_name,
+                        "_id": document['_id'],
+                        "_source": self.__add_created_metadata_if_not_exists(document['_source'])
+                    }
+
+        writer = self._create_bulk_writer()
+        try:
+            for ok, item in writer.write(actions()):
+                if not ok:
+                    _, info = next(iter(item.items()))
+                    print(f"Document {info.get('_id')} failed: {info.get('error')}")
+                    if on_failed:
+                        on_failed(info.get('_id'), info.get('error'))
+                advance(1 + pending.popleft())
+        except (elasticsearch.ConnectionError, elasticsearch.ConnectionTimeout) as e:
+            traceback.print_exc()
+            raise Exception("写入数据超时")
+        if on_progress and state["processed"] != state["reported"]:
+            on_progress(state["processed"])
+        summary = writer.summary()
+        if summary['failed'] or summary['retried']:
+            print(f"写入完成：成功 {summary['succeeded']} 条，失败 {summary['failed']} 条，重试 {summary['retried']} 次")
+        return state["processed"]
+
+    def get_existing_ids(self, ids):
+        """
+        批量查询哪些 id 的文档已经存在，只返回 id，不返回文档内容
+        """
+        if not ids:
+            return set()
+        try:
+            response = es.mget(index=self.index_name, ids=list(set(ids)), _source=False)
+        except elasticsearch.NotFoundError:
+            return set()
+        return {doc['_id'] for doc in response['docs'] if doc.get('found')}
+
+    def embed_chunks(
+            self,
+            embedding_model,
+            chunks,
+            skip_existing=INGEST_SKIP_EXISTING,
+            update_existing_metadata=INGEST_UPDATE_EXISTING_METADATA,
+            stats=None
+    ):
+        """
+        分批生成向量，返回可以直接写入 ES 的文档。
+        向量化在后台线程中进行，和下游写入 ES 重叠执行，最多提前生成 INGEST_PIPELINE_QUEUE_SIZE 批
+        :param chunks: 可迭代的 {"_id": ..., "page_content": ..., "metadata": ...}
+        :param skip_existing: 向量化之前按批查询 ES，id（内容的 md5）已存在的片段不再生成向量
+        :param update_existing_metadata: 已存在的片段是否用新的 metadata 做局部更新，为 False 时不写入
+        :param stats: 传入 dict 时，在 stats["existing"] 中累计已存在的片段数
+        """
+
+        def embed_batches():
+            for batch in batched(chunks, INGEST_EMBEDDING_BATCH_SIZE):
+                existing_ids = self.get_existing_ids([chunk['_id'] for chunk in batch]) if skip_existing else set()
+                missing = [chunk for chunk in batch if chunk['_id'] not in existing_ids]
+                embeddings = generate_embedding_of_model(
+                    embedding_model, [chunk['page_content'] for chunk in missing]
+                ) if missing else []
+                if stats is not None:
+                    stats["existing"] = stats.get("existing", 0) + len(batch) - len(missing)
+
+                documents = []
+                embedding_index = 0
+                for chunk in batch:
+                    # 按来源查找文档时使用，见 _source_query
+                    source = chunk['metadata'].get('source')
+                    extra = {"sourceHash": source_hash_of(source)} if source else {}
+                    if chunk['_id'] in existing_ids:
+                        documents.append({
+                            "_id": chunk['_id'],
+                            "_op_type": "update" if update_existing_metadata else "none",
+                            "_source": {
+                                "metadata": chunk['metadata'],
+                                **extra
+                            }
+                        })
+                        continue
+                    documents.append({
+                        "_id": chunk['_id'],
+                        "_source": {
+                            "page_content": chunk['page_content'],
+                            "metadata": chunk['metadata'],
+                            "embeddings": embeddings[embedding_index],
+                            **extra
+                        }
+                    })
+                    embedding_index += 1
+                yield documents
+
+        for documents in prefetch(embed_batches(), maxsize=INGEST_PIPELINE_QUEUE_SIZE):
+            yield from documents
+
+    @staticmethod
+    def _source_query(sources):
+        """
+        按来源查找文档：sourceHash 为来源的 md5，不受长度限制；
+        之前写入的文档没有 sourceHash，再按 metadata.source.keyword 查找，旧索引的动态映射中 keyword 只索引
+        不超过 256 个字符的值，更长的来源（例如签名链接）的旧文档查找不到，这些文档重新导入时相当于 append。
+        旧索引没有显式映射 sourceHash，动态映射为 text，md5 只有小写字母和数字，分词后仍是一个完整的词，terms 查询同样能匹配
+        """
+        return {
+            "bool": {
+                "should": [
+                    {"terms": {"sourceHash": [source_hash_of(source) for source in sources]}},
+                    {"terms": {"metadata.source.keyword": list(sources)}}
+                ],
+                "minimum_should_match": 1
+            }
+        }
+
+    def delete_documents_by_source(self, sources):
+        """
+        删除来源（metadata.source）在 sources 中的所有文档
+        :return: 删除的文档数
+        """
+        deleted = 0
+        for chunk in chunk_list(list(sources), ELASTICSEARCH_BATCH_SIZE):
+            response = es.delete_by_query(
+                index=self.index_name,
+                query=self._source_query(chunk),
+                conflicts="proceed",
+                refresh=True
+            )
+            deleted += response['deleted']
+        return deleted
+
+    def get_ids_by_source(self, source):
+        """
+        获取来源（metadata.source）为 source 的所有文档的 id
+        """
+        try:
+            hits = helpers.scan(
+                es,
+                index=self.index_name,
+                query={
+                    "query": self._source_query([source])
+                },
+                _source=False,
+                size=ELASTICSEARCH_BATCH_SIZE
+            )
+            return {hit['_id'] for hit in hits}
+        except elasticsearch.NotFoundError:
+            return set()
+
+    def delete_documents_by_ids(self, ids):
+        """
+        :return: 删除的文档数
+        """
+        deleted = 0
+        for chunk in chunk_list(list(ids), ELASTICSEARCH_BATCH_SIZE):
+            response = es.delete_by_query(
+                index=self.index_name,
+                query={
+                    "ids": {
+                        "values": chunk
+                    }
+                },
+                conflicts="proceed",
+                refresh=True
+            )
+            deleted += response['deleted']
+        return deleted
 
     def delete_es_document(self, pk):
         res = es.delete(
@@ -193,23 +644,26 @@ class ESClient:
         return response['hits']['hits']
 
     def insert_texts_batch(self, embedding_model, text_list):
-        page_contents = [
-            item['page_content'] for item in text_list
-        ]
-        embeddings = generate_embedding_of_model(embedding_model, page_contents)
-        es_documents = []
-        for (index, item) in enumerate(text_list):
-            es_documents.append({
+        """
+        已存在（内容相同）的文本不再重新生成向量，重试之后仍有写入失败的文本时抛出 BulkIndexError
+        """
+        chunks = (
+            {
                 "_id": generate_md5(item['page_content']),
-                "_source": {
-                    "page_content": item['page_content'],
-                    "metadata": item.get('metadata', {}),
-                    "embeddings": embeddings[index]
-                }
-            })
-        self.upsert_documents_batch(
-            es_documents
+                "page_content": item['page_content'],
+                "metadata": item.get('metadata', {})
+            } for item in text_list
         )
+        failed = {"count": 0, "errors": []}
+
+        def on_failed(pk, error):
+            failed["count"] += 1
+            if len(failed["errors"]) < MAX_ERRORS_IN_SUMMARY:
+                failed["errors"].append({"_id": pk, "error": error})
+
+        self.upsert_documents_stream(self.embed_chunks(embedding_model, chunks), on_failed=on_failed)
+        if failed["count"]:
+            raise BulkIndexError(f"{failed['count']} document(s) failed to index.", failed["errors"])
 
     def insert_vector_from_file(
             self,
@@ -222,58 +676,119 @@ class ESClient:
             chunk_overlap=0,
             separator='\n\n',
             pre_process_rules=[],
-            jqSchema=None
+            jqSchema=None,
+            length_unit='char',
+            near_dedup=None,
+            reindex_mode=DEFAULT_REINDEX_MODE
     ):
-        folder = ensure_directory_exists("./download")
-        file_path = oss_client.download_file(file_url, folder)
-        if not file_path:
-            raise Exception("下载文件失败")
-        progress_table = FileProcessProgressTable(app_id=self.app_id)
-        if task_id:
-            progress_table.update_progress(task_id, 0.1, "已下载文件到服务器")
-        texts = load_documents(file_path, chunk_size=chunk_size, chunk_overlap=chunk_overlap, separator=separator,
-                               pre_process_rules=pre_process_rules,
-                               jqSchema=jqSchema
-                               )
-        texts = [text.page_content for text in texts]
-        if len(texts) == 0:
-            return
-        if task_id:
-            progress_table.update_progress(task_id, 0.3, "已加载文件")
-
-        pks = [
-            generate_md5(text) for text in texts
-        ]
-        embeddings = generate_embedding_of_model(embedding_model, texts)
-        es_documents = []
-        for index, pk in enumerate(pks):
+        """
+        :param length_unit: chunk_size 和 chunk_overlap 的单位，char 为字符数，token 为 embedding 模型的 token 数
+        :param near_dedup: 近似重复片段过滤的配置 {"threshold": 0.9, "scope": ...}，为空时不过滤
+        :param reindex_mode: 同一个文件重新导入时的处理方式，见 REINDEX_MODES
+        """
+        # 每个任务使用单独的目录，并发的任务之间不会互相覆盖
+        folder = ensure_directory_exists(os.path.join("./download", task_id or generate_pk()))
+        try:
+            if download_cache:
+                file_path = download_cache.download_url(file_url, folder)
+            else:
+                file_path = oss_client.download_file(file_url, folder)
+            if not file_path:
+                raise Exception("下载文件失败")
+            progress_table = FileProcessProgressTable(app_id=self.app_id)
+            if task_id:
+                progress_table.update_progress(task_id, 0.1, "已下载文件到服务器")
+
             metadata_to_save = {
                 "source": file_url,
             }
             if metadata and isinstance(metadata, dict):
                 metadata_to_save.update(metadata)
-            embedding = embeddings[index]
-            es_documents.append({
-                "_id": pk,
-                "_source": {
-                    "page_content": texts[index],
-                    "metadata": metadata_to_save,
-                    "embeddings": embedding
-                }
-            })
 
+            # 文件按页流式加载和切分，片段产生之后立刻进入向量化和写入阶段，总片段数事先未知，
+            # PDF 根据已加载的页数估算进度
+            position = {"page": 0, "total_pages": 0}
+            # 单个文件的导入，file 和 task 两种范围相同
+            near_duplicate_filter, _ = create_near_duplicate_filter(near_dedup)
+
+            # diff 模式下，同一个文件之前导入的片段中不在新版本里的，在写入完成之后删除
+            previous_ids = self.get_ids_by_source(metadata_to_save['source']) \
+                if reindex_mode == 'diff' else set()
+            current_ids = set()
+            # 已经存在的片段数（这些片段不需要重新生成向量）、删除的旧片段数和写入失败的片段数
+            stats = {"existing": 0, "removed": 0, "failed": 0}
+
+            def stats_message():
+                message = ""
+                if stats["existing"]:
+                    message += f"，其中 {stats['existing']} 条已存在，未重新生成向量"
+                if stats["removed"]:
+                    message += f"，删除了旧版本中的 {stats['removed']} 条数据"
+                if stats["failed"]:
+                    message += f"，{stats['failed']} 条数据写入失败"
+                if near_duplicate_filter:
+                    message += f"，过滤了 {near_duplicate_filter.dropped} 个近似重复的片段"
+                return message
+
+            def iter_chunks():
+                texts = iter_load_documents(file_path, chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+                                            separator=separator, pre_process_rules=pre_process_rules,
+                                            jqSchema=jqSchema,
+                                            tokenizer_model=embedding_model if length_unit == 'token' else None)
+                for text in texts:
+                    if text.metadata.get('total_pages'):
+                        position["page"] = text.metadata.get('page', 0) + 1
+                        position["total_pages"] = text.metadata['total_pages']
+                    if near_duplicate_filter and near_duplicate_filter.is_duplicate(text.page_content):
+                        continue
+                    pk = generate_md5(text.page_content)
+                    current_ids.add(pk)
+                    yield {
+                        "_id": pk,
+                        "page_content": text.page_content,
+                        "metadata": {**metadata_to_save, **get_chunk_location(text.metadata)}
+                    }
+
+            def on_progress(indexed):
+                if task_id:
+                    progress = 0.1
+                    if position["total_pages"]:
+                        progress += 0.89 * position["page"] / position["total_pages"]
+                    progress_table.update_progress(
+                        task_id, min(progress, 0.99),
+                        f"正在加载文件、生成向量并写入向量数据库，已写入 {indexed} 条向量数据{stats_message()}"
+                    )
+
+            def on_failed(pk, error):
+                stats["failed"] += 1
+
+            documents = self.embed_chunks(embedding_model, iter_chunks(), stats=stats)
+            is_large_file = os.path.getsize(file_path) >= ELASTICSEARCH_BULK_INGEST_MIN_FILE_MB * 1024 * 1024
+            if not is_large_file:
+                self.restore_expired_bulk_ingest_settings()
+            with self.bulk_ingest_mode() if is_large_file else nullcontext():
+                indexed = self.upsert_documents_stream(documents, on_progress, on_failed)
+            removed_ids = previous_ids - current_ids
+            if removed_ids:
+                stats["removed"] = self.delete_documents_by_ids(removed_ids)
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+        if indexed == 0:
+            return
         if task_id:
-            progress_table.update_progress(task_id, 0.8, "已生成向量，正在写入向量数据库")
-        self.upsert_documents_batch(es_documents)
-        if task_id:
-            progress_table.update_progress(task_id, 1.0, f"完成，共写入 {len(es_documents)} 条向量数据")
+            progress_table.update_progress(task_id, 1.0, f"完成，共写入 {indexed} 条向量数据{stats_message()}")
 
         file_table = FileRecord(app_id=self.app_id)
-        file_table.create_record(team_id, self.index_name_with_no_suffix, file_url, {
+        # diff 模式下同一个文件只保留一条记录
+        save_record = file_table.upsert_record if reindex_mode == 'diff' else file_table.create_record
+        save_record(team_id, self.index_name_with_no_suffix, file_url, {
             "chunkSize": chunk_size,
             "chunkOverlap": chunk_overlap,
             "separator": separator,
             "preProcessRules": pre_process_rules,
-            "jqSchema": jqSchema
+            "jqSchema": jqSchema,
+            "lengthUnit": length_unit,
+            "nearDedup": near_dedup,
+            "reindexMode": reindex_mode
         })
-        return len(es_documents)
+        return indexed
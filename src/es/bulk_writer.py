@@ -0,0 +1,154 @@
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import elasticsearch
+from elasticsearch import helpers
+
+# 同时进行的 bulk 请求数
+ELASTICSEARCH_BULK_THREAD_COUNT = os.environ.get('ELASTICSEARCH_BULK_THREAD_COUNT', '4')
+ELASTICSEARCH_BULK_THREAD_COUNT = int(ELASTICSEARCH_BULK_THREAD_COUNT)
+# 集群过载（429 / 503）或者连接失败时的最大重试次数，以及指数退避的初始和最大等待秒数
+ELASTICSEARCH_BULK_MAX_RETRIES = os.environ.get('ELASTICSEARCH_BULK_MAX_RETRIES', '5')
+ELASTICSEARCH_BULK_MAX_RETRIES = int(ELASTICSEARCH_BULK_MAX_RETRIES)
+ELASTICSEARCH_BULK_INITIAL_BACKOFF = os.environ.get('ELASTICSEARCH_BULK_INITIAL_BACKOFF', '1')
+ELASTICSEARCH_BULK_INITIAL_BACKOFF = float(ELASTICSEARCH_BULK_INITIAL_BACKOFF)
+ELASTICSEARCH_BULK_MAX_BACKOFF = os.environ.get('ELASTICSEARCH_BULK_MAX_BACKOFF', '60')
+ELASTICSEARCH_BULK_MAX_BACKOFF = float(ELASTICSEARCH_BULK_MAX_BACKOFF)
+
+RETRY_STATUS = (429, 503)
+# 汇总信息中最多保留的失败详情条数
+MAX_ERRORS_IN_SUMMARY = 10
+
+
+class BulkWriter:
+    """
+    并发的 bulk 写入：
+    - 按条数和请求字节数切分成多个 bulk 请求，最多 thread_count 个请求同时进行
+    - 整个请求被拒绝（429 / 503、连接失败）时按指数退避重试整个请求，
+      部分条目被拒绝（429 / 503）时只重试这些条目
+    - 其他失败的条目不会中断写入，记录在 summary() 中
+    write() 按 actions 的顺序返回每一条的结果
+    """
+
+    def __init__(
+            self,
+            client,
+            chunk_size=500,
+            max_chunk_bytes=10 * 1024 * 1024,
+            thread_count=ELASTICSEARCH_BULK_THREAD_COUNT,
+            max_retries=ELASTICSEARCH_BULK_MAX_RETRIES,
+            initial_backoff=ELASTICSEARCH_BULK_INITIAL_BACKOFF,
+            max_backoff=ELASTICSEARCH_BULK_MAX_BACKOFF
+    ):
+        self.client = client
+        self.serializer = client.transport.serializers.get_serializer("application/json")
+        self.chunk_size = chunk_size
+        self.max_chunk_bytes = max_chunk_bytes
+        self.thread_count = max(1, thread_count)
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.succeeded = 0
+        self.failed = 0
+        self.retried = 0
+        self.errors = []
+        self.lock = threading.Lock()
+
+    def summary(self):
+        return {
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "retried": self.retried,
+            "errors": self.errors
+        }
+
+    def _iter_chunks(self, actions):
+        """
+        序列化 actions 并切分，每个 chunk 是 [每一条的序列化后的行]
+        """
+        chunk, size = [], 0
+        for action in actions:
+            header, data = helpers.expand_action(action)
+            lines = [self.serializer.dumps(header)]
+            if data is not None:
+                lines.append(self.serializer.dumps(data))
+            # 每一行后面还有一个换行符
+            lines_size = sum(len(line) + 1 for line in lines)
+            if chunk and (len(chunk) >= self.chunk_size or size + lines_size > self.max_chunk_bytes):
+                yield chunk
+                chunk, size = [], 0
+            chunk.append(lines)
+            size += lines_size
+        if chunk:
+            yield chunk
+
+    def _backoff(self, attempt):
+        # 加入随机抖动，避免多个请求在同一时刻重试
+        return min(self.max_backoff, self.initial_backoff * 2 ** (attempt - 1)) * random.uniform(0.5, 1)
+
+    def _send(self, chunk):
+        """
+        发送一个 chunk，返回和 chunk 顺序相同的 [(ok, item)]
+        """
+        results = [None] * len(chunk)
+        pending = list(range(len(chunk)))
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                with self.lock:
+                    self.retried += len(pending)
+                time.sleep(self._backoff(attempt))
+            try:
+                response = self.client.bulk(operations=[line for index in pending for line in chunk[index]])
+            except elasticsearch.ApiError as e:
+                if e.status_code in RETRY_STATUS and attempt < self.max_retries:
+                    continue
+                raise
+            except (elasticsearch.ConnectionError, elasticsearch.ConnectionTimeout):
+                if attempt < self.max_retries:
+                    continue
+                raise
+
+            to_retry = []
+            for index, item in zip(pending, response['items']):
+                status = next(iter(item.values())).get('status', 500)
+                if status in RETRY_STATUS and attempt < self.max_retries:
+                    to_retry.append(index)
+                    continue
+                results[index] = (200 <= status < 300, item)
+            if not to_retry:
+                break
+            pending = to_retry
+        return results
+
+    def write(self, actions):
+        """
+        :param actions: 和 helpers.bulk 相同格式的 actions，可以是生成器
+        :return: 生成器，按 actions 的顺序返回 (ok, item)
+        """
+        with ThreadPoolExecutor(self.thread_count) as executor:
+            futures = deque()
+            try:
+                for chunk in self._iter_chunks(actions):
+                    futures.append(executor.submit(self._send, chunk))
+                    # 提前准备好下一批请求，同时控制内存中的请求数
+                    while len(futures) > self.thread_count:
+                        yield from self._collect(futures.popleft().result())
+                while futures:
+                    yield from self._collect(futures.popleft().result())
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    def _collect(self, results):
+        for ok, item in results:
+            if ok:
+                self.succeeded += 1
+            else:
+                self.failed += 1
+                if len(self.errors) < MAX_ERRORS_IN_SUMMARY:
+                    self.errors.append(item)
+            yield ok, item
@@ -6,7 +6,7 @@ from vines_worker_sdk.server.exceptions import ClientException
 from src.database import CollectionTable, FileProcessProgressTable, FileRecord
 from bson.json_util import dumps
 from src.utils import generate_short_id, get_dimension_by_embedding_model, generate_random_string
-from src.es import ESClient
+from src.es import ESClient, get_vector_index_config, VECTOR_SIMILARITIES, VECTOR_INDEX_TYPES
 
 
 @app.post('/api/vector/collections')
@@ -20,6 +20,16 @@ def create_collection():
     metadata_fields = data.get('metadataFields', None)
     description = data.get('description', '')
     dimension = get_dimension_by_embedding_model(embedding_model)
+    # 向量索引的配置：{"similarity": "dot_product", "indexType": "int8_hnsw", "m": 16, "efConstruction": 100}，
+    # 不传的使用默认值
+    vector_index = get_vector_index_config(data.get('vectorIndex'))
+    if vector_index['similarity'] not in VECTOR_SIMILARITIES:
+        raise ClientException(f"不支持的相似度算法：{vector_index['similarity']}")
+    if vector_index['indexType'] not in VECTOR_INDEX_TYPES:
+        raise ClientException(f"不支持的向量索引类型：{vector_index['indexType']}")
+    for key in ('m', 'efConstruction'):
+        if not isinstance(vector_index[key], int) or vector_index[key] <= 0:
+            raise ClientException(f"非法的向量索引参数 {key}：{vector_index[key]}")
     table = CollectionTable(
         app_id=app_id
     )
@@ -35,7 +45,7 @@ def create_collection():
         app_id=app_id,
         index_name=name
     )
-    es_client.create_es_index(dimension)
+    es_client.create_es_index(dimension, vector_index=vector_index, metadata_fields=metadata_fields)
     table.insert_one(
         creator_user_id=user_id,
         team_id=team_id,
@@ -45,7 +55,8 @@ def create_collection():
         embedding_model=embedding_model,
         dimension=dimension,
         logo=logo,
-        metadata_fields=metadata_fields
+        metadata_fields=metadata_fields,
+        vector_index=vector_index
     )
 
     return {
@@ -159,7 +170,9 @@ def copy_collection(name):
     # 在 es 中创建 template
     es_client = ESClient(app_id=app_id, index_name=name)
     es_client.create_es_index(
-        dimension
+        dimension,
+        vector_index=collection.get('vectorIndex'),
+        metadata_fields=collection.get('metadataFields')
     )
     table.insert_one(
         creator_user_id=user_id,
@@ -170,7 +183,8 @@ def copy_collection(name):
         logo=collection.get('logo'),
         embedding_model=embedding_model,
         dimension=dimension,
-        metadata_fields=collection.get('metadataFields')
+        metadata_fields=collection.get('metadataFields'),
+        vector_index=collection.get('vectorIndex')
     )
     return {
         "name": new_collection_name
@@ -204,7 +218,9 @@ def empty_collection(name):
     )
     collection = table.find_by_name_without_team(name)
     es_client.create_es_index(
-        dimension=collection['dimension']
+        dimension=collection['dimension'],
+        vector_index=collection.get('vectorIndex'),
+        metadata_fields=collection.get('metadataFields')
     )
     return {
         "success": True
@@ -1,7 +1,12 @@
 from .server import app
-from ..utils import SUPPORTED_EMBEDDING_MODELS
+from ..utils import SUPPORTED_EMBEDDING_MODELS, model_registry
 
 
 @app.get("/api/vector/supported-embedding-models")
 def get_supported_embedding_models():
     return SUPPORTED_EMBEDDING_MODELS
+
+
+@app.get("/api/vector/loaded-models")
+def get_loaded_models():
+    return model_registry.describe()
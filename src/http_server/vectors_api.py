@@ -1,11 +1,12 @@
 from flask import request
 from src.utils import generate_embedding_of_model, generate_md5
+from src.utils.near_dedup import NEAR_DEDUP_SCOPES
 from .server import app
 from src.database import CollectionTable, FileProcessProgressTable
 from vines_worker_sdk.server.exceptions import ServerException, ClientException
 import uuid
 from src.queue import submit_task, PROCESS_FILE_QUEUE_NAME
-from src.es import ESClient
+from src.es import ESClient, REINDEX_MODES, DEFAULT_REINDEX_MODE
 from ..utils.oss.tos import TOSClient
 from ..utils.oss.aliyunoss import AliyunOSSClient
 
@@ -72,12 +73,34 @@ def save_vector(name):
         chunk_overlap = segmentParams.get('segmentChunkOverlap', 10)
         chunk_size = segmentParams.get('segmentMaxLength', 1000)
         separator = segmentParams.get('segmentSymbol', "\n\n")
-        task_id = str(uuid.uuid4())
-
+        # chunk 长度的单位：char 按字符数，token 按 embedding 模型的 token 数
+        length_unit = segmentParams.get('segmentLengthUnit', 'char')
+        if length_unit not in ('char', 'token'):
+            raise ClientException(f"不支持的长度单位：{length_unit}")
+        # 近似重复片段过滤，例如 {"threshold": 0.9, "scope": "file"}，不传时不过滤
+        near_dedup = params.get('nearDedup')
+        if near_dedup:
+            threshold = near_dedup.get('threshold', 0.9)
+            if not isinstance(threshold, (int, float)) or not 0 < threshold <= 1:
+                raise ClientException(f"非法的相似度阈值：{threshold}")
+            if near_dedup.get('scope', 'file') not in NEAR_DEDUP_SCOPES:
+                raise ClientException(f"不支持的去重范围：{near_dedup.get('scope')}")
+        # 重新导入同一个文件时的处理方式：diff 只写入新增的片段并删除旧版本中的片段，append 保留旧版本的片段
+        reindex_mode = params.get('reindexMode', DEFAULT_REINDEX_MODE)
+        if reindex_mode not in REINDEX_MODES:
+            raise ClientException(f"不支持的重新导入方式：{reindex_mode}")
         progress_table = FileProcessProgressTable(app_id)
-        progress_table.create_task(
-            team_id=team_id, collection_name=name, task_id=task_id
-        )
+        # 传入之前失败的 OSS 导入任务的 id 时，会跳过该任务中已经导入完成的文件
+        resume_task_id = data.get('resumeTaskId')
+        if resume_task_id:
+            if not progress_table.get_task(team_id=team_id, collection_name=name, task_id=resume_task_id):
+                raise ClientException(f"任务 {resume_task_id} 不存在")
+            task_id = resume_task_id
+        else:
+            task_id = str(uuid.uuid4())
+            progress_table.create_task(
+                team_id=team_id, collection_name=name, task_id=task_id
+            )
         submit_task(PROCESS_FILE_QUEUE_NAME, {
             'app_id': app_id,
             'team_id': team_id,
@@ -92,7 +115,10 @@ def save_vector(name):
             'chunk_overlap': chunk_overlap,
             'separator': separator,
             'pre_process_rules': pre_process_rules,
-            'jqSchema': jqSchema
+            'jqSchema': jqSchema,
+            'length_unit': length_unit,
+            'near_dedup': near_dedup,
+            'reindex_mode': reindex_mode
         })
         return {"taskId": task_id}
     else:
@@ -4,13 +4,20 @@ import json
 import traceback
 from src.utils.oss.tos import TOSClient
 from src.utils.oss.aliyunoss import AliyunOSSClient
+from src.utils.oss import FileFilter
 from src.database import CollectionTable, FileProcessProgressTable
-from src.es import ESClient
+from src.es import ESClient, DEFAULT_REINDEX_MODE
+from src.queue.oss_import import OSSImporter
+from src.queue.reliable_queue import ReliableQueue
 
 REDIS_URL = os.environ.get("REDIS_URL")
 redis = redis.from_url(REDIS_URL)
 
 PROCESS_FILE_QUEUE_NAME = 'queue:vines-worker-text-collections:process-file'
+QUEUE_VISIBILITY_TIMEOUT = os.environ.get('QUEUE_VISIBILITY_TIMEOUT', '60')
+QUEUE_VISIBILITY_TIMEOUT = int(QUEUE_VISIBILITY_TIMEOUT)
+QUEUE_MAX_ATTEMPTS = os.environ.get('QUEUE_MAX_ATTEMPTS', '3')
+QUEUE_MAX_ATTEMPTS = int(QUEUE_MAX_ATTEMPTS)
 
 
 def submit_task(queue_name, task_data):
@@ -32,6 +39,9 @@ def consume_task(task_data):
     separator = task_data['separator']
     pre_process_rules = task_data['pre_process_rules']
     jqSchema = task_data['jqSchema']
+    length_unit = task_data.get('length_unit', 'char')
+    near_dedup = task_data.get('near_dedup')
+    reindex_mode = task_data.get('reindex_mode', DEFAULT_REINDEX_MODE)
     es_client = ESClient(app_id=app_id, index_name=collection_name)
     table = CollectionTable(
         app_id=app_id
@@ -41,14 +51,14 @@ def consume_task(task_data):
     if oss_config:
         try:
             oss_type, oss_config = oss_config.get('ossType'), oss_config.get('ossConfig')
+            # 增量同步：只导入新增和变更的文件，并删除已被移除的文件的数据
+            incremental = oss_config.get('syncMode') == 'incremental'
             if oss_type == 'TOS':
                 endpoint, region, bucket_name, accessKeyId, accessKeySecret, baseFolder, fileExtensions, excludeFileRegex, importFileNameNotContent = oss_config.get(
                     'endpoint'), oss_config.get('region'), oss_config.get('bucketName'), oss_config.get(
                     'accessKeyId'), oss_config.get('accessKeySecret'), oss_config.get('baseFolder'), oss_config.get(
                     'fileExtensions'), oss_config.get('excludeFileRegex'), oss_config.get(
                     'importFileNameNotContent')
-                if fileExtensions:
-                    fileExtensions = fileExtensions.split(',')
                 tos_client = TOSClient(
                     endpoint,
                     region,
@@ -56,44 +66,28 @@ def consume_task(task_data):
                     accessKeyId,
                     accessKeySecret,
                 )
-                all_files = tos_client.get_all_files_in_base_folder(
+                # 边获取文件列表边导入，获取到的文件数会在导入进度中更新
+                all_files = tos_client.iter_objects_in_base_folder(
                     baseFolder,
                     fileExtensions,
                     excludeFileRegex
                 )
-                progress_table.update_progress(
-                    task_id=task_id, progress=0.1, message=f"共获取到 {len(all_files)} 个文件"
+                OSSImporter(
+                    es_client, tos_client, team_id, embedding_model, task_id,
+                    chunk_size=chunk_size,
+                    chunk_overlap=chunk_overlap,
+                    separator=separator,
+                    pre_process_rules=pre_process_rules,
+                    jqSchema=jqSchema,
+                    length_unit=length_unit,
+                    near_dedup=near_dedup,
+                    reindex_mode=reindex_mode
+                ).run(
+                    all_files,
+                    incremental=incremental,
+                    base_folder=baseFolder,
+                    file_filter=FileFilter(fileExtensions, excludeFileRegex)
                 )
-                processed = 0
-                failed = 0
-                for absolute_filename in all_files:
-                    try:
-                        presign_url = tos_client.get_signed_url(absolute_filename)
-                        signed_url = presign_url.signed_url
-                        metadata = {
-                            "filename": absolute_filename
-                        }
-                        es_client.insert_vector_from_file(
-                            team_id,
-                            embedding_model, signed_url, metadata,
-                            chunk_size=chunk_size,
-                            chunk_overlap=chunk_overlap,
-                            separator=separator,
-                            pre_process_rules=pre_process_rules,
-                            jqSchema=jqSchema
-                        )
-                    except Exception as e:
-                        failed += 1
-                        print(f"导入文件失败：file={absolute_filename}, 错误信息: ")
-                        traceback.print_exc()
-                    finally:
-                        processed += 1
-                        progress = "{:.2f}".format(processed / len(all_files))
-                        message = f"已成功写入 {processed}/{len(all_files)} 个文件" if failed == 0 else f"已成功写入 {processed}/{len(all_files)} 个文件，失败 {failed} 个文件"
-                        progress_table.update_progress(
-                            task_id=task_id, progress=0.1 + float(progress),
-                            message=message
-                        )
 
                 table.add_metadata_fields_if_not_exists(
                     team_id, collection_name, ['filename', 'filepath']
@@ -110,43 +104,28 @@ def consume_task(task_data):
                     access_key=accessKeyId,
                     secret_key=accessKeySecret
                 )
-                all_files = aliyunoss_client.get_all_files_in_base_folder(
+                # 边获取文件列表边导入，获取到的文件数会在导入进度中更新
+                all_files = aliyunoss_client.iter_objects_in_base_folder(
                     baseFolder,
                     fileExtensions,
                     excludeFileRegex
                 )
-                progress_table.update_progress(
-                    task_id=task_id, progress=0.1, message=f"共获取到 {len(all_files)} 个文件"
+                OSSImporter(
+                    es_client, aliyunoss_client, team_id, embedding_model, task_id,
+                    chunk_size=chunk_size,
+                    chunk_overlap=chunk_overlap,
+                    separator=separator,
+                    pre_process_rules=pre_process_rules,
+                    jqSchema=jqSchema,
+                    length_unit=length_unit,
+                    near_dedup=near_dedup,
+                    reindex_mode=reindex_mode
+                ).run(
+                    all_files,
+                    incremental=incremental,
+                    base_folder=baseFolder,
+                    file_filter=FileFilter(fileExtensions, excludeFileRegex)
                 )
-                processed = 0
-                failed = 0
-                for absolute_filename in all_files:
-                    try:
-                        signed_url = aliyunoss_client.get_signed_url(absolute_filename)
-                        metadata = {
-                            "filename": absolute_filename
-                        }
-                        es_client.insert_vector_from_file(
-                            team_id,
-                            embedding_model, signed_url, metadata,
-                            chunk_size=chunk_size,
-                            chunk_overlap=chunk_overlap,
-                            separator=separator,
-                            pre_process_rules=pre_process_rules,
-                            jqSchema=jqSchema
-                        )
-                    except Exception as e:
-                        failed += 1
-                        print(f"导入文件失败：file={absolute_filename}, 错误信息: ")
-                        traceback.print_exc()
-                    finally:
-                        processed += 1
-                        progress = "{:.2f}".format(processed / len(all_files))
-                        message = f"已成功写入 {processed}/{len(all_files)} 个文件" if failed == 0 else f"已成功写入 {processed}/{len(all_files)} 个文件，失败 {failed} 个文件"
-                        progress_table.update_progress(
-                            task_id=task_id, progress=0.1 + float(progress),
-                            message=message
-                        )
 
                 table.add_metadata_fields_if_not_exists(
                     team_id, collection_name, ['filename', 'filepath']
@@ -154,9 +133,9 @@ def consume_task(task_data):
 
         except Exception as e:
             traceback.print_exc()
-            progress_table.mark_task_failed(
-                task_id=task_id, message=str(e)
-            )
+            # 交给队列重试，多次失败进入死信队列之后才把任务标记为失败
+            progress_table.update_progress(task_id, 0, f"执行失败，等待重试：{e}")
+            raise
 
     elif file_url:
         try:
@@ -167,29 +146,65 @@ def consume_task(task_data):
                 chunk_overlap=chunk_overlap,
                 separator=separator,
                 pre_process_rules=pre_process_rules,
-                jqSchema=jqSchema
+                jqSchema=jqSchema,
+                length_unit=length_unit,
+                near_dedup=near_dedup,
+                reindex_mode=reindex_mode
             )
             table.add_metadata_fields_if_not_exists(
                 team_id, collection_name, metadata.keys()
             )
         except Exception as e:
             traceback.print_exc()
-            progress_table.mark_task_failed(
-                task_id=task_id, message=str(e)
-            )
+            # 交给队列重试，多次失败进入死信队列之后才把任务标记为失败
+            progress_table.update_progress(task_id, 0, f"执行失败，等待重试：{e}")
+            raise
+
+
+def mark_dead_letter_task_failed(task_json_str, error=None):
+    try:
+        task_data = json.loads(task_json_str)
+        progress_table = FileProcessProgressTable(task_data['app_id'])
+        message = "任务多次执行失败，已停止重试"
+        if error is not None:
+            message += f"：{error}"
+        progress_table.mark_task_failed(
+            task_id=task_data['task_id'], message=message
+        )
+    except Exception:
+        traceback.print_exc()
 
 
 # 从队列中获取并处理任务
-def consume_task_forever(queue_name):
-    while True:
+def consume_task_forever(queue_name, stop_event=None):
+    """
+    :param stop_event: 设置之后处理完当前任务就退出
+    """
+    queue = ReliableQueue(
+        redis, queue_name,
+        visibility_timeout=QUEUE_VISIBILITY_TIMEOUT,
+        max_attempts=QUEUE_MAX_ATTEMPTS
+    )
+    queue.start_heartbeat()
+    while stop_event is None or not stop_event.is_set():
+        task_json_str = None
         try:
-            # 使用 blpop 阻塞等待任务
-            _, task_json_str = redis.blpop(queue_name)
+            # 把崩溃的消费者未完成的任务重新入队
+            queue.requeue_expired(on_dead_letter=mark_dead_letter_task_failed)
+            # 使用 blmove 阻塞等待任务，任务会先放到当前消费者的 processing 列表中，处理完成后再 ack
+            task_json_str = queue.pop(timeout=5)
+            if task_json_str is None:
+                continue
             task_data = json.loads(task_json_str)
             print(f"Processing task: {task_data}")
             consume_task(task_data)
+            queue.ack(task_json_str)
         except Exception as e:
             print("消费任务失败：")
             print("=============================")
             print(e)
             print("=============================")
+            if task_json_str is not None:
+                # 失败计入任务的执行次数，超过次数后移入死信队列并把任务标记为失败
+                queue.nack(task_json_str, on_dead_letter=lambda payload: mark_dead_letter_task_failed(payload, e))
+    queue.stop_heartbeat()
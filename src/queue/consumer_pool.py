@@ -0,0 +1,107 @@
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+INGEST_CONSUMER_DEVICES = os.environ.get('INGEST_CONSUMER_DEVICES', '')
+INGEST_CONSUMERS_PER_DEVICE = os.environ.get('INGEST_CONSUMERS_PER_DEVICE', '1')
+INGEST_CONSUMERS_PER_DEVICE = int(INGEST_CONSUMERS_PER_DEVICE)
+INGEST_CONSUMER_DRAIN_TIMEOUT = os.environ.get('INGEST_CONSUMER_DRAIN_TIMEOUT', '300')
+INGEST_CONSUMER_DRAIN_TIMEOUT = int(INGEST_CONSUMER_DRAIN_TIMEOUT)
+
+
+def bind_device(device):
+    """
+    在子进程初始化 CUDA / NPU 之前限制它可见的设备，例如 cuda:1 -> CUDA_VISIBLE_DEVICES=1，cpu 则隐藏所有 GPU
+    """
+    if not device:
+        return
+    device_type, _, index = device.partition(':')
+    if device_type == 'cpu':
+        os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    elif device_type == 'cuda':
+        os.environ['CUDA_VISIBLE_DEVICES'] = index or '0'
+    elif device_type == 'npu':
+        os.environ['ASCEND_RT_VISIBLE_DEVICES'] = index or '0'
+    else:
+        raise Exception(f"不支持的设备类型：{device}")
+
+
+def run_consumer(queue_name, device, stop_event):
+    bind_device(device)
+
+    # 主进程的信号处理会把 conductor 任务标记为失败，消费者进程收到信号时只需要停止拉取新任务
+    def stop(signum, frame):
+        print(f"消费者进程 {os.getpid()} 收到退出信号，处理完当前任务后退出 ...")
+        stop_event.set()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    from src.queue import consume_task_forever
+    consume_task_forever(queue_name, stop_event)
+
+
+class ConsumerPool:
+    """
+    多个消费者进程共享同一个队列，每个进程绑定一个设备（INGEST_CONSUMER_DEVICES，例如 cuda:0,cuda:1 或 cpu），
+    每个设备启动 INGEST_CONSUMERS_PER_DEVICE 个消费者，不配置设备时不做绑定。
+    文件的解析在每个消费者内部的进程池中进行（OSS_IMPORT_PARSE_CONCURRENCY）。
+    消费者进程使用 spawn 启动：主进程（conductor 的搜索、向量化 worker）可能已经初始化了 CUDA，
+    fork 出来的子进程无法使用 CUDA，bind_device 设置的 CUDA_VISIBLE_DEVICES 也不会生效。
+    """
+
+    def __init__(self, queue_name, devices=None, consumers_per_device=1, drain_timeout=300):
+        self.queue_name = queue_name
+        self.devices = devices or [None]
+        self.consumers_per_device = consumers_per_device
+        self.drain_timeout = drain_timeout
+        self.context = multiprocessing.get_context('spawn')
+        self.stop_event = self.context.Event()
+        self.processes = []
+
+    def _start_process(self, device):
+        process = self.context.Process(target=run_consumer, args=(self.queue_name, device, self.stop_event))
+        process.start()
+        return process
+
+    def start(self):
+        for device in self.devices:
+            for _ in range(self.consumers_per_device):
+                self.processes.append((device, self._start_process(device)))
+        threading.Thread(target=self._watch, daemon=True, name="consumer-pool-watcher").start()
+
+    def _watch(self):
+        # 异常退出的消费者自动重启，它未完成的任务会在心跳过期之后被重新入队
+        while not self.stop_event.wait(5):
+            for index, (device, process) in enumerate(self.processes):
+                if not process.is_alive() and not self.stop_event.is_set():
+                    print(f"消费者进程 {process.pid} 已退出（exitcode={process.exitcode}），重新启动")
+                    self.processes[index] = (device, self._start_process(device))
+
+    def stop(self):
+        """
+        停止拉取新任务，等待正在处理的任务完成，超时之后强制退出
+        """
+        self.stop_event.set()
+        deadline = time.monotonic() + self.drain_timeout
+        for _, process in self.processes:
+            process.join(max(0, deadline - time.monotonic()))
+        for _, process in self.processes:
+            if process.is_alive():
+                print(f"消费者进程 {process.pid} 未能在 {self.drain_timeout} 秒内完成任务，强制退出")
+                # 消费者进程收到 SIGTERM 只会设置 stop_event，超时之后需要用 SIGKILL 结束，
+                # 它未完成的任务会在心跳过期之后被重新入队
+                process.kill()
+                process.join()
+
+
+def create_consumer_pool(queue_name):
+    devices = [device.strip() for device in INGEST_CONSUMER_DEVICES.split(',') if device.strip()]
+    return ConsumerPool(
+        queue_name,
+        devices=devices,
+        consumers_per_device=INGEST_CONSUMERS_PER_DEVICE,
+        drain_timeout=INGEST_CONSUMER_DRAIN_TIMEOUT
+    )
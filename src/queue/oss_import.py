@@ -0,0 +1,442 @@
+import os
+import queue
+import shutil
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import nullcontext
+
+from vines_worker_sdk.utils.files import ensure_directory_exists
+
+from src.es import DEFAULT_REINDEX_MODE
+from src.database import FileProcessProgressTable, FileRecord, FileImportCheckpointTable
+from src.utils import generate_md5, download_cache, chunk_list
+from src.utils.document_loader import load_document_chunks, load_document_chunks_from_buffer, get_parse_pool
+from src.utils.near_dedup import create_near_duplicate_filter
+from src.utils.oss import FileFilter, OSS_DOWNLOAD_MEMORY_THRESHOLD_MB
+
+OSS_IMPORT_DOWNLOAD_CONCURRENCY = os.environ.get('OSS_IMPORT_DOWNLOAD_CONCURRENCY', '8')
+OSS_IMPORT_DOWNLOAD_CONCURRENCY = int(OSS_IMPORT_DOWNLOAD_CONCURRENCY)
+OSS_IMPORT_PARSE_CONCURRENCY = os.environ.get('OSS_IMPORT_PARSE_CONCURRENCY', str(min(os.cpu_count() or 1, 4)))
+OSS_IMPORT_PARSE_CONCURRENCY = int(OSS_IMPORT_PARSE_CONCURRENCY)
+OSS_IMPORT_LISTING_QUEUE_SIZE = os.environ.get('OSS_IMPORT_LISTING_QUEUE_SIZE', '10000')
+OSS_IMPORT_LISTING_QUEUE_SIZE = int(OSS_IMPORT_LISTING_QUEUE_SIZE)
+
+_LISTING_END = object()
+
+
+class OSSImporter:
+    """
+    并发导入 OSS 中的文件，分为四个阶段：
+    0. 后台线程中获取文件列表，获取到的文件立刻进入下一阶段
+    1. 线程池中通过 OSS SDK 下载文件，小文件直接读到内存中，大文件使用并发的范围请求
+    2. 进程池中解析、切分文件
+    3. 多个文件的片段合并成 batch 统一向量化，并流式写入 ES
+    """
+
+    def __init__(
+            self,
+            es_client,
+            storage_client,
+            team_id,
+            embedding_model,
+            task_id,
+            chunk_size=1000,
+            chunk_overlap=0,
+            separator='\n\n',
+            pre_process_rules=[],
+            jqSchema=None,
+            length_unit='char',
+            near_dedup=None,
+            reindex_mode=DEFAULT_REINDEX_MODE
+    ):
+        """
+        :param length_unit: chunk_size 和 chunk_overlap 的单位，char 为字符数，token 为 embedding 模型的 token 数
+        :param near_dedup: 近似重复片段过滤的配置 {"threshold": 0.9, "scope": "file" | "task"}，为空时不过滤，
+            scope 为 file 时只在同一个文件内去重，为 task 时在本次导入的所有文件之间去重，不和索引中已有的片段比较
+        :param reindex_mode: 之前导入过的文件重新导入时的处理方式：diff 只为新增的片段生成向量，并删除新版本中已不存在的片段
+            （可能删除其他文件中内容相同的片段，见 REINDEX_MODES）；
+            append 在增量同步时先删除文件的所有旧片段再全部重新导入，全量导入时保留旧片段
+        """
+        self.es_client = es_client
+        self.storage_client = storage_client
+        self.team_id = team_id
+        self.embedding_model = embedding_model
+        self.task_id = task_id
+        self.split_config = {
+            "chunkSize": chunk_size,
+            "chunkOverlap": chunk_overlap,
+            "separator": separator,
+            "preProcessRules": pre_process_rules,
+            "jqSchema": jqSchema,
+            "lengthUnit": length_unit,
+            "nearDedup": near_dedup,
+            "reindexMode": reindex_mode
+        }
+        self.parse_kwargs = {
+            "chunk_size": chunk_size,
+            "chunk_overlap": chunk_overlap,
+            "separator": separator,
+            "pre_process_rules": pre_process_rules,
+            "jqSchema": jqSchema,
+            "tokenizer_model": embedding_model if length_unit == 'token' else None
+        }
+        self.progress_table = FileProcessProgressTable(es_client.app_id)
+        self.file_table = FileRecord(app_id=es_client.app_id)
+        self.checkpoint_table = FileImportCheckpointTable(app_id=es_client.app_id)
+        self.download_folder = ensure_directory_exists(os.path.join("./download", task_id))
+        # 导入记录按 bucket 区分，同一个知识库可以从多个 bucket 导入
+        self.bucket = storage_client.get_object_uri('')
+        self.base_folder = ''
+        self.total = 0
+        self.processed = 0
+        self.failed = 0
+        self.skipped = 0
+        self.indexed = 0
+        # 每个文件还未写入 ES 的片段数和对象地址
+        self.remaining_chunks = {}
+        self.download_urls = {}
+        # oss key -> 对象信息（key、size、etag、last_modified）
+        self.objects = {}
+        # 获取文件列表的线程把需要导入的文件放到这个队列中
+        self.pending_files = queue.Queue(maxsize=OSS_IMPORT_LISTING_QUEUE_SIZE)
+        self.listing_finished = False
+        self.listing_error = None
+        self.stopped = threading.Event()
+        self.reindex_mode = reindex_mode
+        # 需要处理旧片段的文件：增量同步时内容有变化的文件，diff 模式下还包括全量导入时之前导入过的文件
+        self.changed_files = set()
+        # diff 模式下 changed_files 中的文件在 ES 中已有的片段 id
+        self.previous_ids = {}
+        # 按写入顺序记录每个片段的 id 和所属的文件，用于判断文件是否已全部写入
+        self.chunk_owners = deque()
+        # 写入失败的片段 id 和包含写入失败的片段的文件，这些文件不记录为导入完成，断点续传或增量同步时会重新导入
+        self.failed_chunk_ids = set()
+        self.failed_files = set()
+        # 下载解析阶段和写入阶段在不同的线程中更新进度
+        self.lock = threading.Lock()
+        self.near_duplicate_filter, self.near_dedup_scope = create_near_duplicate_filter(near_dedup)
+        # 已经存在于 ES 中的片段数，这些片段不需要重新生成向量
+        self.embed_stats = {"existing": 0}
+        # diff 模式下删除的旧片段数
+        self.removed_chunks = 0
+
+    def _download(self, key):
+        """
+        通过 OSS SDK 直接下载，小文件返回 bytes，大文件返回本地文件路径，etag 未变化的大文件直接使用本地缓存
+        """
+        url = self.storage_client.get_object_uri(key)
+        etag = self.objects[key].get('etag')
+        size = self.objects[key].get('size')
+        # 小对象直接下载到内存中，不经过磁盘缓存
+        use_cache = download_cache is not None and etag and \
+            (size is None or size > OSS_DOWNLOAD_MEMORY_THRESHOLD_MB * 1024 * 1024)
+        data_or_path = download_cache.get(url, etag, self.download_folder) if use_cache else None
+        if data_or_path is None:
+            data_or_path = self.storage_client.download(key, size, self.download_folder)
+            if use_cache:
+                download_cache.put(url, data_or_path, etag=etag)
+        if key in self.changed_files:
+            if self.reindex_mode == 'diff':
+                previous_ids = self.es_client.get_ids_by_source(url)
+                with self.lock:
+                    self.previous_ids[key] = previous_ids
+            else:
+                self.es_client.delete_documents_by_source([url])
+        return url, data_or_path
+
+    def _iter_parsed_files(self, download_pool, parse_pool):
+        """
+        获取文件列表、下载和解析同时进行，按完成顺序返回 (key, 对象地址, 文本片段列表)
+        """
+        max_in_flight = OSS_IMPORT_DOWNLOAD_CONCURRENCY + OSS_IMPORT_PARSE_CONCURRENCY * 2
+        in_flight = {}
+        listing_finished = False
+
+        try:
+            while True:
+                while not listing_finished and len(in_flight) < max_in_flight:
+                    # 没有正在处理的文件时等待文件列表
+                    key = self._get_pending_file(block=not in_flight)
+                    if key is None:
+                        break
+                    if key is _LISTING_END:
+                        listing_finished = True
+                        break
+                    in_flight[download_pool.submit(self._download, key)] = ('download', key, None)
+                if not in_flight:
+                    if listing_finished or self.stopped.is_set():
+                        break
+                    continue
+
+                done, _ = wait(in_flight, timeout=0.5, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, key, url = in_flight.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception:
+                        print(f"导入文件失败：file={key}, 错误信息: ")
+                        traceback.print_exc()
+                        self._mark_file_done(key, success=False)
+                        continue
+                    if stage == 'download':
+                        url, data_or_path = result
+                        if isinstance(data_or_path, bytes):
+                            parse_future = parse_pool.submit(
+                                load_document_chunks_from_buffer, data_or_path, key, **self.parse_kwargs
+                            )
+                        else:
+                            parse_future = parse_pool.submit(load_document_chunks, data_or_path, **self.parse_kwargs)
+                        in_flight[parse_future] = ('parse', key, url)
+                    else:
+                        yield key, url, result
+        finally:
+            # 解析进程池是共用的，提前退出时取消还没有开始的任务
+            for future in in_flight:
+                future.cancel()
+
+        if self.listing_error is not None:
+            raise self.listing_error
+
+    def _iter_chunks(self, download_pool, parse_pool):
+        for key, url, chunks in self._iter_parsed_files(download_pool, parse_pool):
+            if self.near_duplicate_filter:
+                if self.near_dedup_scope == 'file':
+                    self.near_duplicate_filter.reset()
+                chunks = [chunk for chunk in chunks if not self.near_duplicate_filter.is_duplicate(chunk[0])]
+            ids = [generate_md5(text) for text, _ in chunks]
+            with self.lock:
+                previous_ids = self.previous_ids.pop(key, None)
+            if previous_ids:
+                # 新版本中已不存在的片段，新版本中仍然存在的片段在向量化之前会被跳过
+                removed_ids = previous_ids.difference(ids)
+                if removed_ids:
+                    self.removed_chunks += self.es_client.delete_documents_by_ids(removed_ids)
+            if len(chunks) == 0:
+                self.checkpoint_table.mark_file_done(self.task_id, key)
+                self.file_table.upsert_oss_object_record(
+                    self.team_id, self.es_client.index_name_with_no_suffix, url, self.objects[key], self.split_config,
+                    bucket=self.bucket, base_folder=self.base_folder
+                )
+                self._mark_file_done(key, success=True)
+                continue
+            with self.lock:
+                self.remaining_chunks[key] = len(chunks)
+                self.download_urls[key] = url
+            for pk, (text, location) in zip(ids, chunks):
+                yield {
+                    "_id": pk,
+                    "page_content": text,
+                    "metadata": {
+                        "source": url,
+                        "filename": key,
+                        **location
+                    }
+                }
+
+    def _track_owners(self, documents):
+        for document in documents:
+            self.chunk_owners.append((document['_source']['metadata']['filename'], document['_id']))
+            yield document
+
+    def _on_failed(self, pk, error):
+        self.failed_chunk_ids.add(pk)
+
+    def _on_indexed(self, indexed):
+        for _ in range(indexed - self.indexed):
+            key, pk = self.chunk_owners.popleft()
+            if pk in self.failed_chunk_ids:
+                self.failed_files.add(key)
+            with self.lock:
+                self.remaining_chunks[key] -= 1
+                finished = self.remaining_chunks[key] == 0
+                if finished:
+                    del self.remaining_chunks[key]
+                    url = self.download_urls.pop(key)
+            if finished and key in self.failed_files:
+                self.failed_files.discard(key)
+                print(f"导入文件失败：file={key}, 部分片段写入 ES 失败")
+                self._mark_file_done(key, success=False)
+            elif finished:
+                self.checkpoint_table.mark_file_done(self.task_id, key)
+                self.file_table.upsert_oss_object_record(
+                    self.team_id, self.es_client.index_name_with_no_suffix, url, self.objects[key], self.split_config,
+                    bucket=self.bucket, base_folder=self.base_folder
+                )
+                self._mark_file_done(key, success=True)
+        self.indexed = indexed
+
+    def _mark_file_done(self, key, success):
+        with self.lock:
+            self.processed += 1
+            if not success:
+                self.failed += 1
+            self._report_progress()
+
+    def _report_progress(self):
+        if not self.listing_finished:
+            message = f"已处理 {self.processed} 个文件，正在获取文件列表，已获取 {self.total} 个文件"
+            self.progress_table.update_progress(task_id=self.task_id, progress=0.1, message=message)
+            return
+        progress = self.processed / self.total if self.total else 1
+        message = f"已成功写入 {self.processed}/{self.total} 个文件" if self.failed == 0 else f"已成功写入 {self.processed}/{self.total} 个文件，失败 {self.failed} 个文件"
+        self.progress_table.update_progress(
+            task_id=self.task_id, progress=0.1 + 0.89 * progress,
+            message=message + self._stats_message()
+        )
+
+    def _stats_message(self):
+        message = ""
+        if self.embed_stats["existing"]:
+            message += f"，{self.embed_stats['existing']} 个片段已存在，未重新生成向量"
+        if self.removed_chunks:
+            message += f"，删除了 {self.removed_chunks} 个旧版本中的片段"
+        if self.near_duplicate_filter:
+            message += f"，过滤了 {self.near_duplicate_filter.dropped} 个近似重复的片段"
+        return message
+
+    @staticmethod
+    def _is_changed(record, obj):
+        if obj.get('etag'):
+            return record.get('etag') != obj.get('etag') or record.get('size') != obj.get('size')
+        return record.get('size') != obj.get('size') or record.get('lastModified') != obj.get('last_modified')
+
+    def _list_files(self, objects, incremental, file_filter):
+        """
+        在后台线程中获取文件列表，需要导入的文件放到 pending_files 中。
+        增量同步时跳过未变化的文件，列举完成后删除已被移除的文件的数据，
+        只有同一个 bucket 中、在本次的根目录下并且符合本次的过滤条件的文件才会被当作已移除；
+        任务中断后重新执行（或者指定了之前的任务 id 重新提交）时，跳过已经导入完成的文件
+        """
+        collection_name = self.es_client.index_name_with_no_suffix
+        try:
+            records = self.file_table.get_oss_object_records(
+                self.team_id, collection_name, bucket=self.bucket, prefix=self.base_folder
+            ) if incremental or self.reindex_mode == 'diff' else {}
+            done_files = self.checkpoint_table.get_done_files(self.task_id)
+            new_count, unchanged_count = 0, 0
+            # 列举到的、还没有记录 bucket 的旧记录
+            legacy_keys = []
+            for obj in objects:
+                key = obj['key']
+                self.objects[key] = obj
+                if incremental:
+                    record = records.get(key)
+                    if record is None:
+                        new_count += 1
+                    elif self._is_changed(record, obj):
+                        self.changed_files.add(key)
+                    else:
+                        unchanged_count += 1
+                        if 'ossBucket' not in record:
+                            legacy_keys.append(key)
+                        continue
+                elif key in records:
+                    self.changed_files.add(key)
+                with self.lock:
+                    self.total += 1
+                    if key in done_files:
+                        self.skipped += 1
+                        self.processed += 1
+                        continue
+                if not self._put_pending_file(key):
+                    # 下游已经退出，文件列表不完整，不能据此删除已移除的文件
+                    return
+
+            message = f"共获取到 {len(self.objects)} 个文件"
+            if incremental:
+                if legacy_keys:
+                    for keys in chunk_list(legacy_keys, 1000):
+                        self.file_table.set_oss_object_records_bucket(
+                            self.team_id, collection_name, keys, self.bucket, self.base_folder
+                        )
+                # 没有记录 bucket 的旧记录无法确定属于哪个 bucket，不当作已移除
+                removed_files = [
+                    key for key, record in records.items()
+                    if key not in self.objects and record.get('ossBucket') == self.bucket and file_filter.match(key)
+                ]
+                if removed_files:
+                    deleted = self.es_client.delete_documents_by_source(
+                        [records[key]['fileUrl'] for key in removed_files]
+                    )
+                    self.file_table.delete_oss_object_records(
+                        self.team_id, collection_name, removed_files, bucket=self.bucket
+                    )
+                    print(f"增量同步：删除了 {len(removed_files)} 个已移除文件的 {deleted} 条数据")
+                message += f"，新增 {new_count} 个文件，变更 {len(self.changed_files)} 个文件，" \
+                           f"删除 {len(removed_files)} 个文件，{unchanged_count} 个文件未变化"
+            if self.skipped:
+                message += f"，其中 {self.skipped} 个文件已在之前导入完成，从断点处继续导入"
+            with self.lock:
+                self.listing_finished = True
+                self.progress_table.update_progress(task_id=self.task_id, progress=0.1, message=message)
+                self._report_progress()
+        except Exception as e:
+            traceback.print_exc()
+            self.listing_error = e
+        finally:
+            # 提前退出时关闭列举对象的生成器，结束其中的并发列举
+            close = getattr(objects, 'close', None)
+            if close:
+                close()
+            self._put_pending_file(_LISTING_END)
+
+    def _put_pending_file(self, key):
+        """
+        :return: 是否放入了队列，下游异常退出之后不再等待队列空位，返回 False
+        """
+        while not self.stopped.is_set():
+            try:
+                self.pending_files.put(key, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get_pending_file(self, block):
+        """
+        :param block: 是否等待，等待时每隔一段时间检查下游是否已经退出
+        :return: 文件 key，没有可用的文件时返回 None
+        """
+        while True:
+            try:
+                return self.pending_files.get(timeout=0.5) if block else self.pending_files.get_nowait()
+            except queue.Empty:
+                if not block or self.stopped.is_set():
+                    return None
+
+    def run(self, objects, incremental=False, base_folder=None, file_filter=None):
+        """
+        :param objects: OSS 对象的可迭代对象（可以是列举对象的生成器），每个元素包含 key、size、etag、last_modified
+        :param incremental: 是否为增量同步，增量同步时只导入新增和变更的文件，并删除已被移除的文件的数据
+        :param base_folder: 列举 objects 时的根目录
+        :param file_filter: 列举 objects 时使用的 FileFilter，增量同步时不符合过滤条件的文件不会被删除
+        """
+        self.base_folder = base_folder or ''
+        file_filter = file_filter or FileFilter()
+        listing_thread = threading.Thread(
+            target=self._list_files, args=(objects, incremental, file_filter), daemon=True
+        )
+        listing_thread.start()
+        try:
+            # 解析进程池在同一个进程的多次导入之间共用
+            parse_pool = get_parse_pool(OSS_IMPORT_PARSE_CONCURRENCY)
+            with ThreadPoolExecutor(OSS_IMPORT_DOWNLOAD_CONCURRENCY) as download_pool:
+                chunks = self._iter_chunks(download_pool, parse_pool)
+                documents = self._track_owners(self.es_client.embed_chunks(
+                    self.embedding_model, chunks, stats=self.embed_stats
+                ))
+                # 增量同步通常只修改少量文件，不切换整个索引的设置
+                with self.es_client.bulk_ingest_mode() if not incremental else nullcontext():
+                    self.es_client.upsert_documents_stream(documents, self._on_indexed, self._on_failed)
+        finally:
+            self.stopped.set()
+            listing_thread.join()
+            shutil.rmtree(self.download_folder, ignore_errors=True)
+
+        # 有失败的文件时保留断点记录，重新执行时只需要导入失败的文件，过期后由 TTL 索引删除
+        if self.failed == 0:
+            self.checkpoint_table.delete_task(self.task_id)
+        message = f"完成，共导入 {self.processed - self.failed}/{self.total} 个文件" if self.failed == 0 else f"完成，共导入 {self.processed - self.failed}/{self.total} 个文件，失败 {self.failed} 个文件"
+        self.progress_table.update_progress(task_id=self.task_id, progress=1.0, message=message + self._stats_message())
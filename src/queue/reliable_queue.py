@@ -0,0 +1,122 @@
+import hashlib
+import os
+import socket
+import threading
+import uuid
+
+# 原子地把任务从 processing 列表中移出，重新入队或者移入死信队列，返回任务的失败次数，任务已被其他消费者处理时返回 -1
+RETRY_OR_DEAD_LETTER_SCRIPT = """
+if redis.call('LREM', KEYS[1], 1, ARGV[1]) == 0 then
+    return -1
+end
+local attempts = redis.call('HINCRBY', KEYS[4], ARGV[2], 1)
+if attempts >= tonumber(ARGV[3]) then
+    redis.call('RPUSH', KEYS[3], ARGV[1])
+    redis.call('HDEL', KEYS[4], ARGV[2])
+else
+    redis.call('LPUSH', KEYS[2], ARGV[1])
+end
+return attempts
+"""
+
+
+class ReliableQueue:
+    """
+    基于 Redis 的可靠队列：
+    - 消费者通过 BLMOVE 把任务移动到自己的 processing 列表中，处理完成后 ack 才会删除
+    - 消费者通过心跳 key 表明自己存活，心跳过期后（进程崩溃、节点被回收）其 processing 列表中的任务会重新入队
+    - 同一个任务失败（或者所在的消费者崩溃）超过 max_attempts 次后移入死信队列
+    """
+
+    def __init__(self, redis_client, queue_name, visibility_timeout=60, max_attempts=3):
+        self.redis = redis_client
+        self.queue_name = queue_name
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.consumer_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.consumers_key = f"{queue_name}:consumers"
+        self.attempts_key = f"{queue_name}:attempts"
+        self.dead_letter_queue_name = f"{queue_name}:dead-letter"
+        self.processing_queue_name = self._processing_queue_name_of(self.consumer_id)
+        self.heartbeat_stopped = threading.Event()
+        self.retry_or_dead_letter_script = redis_client.register_script(RETRY_OR_DEAD_LETTER_SCRIPT)
+
+    def _processing_queue_name_of(self, consumer_id):
+        return f"{self.queue_name}:processing:{consumer_id}"
+
+    def _heartbeat_key_of(self, consumer_id):
+        return f"{self.queue_name}:heartbeat:{consumer_id}"
+
+    @staticmethod
+    def _payload_id(payload):
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        return hashlib.md5(payload).hexdigest()
+
+    def _beat(self):
+        self.redis.set(self._heartbeat_key_of(self.consumer_id), 1, ex=self.visibility_timeout)
+        # 心跳短暂中断时会被 requeue_expired 注销，恢复之后重新注册，崩溃时其 processing 列表才能被回收
+        self.redis.sadd(self.consumers_key, self.consumer_id)
+
+    def start_heartbeat(self):
+        self._beat()
+
+        def run():
+            while not self.heartbeat_stopped.wait(self.visibility_timeout / 3):
+                try:
+                    self._beat()
+                except Exception as e:
+                    print(f"发送队列心跳失败：{e}")
+
+        threading.Thread(target=run, daemon=True, name="reliable-queue-heartbeat").start()
+
+    def stop_heartbeat(self):
+        """
+        停止心跳并注销消费者，processing 列表中剩余的任务会立刻重新入队
+        """
+        self.heartbeat_stopped.set()
+        self.redis.delete(self._heartbeat_key_of(self.consumer_id))
+        self.requeue_expired()
+
+    def pop(self, timeout=5):
+        """
+        阻塞获取一个任务，超时返回 None
+        """
+        return self.redis.blmove(self.queue_name, self.processing_queue_name, timeout, 'LEFT', 'RIGHT')
+
+    def ack(self, payload):
+        self.redis.lrem(self.processing_queue_name, 1, payload)
+        self.redis.hdel(self.attempts_key, self._payload_id(payload))
+
+    def nack(self, payload, on_dead_letter=None):
+        """
+        任务处理失败，重新入队，超过重试次数则移入死信队列
+        """
+        self._retry_or_dead_letter(self.processing_queue_name, payload, on_dead_letter)
+
+    def _retry_or_dead_letter(self, processing_queue_name, payload, on_dead_letter=None):
+        # 失败的任务放到队头，尽快重新执行
+        attempts = self.retry_or_dead_letter_script(
+            keys=[processing_queue_name, self.queue_name, self.dead_letter_queue_name, self.attempts_key],
+            args=[payload, self._payload_id(payload), self.max_attempts]
+        )
+        if attempts >= self.max_attempts:
+            print(f"任务已失败 {attempts} 次，移入死信队列 {self.dead_letter_queue_name}")
+            if on_dead_letter:
+                on_dead_letter(payload)
+
+    def requeue_expired(self, on_dead_letter=None):
+        """
+        把心跳已过期的消费者正在处理的任务重新入队
+        """
+        for consumer_id in self.redis.smembers(self.consumers_key):
+            if isinstance(consumer_id, bytes):
+                consumer_id = consumer_id.decode('utf-8')
+            if self.redis.exists(self._heartbeat_key_of(consumer_id)):
+                continue
+            processing_queue_name = self._processing_queue_name_of(consumer_id)
+            for payload in self.redis.lrange(processing_queue_name, 0, -1):
+                print(f"消费者 {consumer_id} 心跳已过期，任务重新入队")
+                self._retry_or_dead_letter(processing_queue_name, payload, on_dead_letter)
+            if self.redis.llen(processing_queue_name) == 0:
+                self.redis.srem(self.consumers_key, consumer_id)
@@ -1,12 +1,19 @@
 import uuid
 import os
 from FlagEmbedding import FlagModel
+from transformers import AutoTokenizer
+from functools import lru_cache
 from random import choice
 from string import ascii_letters
 from shortid import ShortId
 import torch
-import re
 import hashlib
+import numpy as np
+from src.utils.embedding_batcher import EmbeddingBatcher
+from src.utils.embedding_cache import EmbeddingCache
+from src.utils.download_cache import DownloadCache
+from src.utils.model_registry import ModelRegistry
+from src.utils.text_pre_process import get_pre_processor
 
 try:
     import torch_npu
@@ -17,7 +24,22 @@ sid = ShortId()
 
 ROOT_FOLDER = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
 
-MODEL_CACHE = {}
+MODEL_GPU_MEMORY_BUDGET_MB = os.environ.get('MODEL_GPU_MEMORY_BUDGET_MB', '0')
+MODEL_GPU_MEMORY_BUDGET_MB = int(MODEL_GPU_MEMORY_BUDGET_MB)
+MODEL_CPU_MEMORY_BUDGET_MB = os.environ.get('MODEL_CPU_MEMORY_BUDGET_MB', '0')
+MODEL_CPU_MEMORY_BUDGET_MB = int(MODEL_CPU_MEMORY_BUDGET_MB)
+EMBEDDING_BATCH_MAX_SIZE = os.environ.get('EMBEDDING_BATCH_MAX_SIZE', '32')
+EMBEDDING_BATCH_MAX_SIZE = int(EMBEDDING_BATCH_MAX_SIZE)
+EMBEDDING_BATCH_MAX_WAIT_MS = os.environ.get('EMBEDDING_BATCH_MAX_WAIT_MS', '10')
+EMBEDDING_BATCH_MAX_WAIT_MS = float(EMBEDDING_BATCH_MAX_WAIT_MS)
+EMBEDDING_CACHE_ENABLED = os.environ.get('EMBEDDING_CACHE_ENABLED', 'true').lower() == 'true'
+EMBEDDING_CACHE_PATH = os.environ.get('EMBEDDING_CACHE_PATH', os.path.join(ROOT_FOLDER, 'cache/embeddings.sqlite3'))
+EMBEDDING_CACHE_MAX_MB = os.environ.get('EMBEDDING_CACHE_MAX_MB', '2048')
+EMBEDDING_CACHE_MAX_MB = int(EMBEDDING_CACHE_MAX_MB)
+DOWNLOAD_CACHE_ENABLED = os.environ.get('DOWNLOAD_CACHE_ENABLED', 'true').lower() == 'true'
+DOWNLOAD_CACHE_DIR = os.environ.get('DOWNLOAD_CACHE_DIR', os.path.join(ROOT_FOLDER, 'cache/downloads'))
+DOWNLOAD_CACHE_MAX_MB = os.environ.get('DOWNLOAD_CACHE_MAX_MB', '10240')
+DOWNLOAD_CACHE_MAX_MB = int(DOWNLOAD_CACHE_MAX_MB)
 
 def generate_pk():
     return str(uuid.uuid4())
@@ -35,24 +57,114 @@ def generate_md5(string: str):
     return hashlib.md5(string.encode('utf-8')).hexdigest()
 
 
+model_registry = ModelRegistry(
+    gpu_budget_bytes=MODEL_GPU_MEMORY_BUDGET_MB * 1024 * 1024,
+    cpu_budget_bytes=MODEL_CPU_MEMORY_BUDGET_MB * 1024 * 1024
+)
+
+
 def load_model(model_name):
-    if model_name in MODEL_CACHE:
-        return MODEL_CACHE[model_name]
+    def loader():
+        model_path = get_model_path_by_embedding_model(model_name)
+        return FlagModel(
+            model_path if os.path.exists(model_path) else model_name,
+            use_fp16=True
+        )
+
+    return model_registry.get(model_name, loader)
+
+@lru_cache(maxsize=None)
+def load_tokenizer(model_name):
+    """
+    只加载模型的 tokenizer，用于按 token 切分文本（解析进程中不需要加载模型本身）
+    """
     model_path = get_model_path_by_embedding_model(model_name)
-    model = FlagModel(
-        model_path if os.path.exists(model_path) else model_name,
-        use_fp16=True
-    )
-    MODEL_CACHE[model_name] = model
-    return model
+    return AutoTokenizer.from_pretrained(model_path if os.path.exists(model_path) else model_name)
 
-def generate_embedding_of_model(model_name, q):
+
+def count_tokens_of_model(model_name, texts):
+    """
+    批量计算文本的 token 数，不包含 [CLS] / [SEP] 等特殊 token
+    """
+    tokenizer = load_tokenizer(model_name)
+    return [len(input_ids) for input_ids in tokenizer(texts, add_special_tokens=False)['input_ids']]
+
+
+def encode_texts_of_model(model_name, texts):
+    """
+    FlagModel 按顺序划分 batch，每个 batch 会 padding 到其中最长的文本，
+    先按长度排序让长度相近的文本在同一个 batch 中，推理完成后再恢复原来的顺序
+    """
     model = load_model(model_name)
-    embeddings = model.encode(q)
+    order = np.argsort([-len(text) for text in texts], kind='stable')
+    sorted_embeddings = model.encode([texts[i] for i in order])
     torch.cuda.empty_cache()
+    embeddings = np.empty_like(sorted_embeddings)
+    embeddings[order] = sorted_embeddings
     return embeddings
 
 
+embedding_batcher = EmbeddingBatcher(
+    encode_texts_of_model,
+    max_batch_size=EMBEDDING_BATCH_MAX_SIZE,
+    max_wait_ms=EMBEDDING_BATCH_MAX_WAIT_MS
+)
+
+
+embedding_cache = EmbeddingCache(
+    EMBEDDING_CACHE_PATH,
+    max_bytes=EMBEDDING_CACHE_MAX_MB * 1024 * 1024
+) if EMBEDDING_CACHE_ENABLED else None
+
+
+download_cache = DownloadCache(
+    DOWNLOAD_CACHE_DIR,
+    max_bytes=DOWNLOAD_CACHE_MAX_MB * 1024 * 1024
+) if DOWNLOAD_CACHE_ENABLED else None
+
+
+def generate_embeddings_with_cache(model_name, texts):
+    if embedding_cache is None or len(texts) == 0:
+        return embedding_batcher.encode(model_name, texts)
+
+    text_hashes = [generate_md5(text) for text in texts]
+    cached = embedding_cache.get_many(model_name, text_hashes)
+    # 同一批里重复的文本也只需要推理一次
+    missed = {}
+    for text_hash, text in zip(text_hashes, texts):
+        if text_hash not in cached and text_hash not in missed:
+            missed[text_hash] = text
+    if missed:
+        missed_hashes = list(missed.keys())
+        missed_embeddings = embedding_batcher.encode(model_name, list(missed.values()))
+        embedding_cache.put_many(model_name, missed_hashes, missed_embeddings)
+        for text_hash, embedding in zip(missed_hashes, missed_embeddings):
+            cached[text_hash] = np.asarray(embedding, dtype=np.float32)
+    return np.stack([cached[text_hash] for text_hash in text_hashes])
+
+
+def normalize_embeddings(embeddings):
+    """
+    按 float32 重新归一化为单位长度：模型以 fp16 推理，归一化之后的长度误差可能超过 ES dot_product 允许的范围
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    return embeddings / np.maximum(norms, np.finfo(np.float32).tiny)
+
+
+def generate_embedding_of_model(model_name, q):
+    """
+    生成单位长度的向量，已经计算过的文本直接从 embedding_cache 中读取，
+    并发的小请求会通过 embedding_batcher 合并成一个 batch 推理
+    :param model_name: embedding 模型名称
+    :param q: 单条文本或者文本列表，单条文本时返回一维向量
+    :return:
+    """
+    if isinstance(q, str):
+        return normalize_embeddings(generate_embeddings_with_cache(model_name, [q]))[0]
+    return normalize_embeddings(generate_embeddings_with_cache(model_name, list(q)))
+
+
 SUPPORTED_EMBEDDING_MODELS = [
     {
         "name": "BAAI/bge-base-zh-v1.5",
@@ -112,36 +224,13 @@ def get_model_path_by_embedding_model(embedding_model):
     raise Exception(f"不支持的 embedding 模型：{embedding_model}")
 
 
-def replace_space_n_tab(text):
-    """
-    替换空格和制表符
-    :param text:
-    :return:
-    """
-    pattern = re.compile(r'\s+')  # 匹配任意空白字符，等价于 [\t\n\r\f\v]
-    text = re.sub(pattern, '', text)
-    return text
-
-
-def delete_url_email(text):
-    url_pattern = re.compile(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+')  # url
-    email_pattern = re.compile(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,7}\b')  # email
-    text = re.sub(url_pattern, '', text)
-    text = re.sub(email_pattern, '', text)
-    return text
-
-
 def txt_pre_process(txt, pre_process_rules):
     """
-    文本预处理
+    文本预处理，选中的规则编译成一个处理器，一次遍历完成所有替换，批量处理多页时使用 get_pre_processor(rules).process_batch
     :param txt:
     :return:
     """
-    if "replace-space-n-tab" in pre_process_rules:
-        txt = txt.replace('\n', '').replace('\t', '')
-    if "delete-url-and-email" in pre_process_rules:
-        txt = delete_url_email(txt)
-    return txt
+    return get_pre_processor(pre_process_rules).process(txt)
 
 
 def chunk_list(input_list, chunk_size):
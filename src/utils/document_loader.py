@@ -1,88 +1,492 @@
-from langchain.document_loaders import TextLoader, PyMuPDFLoader, CSVLoader, UnstructuredFileLoader, \
-    UnstructuredMarkdownLoader, \
-    JSONLoader
-from langchain.text_splitter import CharacterTextSplitter
+from langchain.document_loaders import UnstructuredFileLoader, UnstructuredMarkdownLoader
+from langchain.schema import Document
+import fitz
+import jq
+import csv
+import io
+import json
 import zipfile
 import os
-import uuid
-from pathlib import Path
-import shutil
+import tempfile
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+from itertools import islice
 
-from src.utils import txt_pre_process
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
+from src.utils import count_tokens_of_model
+from src.utils.text_pre_process import get_pre_processor, BATCH_RULES
+from src.utils.text_splitter import TextSplitter
 
-def load_single_document(file_path, jq_schema=None, pre_process_rules=[]):
-    file_ext = file_path.split('.')[-1]
-    if file_ext == 'pdf':
-        loader = PyMuPDFLoader(file_path=file_path)
-    elif file_ext == 'csv':
-        loader = CSVLoader(file_path=file_path)
-    elif file_ext == 'txt':
-        loader = TextLoader(file_path=file_path)
-    elif file_ext == 'md':
-        loader = UnstructuredMarkdownLoader(file_path=file_path)
-    elif file_ext == '.json':
-        loader = JSONLoader(file_path=file_path, jq_schema=jq_schema, text_content=False)
-    elif file_ext == '.jsonl':
-        loader = JSONLoader(file_path=file_path, json_lines=True, jq_schema=jq_schema, text_content=False)
+ZIP_FILE_EXTENSIONS = ('txt', 'md', 'pdf', 'json', 'jsonl')
+# 保存到片段 metadata 中的位置信息
+CHUNK_LOCATION_KEYS = ('page', 'start_index', 'end_index')
+# zip 中需要加载的文件数量和解压后的总大小限制
+ZIP_MAX_MEMBERS = os.environ.get('ZIP_MAX_MEMBERS', '10000')
+ZIP_MAX_MEMBERS = int(ZIP_MAX_MEMBERS)
+ZIP_MAX_UNCOMPRESSED_MB = os.environ.get('ZIP_MAX_UNCOMPRESSED_MB', '2048')
+ZIP_MAX_UNCOMPRESSED_MB = int(ZIP_MAX_UNCOMPRESSED_MB)
+ZIP_PARSE_CONCURRENCY = os.environ.get('ZIP_PARSE_CONCURRENCY', str(min(os.cpu_count() or 1, 4)))
+ZIP_PARSE_CONCURRENCY = int(ZIP_PARSE_CONCURRENCY)
+PRE_PROCESS_BATCH_SIZE = os.environ.get('PRE_PROCESS_BATCH_SIZE', '32')
+PRE_PROCESS_BATCH_SIZE = int(PRE_PROCESS_BATCH_SIZE)
+
+# 进程数 -> 解析进程池，同一个进程中的多次导入共用，不需要每次重新启动解析进程
+_parse_pools = {}
+_parse_pools_lock = threading.Lock()
+
+
+def get_parse_pool(max_workers):
+    """
+    获取共用的解析进程池。解析进程中不会用到 CUDA，使用 spawn 避免 fork 带来的 CUDA 和线程锁问题；
+    进程池因为子进程异常退出而不可用时重新创建
+    """
+    with _parse_pools_lock:
+        pool = _parse_pools.get(max_workers)
+        if pool is None or getattr(pool, '_broken', False):
+            if pool is not None:
+                pool.shutdown(wait=False, cancel_futures=True)
+            pool = ProcessPoolExecutor(max_workers, mp_context=multiprocessing.get_context('spawn'))
+            _parse_pools[max_workers] = pool
+        return pool
+
+
+# 注册的轻量 loader：file_type -> loader(fp, source, jq_schema)，fp 为二进制文件对象，按记录逐个返回 Document
+NATIVE_LOADERS = {}
+# 没有后缀的文件读取开头的内容判断类型
+SNIFF_SIZE = 1024
+
+
+def register_loader(*file_types):
+    def decorator(loader):
+        for file_type in file_types:
+            NATIVE_LOADERS[file_type] = loader
+        return loader
+
+    return decorator
+
+
+def detect_file_type(filename, head: bytes = None):
+    """
+    根据后缀判断文件类型，没有后缀时根据文件开头的内容判断
+    :param head: 文件开头的内容，不传时从 filename 中读取
+    """
+    basename = os.path.basename(filename)
+    if '.' in basename:
+        return basename.split('.')[-1].lower()
+    if head is None:
+        with open(filename, 'rb') as f:
+            head = f.read(SNIFF_SIZE)
+    if head.startswith(b'%PDF'):
+        return 'pdf'
+    if head.startswith(b'PK\x03\x04'):
+        return 'zip'
+    if head.lstrip()[:1] in (b'{', b'['):
+        return 'json'
+    try:
+        head.decode('utf-8')
+    except UnicodeDecodeError as e:
+        # 开头的内容可能截断在一个多字节字符的中间
+        if e.start < len(head) - 3:
+            return None
+    return 'txt'
+
+
+def json_loads(data):
+    return orjson.loads(data) if orjson else json.loads(data)
+
+
+def json_dumps(value):
+    return orjson.dumps(value).decode('utf-8') if orjson else json.dumps(value, ensure_ascii=False)
+
+
+@lru_cache(maxsize=32)
+def _compile_jq(jq_schema):
+    return jq.compile(jq_schema)
+
+
+def _json_sample_to_text(sample):
+    """
+    和 JSONLoader 的 text_content=False 相同：字符串直接使用，其他类型序列化为 JSON
+    """
+    if isinstance(sample, str):
+        return sample
+    if isinstance(sample, (dict, list)):
+        return json_dumps(sample) if sample else ""
+    return str(sample) if sample is not None else ""
+
+
+def _iter_json_records(values, source, jq_schema=None):
+    """
+    对每个 JSON 值执行 jq_schema，没有 jq_schema 时数组中的每个元素为一条记录
+    """
+    program = _compile_jq(jq_schema) if jq_schema else None
+    seq_num = 0
+    for value in values:
+        if program:
+            samples = program.input(value)
+        else:
+            samples = value if isinstance(value, list) else [value]
+        for sample in samples:
+            seq_num += 1
+            yield Document(page_content=_json_sample_to_text(sample), metadata={"source": source, "seq_num": seq_num})
+
+
+@register_loader('txt')
+def _load_txt(fp, source, jq_schema=None):
+    yield Document(page_content=fp.read().decode('utf-8'), metadata={"source": source})
+
+
+@register_loader('csv')
+def _load_csv(fp, source, jq_schema=None):
+    """
+    逐行读取 CSV，内容格式和 CSVLoader 保持一致
+    """
+    reader = csv.DictReader(io.TextIOWrapper(fp, encoding='utf-8', newline=''))
+    for i, row in enumerate(reader):
+        content = "\n".join(
+            f"{k.strip() if k is not None else k}: {v.strip() if isinstance(v, str) else v}"
+            for k, v in row.items()
+        )
+        yield Document(page_content=content, metadata={"source": source, "row": i})
+
+
+@register_loader('json')
+def _load_json(fp, source, jq_schema=None):
+    yield from _iter_json_records([json_loads(fp.read())], source, jq_schema)
+
+
+@register_loader('jsonl')
+def _load_jsonl(fp, source, jq_schema=None):
+    values = (json_loads(line) for line in fp if line.strip())
+    yield from _iter_json_records(values, source, jq_schema)
+
+
+def _lazy_load_pdf(pdf, source):
+    """
+    逐页读取 PDF，metadata 和 PyMuPDFLoader 保持一致
+    """
+    for page in pdf:
+        yield Document(page_content=page.get_text(), metadata={
+            "source": source,
+            "file_path": source,
+            "page": page.number,
+            "total_pages": len(pdf)
+        })
+
+
+def lazy_load_single_document(file_path, jq_schema=None, pre_process_rules=[]):
+    """
+    按页 / 行逐个返回文档，PDF、CSV 和 JSONL 不会一次性全部读到内存中。
+    txt、csv、json、jsonl 使用轻量的 loader，其他格式使用 Unstructured
+    """
+    file_type = detect_file_type(file_path)
+    if file_type == 'pdf':
+        with fitz.open(file_path) as pdf:
+            yield from _pre_process_documents(_lazy_load_pdf(pdf, file_path), pre_process_rules, paged=True)
+    elif file_type in NATIVE_LOADERS:
+        with open(file_path, 'rb') as fp:
+            documents = NATIVE_LOADERS[file_type](fp, file_path, jq_schema)
+            yield from _pre_process_documents(documents, pre_process_rules)
     else:
-        loader = UnstructuredFileLoader(file_path=file_path)
-    documents = loader.load()
+        if file_type == 'md':
+            loader = UnstructuredMarkdownLoader(file_path=file_path)
+        else:
+            loader = UnstructuredFileLoader(file_path=file_path)
+        try:
+            documents = loader.lazy_load()
+        except NotImplementedError:
+            documents = loader.load()
+        yield from _pre_process_documents(documents, pre_process_rules)
 
-    if len(pre_process_rules) > 0:
-        for doc in documents:
-            doc.page_content = txt_pre_process(doc.page_content, pre_process_rules)
 
-    return documents
+def _pre_process_documents(documents, pre_process_rules, paged=False):
+    """
+    按批（PRE_PROCESS_BATCH_SIZE 页）预处理，页眉页脚等规则需要同时看到多页的内容
+    :param paged: documents 是否为分页的页面（PDF），页眉页脚等多页规则只作用于页面，
+        CSV 的行、JSON 的记录开头都是相同的字段名，会被误判为页眉
+    """
+    if not paged:
+        pre_process_rules = [rule for rule in pre_process_rules if rule not in BATCH_RULES]
+    if len(pre_process_rules) == 0:
+        yield from documents
+        return
+    pre_processor = get_pre_processor(pre_process_rules)
+    documents = iter(documents)
+    while True:
+        batch = list(islice(documents, PRE_PROCESS_BATCH_SIZE))
+        if not batch:
+            break
+        texts = pre_processor.process_batch([doc.page_content for doc in batch])
+        for doc, text in zip(batch, texts):
+            doc.page_content = text
+            yield doc
 
 
-def load_documents(
+def load_single_document(file_path, jq_schema=None, pre_process_rules=[]):
+    return list(lazy_load_single_document(file_path, jq_schema=jq_schema, pre_process_rules=pre_process_rules))
+
+
+@lru_cache(maxsize=32)
+def _create_text_splitter(chunk_size=2048, chunk_overlap=0, separator='\n\n', tokenizer_model=None):
+    """
+    相同配置的 splitter 只创建一次，分隔符的正则只编译一次
+    :param tokenizer_model: 按这个 embedding 模型的 tokenizer 计算长度，为 None 时按字符计算
+    """
+    separator = separator.replace('\\n', '\n')
+    length_function = partial(count_tokens_of_model, tokenizer_model) if tokenizer_model else None
+    return TextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap, separator=separator,
+                        length_function=length_function)
+
+
+def _zip_member_type(zip_file, info):
+    """
+    和单独上传的文件一样使用 detect_file_type 判断类型，没有后缀时读取开头的内容判断
+    """
+    head = None
+    if '.' not in os.path.basename(info.filename):
+        with zip_file.open(info) as f:
+            head = f.read(SNIFF_SIZE)
+    return detect_file_type(info.filename, head)
+
+
+def _list_zip_members(zip_file):
+    """
+    列出 zip 中需要加载的文件，按类型（和原先 rglob 的顺序一致）和文件名排序，保证结果的顺序固定
+    """
+    members = []
+    for info in zip_file.infolist():
+        if info.is_dir() or "__MACOSX" in info.filename:
+            continue
+        file_type = _zip_member_type(zip_file, info)
+        if file_type not in ZIP_FILE_EXTENSIONS:
+            continue
+        members.append((ZIP_FILE_EXTENSIONS.index(file_type), info.filename, info))
+    members = [info for _, _, info in sorted(members, key=lambda member: member[:2])]
+
+    if len(members) > ZIP_MAX_MEMBERS:
+        raise Exception(f"zip 文件中的文件数量 {len(members)} 超过限制 {ZIP_MAX_MEMBERS}")
+    total_size = sum(info.file_size for info in members)
+    if total_size > ZIP_MAX_UNCOMPRESSED_MB * 1024 * 1024:
+        raise Exception(f"zip 文件解压后的大小 {total_size // 1024 // 1024}MB 超过限制 {ZIP_MAX_UNCOMPRESSED_MB}MB")
+    return members
+
+
+def _load_zip_member(data: bytes, filename, chunk_size, chunk_overlap, separator, pre_process_rules, jqSchema,
+                     tokenizer_model):
+    """
+    加载并切分 zip 中的一个文件，在子进程中执行
+    """
+    documents = lazy_load_single_document_from_buffer(data, filename, jq_schema=jqSchema,
+                                                      pre_process_rules=pre_process_rules)
+    if jqSchema:
+        return list(documents)
+    text_splitter = _create_text_splitter(chunk_size, chunk_overlap, separator, tokenizer_model)
+    return [chunk for doc in documents for chunk in text_splitter.split_documents([doc])]
+
+
+def iter_zip_documents(
+        zip_path_or_file,
+        chunk_size=2048,
+        chunk_overlap=0,
+        separator='\n\n',
+        pre_process_rules=[],
+        jqSchema=None,
+        tokenizer_model=None,
+        concurrency=ZIP_PARSE_CONCURRENCY
+):
+    """
+    不解压到磁盘，直接从 zip 中逐个读取文件，在进程池中并发解析，按 _list_zip_members 的顺序返回片段
+    :param zip_path_or_file: zip 文件路径或者文件对象
+    :param concurrency: 解析进程数，小于等于 1 时在当前进程中解析（例如已经在解析进程中）
+    """
+    args = (chunk_size, chunk_overlap, separator, pre_process_rules, jqSchema, tokenizer_model)
+    with zipfile.ZipFile(zip_path_or_file, 'r') as zip_file:
+        members = _list_zip_members(zip_file)
+        print(f"从 zip 文件中加载到 {len(members)} 个文件")
+        chunk_count = 0
+        if concurrency <= 1 or len(members) <= 1:
+            for info in members:
+                for chunk in _load_zip_member(zip_file.read(info), info.filename, *args):
+                    chunk_count += 1
+                    yield chunk
+        else:
+            pool = get_parse_pool(concurrency)
+            # 限制同时读到内存中的文件数量，按提交顺序取结果
+            in_flight = deque()
+            members = iter(members)
+            try:
+                while True:
+                    while len(in_flight) < concurrency * 2:
+                        info = next(members, None)
+                        if info is None:
+                            break
+                        in_flight.append(pool.submit(_load_zip_member, zip_file.read(info), info.filename, *args))
+                    if not in_flight:
+                        break
+                    for chunk in in_flight.popleft().result():
+                        chunk_count += 1
+                        yield chunk
+            finally:
+                # 进程池是共用的，提前退出时取消还没有开始的任务
+                for future in in_flight:
+                    future.cancel()
+        print(f"从 zip 文件中切割到 {chunk_count} 个片段")
+
+
+def iter_load_documents(
         file_path: str,
         chunk_size=2048,
         chunk_overlap=0,
         separator='\n\n',
         pre_process_rules=[],
-        jqSchema=None
+        jqSchema=None,
+        tokenizer_model=None,
+        zip_concurrency=ZIP_PARSE_CONCURRENCY
 ):
+    """
+    流式加载并切分文件，每读取一页 / 一行就切分并返回其中的片段，内存占用只和单页的大小有关。
+    生成器结束（或者被关闭）时删除文件。
+    :param tokenizer_model: 按这个 embedding 模型的 token 数计算 chunk_size 和 chunk_overlap，为 None 时按字符数计算
+    :param zip_concurrency: 并发解析 zip 中文件的进程数
+    """
     file_ext = file_path.split('.')[-1]
-    documents = []
-    if file_ext == 'zip':
-        extract_to = os.path.join(os.path.dirname(file_path), str(uuid.uuid4()))
-        with zipfile.ZipFile(file_path, 'r') as zip_ref:
-            zip_ref.extractall(extract_to)
-        txt_files = Path(extract_to).rglob('**/*.txt')
-        md_files = Path(extract_to).rglob('**/*.md')
-        pdf_files = Path(extract_to).rglob('**/*.pdf')
-        json_files = Path(extract_to).rglob('**/*.json')
-        jsonl_files = Path(extract_to).rglob('**/*.jsonl')
-        all_files = list(txt_files) + list(md_files) + list(pdf_files) + list(json_files) + list(jsonl_files)
-        valid_files = []
-        for file in all_files:
-            if "__MACOSX" not in str(file):
-                valid_files.append(str(file))
-        print("从 zip 文件中加载到以下文件：", valid_files)
-        for file in valid_files:
-            documents.extend(load_single_document(file, pre_process_rules=pre_process_rules,
-                                                  jq_schema=jqSchema
-                                                  ))
-        os.remove(file_path)
-        shutil.rmtree(extract_to)
-    else:
-        documents = load_single_document(file_path, pre_process_rules=pre_process_rules, jq_schema=jqSchema)
+    try:
+        if file_ext == 'zip':
+            yield from iter_zip_documents(file_path, chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+                                          separator=separator, pre_process_rules=pre_process_rules,
+                                          jqSchema=jqSchema, tokenizer_model=tokenizer_model,
+                                          concurrency=zip_concurrency)
+        else:
+            documents = lazy_load_single_document(file_path, pre_process_rules=pre_process_rules,
+                                                  jq_schema=jqSchema)
+            yield from iter_split_documents(documents, chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+                                            separator=separator, jqSchema=jqSchema, tokenizer_model=tokenizer_model)
+    finally:
         os.remove(file_path)
 
-    print(f"使用 Loader 加载到 {len(documents)} 个文本")
 
+def load_documents(
+        file_path: str,
+        chunk_size=2048,
+        chunk_overlap=0,
+        separator='\n\n',
+        pre_process_rules=[],
+        jqSchema=None,
+        tokenizer_model=None
+):
+    return list(iter_load_documents(file_path, chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+                                    separator=separator, pre_process_rules=pre_process_rules, jqSchema=jqSchema,
+                                    tokenizer_model=tokenizer_model))
+
+
+def iter_split_documents(documents, chunk_size=2048, chunk_overlap=0, separator='\n\n', jqSchema=None,
+                         tokenizer_model=None):
+    """
+    逐个文档切分，切分出的片段不会跨越文档，结果和一次性切分所有文档相同
+    """
+    document_count = 0
+    chunk_count = 0
     if jqSchema:
-        return documents
+        for doc in documents:
+            document_count += 1
+            chunk_count += 1
+            yield doc
     else:
-        separator = separator.replace('\\n', '\n')
-        text_splitter = CharacterTextSplitter(
-            separator=separator,
-            chunk_size=chunk_size,
-            chunk_overlap=chunk_overlap,
-            is_separator_regex=True
-        )
-        texts = text_splitter.split_documents(documents)
-        print(f"使用 CharacterTextSplitter 切割到 {len(texts)} 个片段")
-        return texts
+        text_splitter = _create_text_splitter(chunk_size, chunk_overlap, separator, tokenizer_model)
+        for doc in documents:
+            document_count += 1
+            for chunk in text_splitter.split_documents([doc]):
+                chunk_count += 1
+                yield chunk
+    print(f"使用 Loader 加载到 {document_count} 个文本，切割到 {chunk_count} 个片段")
+
+
+def split_documents(documents, chunk_size=2048, chunk_overlap=0, separator='\n\n', jqSchema=None,
+                    tokenizer_model=None):
+    return list(iter_split_documents(documents, chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+                                     separator=separator, jqSchema=jqSchema, tokenizer_model=tokenizer_model))
+
+
+def lazy_load_single_document_from_buffer(data: bytes, filename, jq_schema=None, pre_process_rules=[]):
+    """
+    从内存中加载文档，pdf 和注册的轻量 loader 直接解析，其他格式的 loader 只支持从文件读取，先写入临时文件
+    """
+    file_type = detect_file_type(filename, data[:SNIFF_SIZE])
+    if file_type == 'pdf':
+        with fitz.open(stream=data, filetype='pdf') as pdf:
+            yield from _pre_process_documents(_lazy_load_pdf(pdf, filename), pre_process_rules, paged=True)
+    elif file_type in NATIVE_LOADERS:
+        documents = NATIVE_LOADERS[file_type](io.BytesIO(data), filename, jq_schema)
+        yield from _pre_process_documents(documents, pre_process_rules)
+    else:
+        with tempfile.TemporaryDirectory() as folder:
+            file_path = os.path.join(folder, os.path.basename(filename))
+            with open(file_path, 'wb') as f:
+                f.write(data)
+            yield from lazy_load_single_document(file_path, jq_schema=jq_schema, pre_process_rules=pre_process_rules)
+
+
+def load_single_document_from_buffer(data: bytes, filename, jq_schema=None, pre_process_rules=[]):
+    return list(lazy_load_single_document_from_buffer(data, filename, jq_schema=jq_schema,
+                                                      pre_process_rules=pre_process_rules))
+
+
+def load_documents_from_buffer(
+        data: bytes,
+        filename,
+        chunk_size=2048,
+        chunk_overlap=0,
+        separator='\n\n',
+        pre_process_rules=[],
+        jqSchema=None,
+        tokenizer_model=None,
+        zip_concurrency=ZIP_PARSE_CONCURRENCY
+):
+    """
+    和 load_documents 相同，但是文件内容已经在内存中
+    """
+    if filename.split('.')[-1] == 'zip':
+        return list(iter_zip_documents(io.BytesIO(data), chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+                                       separator=separator, pre_process_rules=pre_process_rules, jqSchema=jqSchema,
+                                       tokenizer_model=tokenizer_model, concurrency=zip_concurrency))
+
+    documents = lazy_load_single_document_from_buffer(data, filename, pre_process_rules=pre_process_rules,
+                                                      jq_schema=jqSchema)
+    return split_documents(documents, chunk_size=chunk_size, chunk_overlap=chunk_overlap, separator=separator,
+                           jqSchema=jqSchema, tokenizer_model=tokenizer_model)
+
+def get_chunk_location(metadata):
+    """
+    片段在源文件中的位置：页码（PDF）以及在这一页 / 这条记录中的字符偏移
+    """
+    return {key: metadata[key] for key in CHUNK_LOCATION_KEYS if key in metadata}
+
+
+def load_document_chunks(file_path, chunk_size=2048, chunk_overlap=0, separator='\n\n', pre_process_rules=[],
+                         jqSchema=None, tokenizer_model=None):
+    """
+    加载并切分文件，返回 (文本内容, 位置) 的列表，用于在子进程中解析文件（返回值需要能被 pickle）。
+    已经在解析进程中，zip 中的文件不再使用进程池并发解析
+    """
+    texts = iter_load_documents(file_path, chunk_size=chunk_size, chunk_overlap=chunk_overlap, separator=separator,
+                                pre_process_rules=pre_process_rules, jqSchema=jqSchema,
+                                tokenizer_model=tokenizer_model, zip_concurrency=1)
+    return [(text.page_content, get_chunk_location(text.metadata)) for text in texts]
+
+
+def load_document_chunks_from_buffer(data: bytes, filename, chunk_size=2048, chunk_overlap=0, separator='\n\n',
+                                     pre_process_rules=[], jqSchema=None, tokenizer_model=None):
+    """
+    和 load_document_chunks 相同，但是文件内容已经在内存中
+    """
+    texts = load_documents_from_buffer(data, filename, chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+                                       separator=separator, pre_process_rules=pre_process_rules, jqSchema=jqSchema,
+                                       tokenizer_model=tokenizer_model, zip_concurrency=1)
+    return [(text.page_content, get_chunk_location(text.metadata)) for text in texts]
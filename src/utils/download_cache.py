@@ -0,0 +1,223 @@
+import hashlib
+import mimetypes
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit, urlunsplit
+
+import requests
+
+
+# 下载文件时建立连接和读取数据（两次读取之间）的超时秒数
+DOWNLOAD_CONNECT_TIMEOUT = os.environ.get('DOWNLOAD_CONNECT_TIMEOUT', '10')
+DOWNLOAD_CONNECT_TIMEOUT = float(DOWNLOAD_CONNECT_TIMEOUT)
+DOWNLOAD_READ_TIMEOUT = os.environ.get('DOWNLOAD_READ_TIMEOUT', '60')
+DOWNLOAD_READ_TIMEOUT = float(DOWNLOAD_READ_TIMEOUT)
+
+_CONTENT_DISPOSITION_FILENAME = re.compile(r'filename\*?=(?:UTF-8\'\')?"?([^";]+)"?', re.IGNORECASE)
+
+
+def _file_ext_of(name):
+    """
+    :return: 路径最后一段的后缀（包含 .），没有后缀时返回空字符串
+    """
+    last_segment = name.split('?')[0].split('/')[-1]
+    if '.' not in last_segment:
+        return ''
+    return '.' + last_segment.split('.')[-1]
+
+
+def _sniff_file_ext(response):
+    """
+    链接中没有后缀时，根据 Content-Disposition 中的文件名或者 Content-Type 判断文件后缀
+    """
+    match = _CONTENT_DISPOSITION_FILENAME.search(response.headers.get('Content-Disposition', ''))
+    if match and _file_ext_of(match.group(1)):
+        return _file_ext_of(match.group(1))
+    content_type = response.headers.get('Content-Type', '').split(';')[0].strip()
+    return (mimetypes.guess_extension(content_type) or '') if content_type else ''
+
+
+class DownloadCache:
+    """
+    下载文件的本地缓存，key 为文件链接（去掉查询参数，签名链接每次都不同）或者 OSS 对象地址，
+    通过 ETag / Last-Modified 判断缓存是否有效，总大小超过 max_bytes 时按最近访问时间淘汰。
+
+    缓存中的文件不会直接交给调用方，而是硬链接（或复制）到调用方指定的目录下，
+    调用方可以随意删除，并发的任务之间也不会互相覆盖。
+    """
+
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = None
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self.lock = threading.Lock()
+        self.conn = None
+
+    def _get_conn(self):
+        if self.conn is None:
+            os.makedirs(self.folder, exist_ok=True)
+            conn = sqlite3.connect(os.path.join(self.folder, 'index.sqlite3'), timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "cache_key TEXT PRIMARY KEY, "
+                "etag TEXT, "
+                "last_modified TEXT, "
+                "filename TEXT NOT NULL, "
+                "size INTEGER NOT NULL, "
+                "last_access REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_files_last_access ON files (last_access)")
+            conn.commit()
+            self.conn = conn
+        return self.conn
+
+    @staticmethod
+    def _cache_key_of_url(url):
+        parts = urlsplit(url)
+        return urlunsplit((parts.scheme, parts.netloc, parts.path, '', ''))
+
+    def _lookup(self, cache_key):
+        with self.lock:
+            return self._get_conn().execute(
+                "SELECT etag, last_modified, filename FROM files WHERE cache_key = ?", (cache_key,)
+            ).fetchone()
+
+    def _link_to(self, filename, target_folder):
+        """
+        把缓存文件链接到 target_folder 下，文件已被淘汰时返回 None
+        """
+        os.makedirs(target_folder, exist_ok=True)
+        target_path = os.path.join(target_folder, f"{uuid.uuid4()}{_file_ext_of(filename)}")
+        source_path = os.path.join(self.folder, filename)
+        try:
+            try:
+                os.link(source_path, target_path)
+            except OSError:
+                shutil.copyfile(source_path, target_path)
+        except FileNotFoundError:
+            return None
+        return target_path
+
+    def _touch(self, cache_key):
+        with self.lock:
+            conn = self._get_conn()
+            conn.execute("UPDATE files SET last_access = ? WHERE cache_key = ?", (time.time(), cache_key))
+            conn.commit()
+
+    def _remove(self, cache_key):
+        with self.lock:
+            conn = self._get_conn()
+            conn.execute("DELETE FROM files WHERE cache_key = ?", (cache_key,))
+            conn.commit()
+
+    def get(self, cache_key, etag, target_folder):
+        """
+        缓存命中且 etag 一致时，返回链接到 target_folder 中的文件路径，否则返回 None
+        """
+        row = self._lookup(cache_key)
+        if row is None or not etag or row[0] != etag:
+            return None
+        target_path = self._link_to(row[2], target_folder)
+        if target_path:
+            self._touch(cache_key)
+        return target_path
+
+    def put(self, cache_key, data_or_path, etag=None, last_modified=None):
+        """
+        写入缓存
+        :param data_or_path: 文件内容（bytes）或者本地文件路径，文件会被硬链接（或复制）到缓存目录中
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        # 本地文件的后缀可能是下载时根据响应头判断的，优先使用
+        file_ext = _file_ext_of(cache_key) if isinstance(data_or_path, bytes) else \
+            _file_ext_of(data_or_path) or _file_ext_of(cache_key)
+        filename = f"{hashlib.md5(cache_key.encode('utf-8')).hexdigest()}{file_ext}"
+        tmp_path = os.path.join(self.folder, f"{uuid.uuid4()}.tmp")
+        if isinstance(data_or_path, bytes):
+            with open(tmp_path, 'wb') as f:
+                f.write(data_or_path)
+        else:
+            try:
+                os.link(data_or_path, tmp_path)
+            except OSError:
+                shutil.copyfile(data_or_path, tmp_path)
+        size = os.path.getsize(tmp_path)
+        # rename 是原子的，其他进程不会读到写了一半的文件
+        os.replace(tmp_path, os.path.join(self.folder, filename))
+        with self.lock:
+            conn = self._get_conn()
+            conn.execute(
+                "INSERT OR REPLACE INTO files (cache_key, etag, last_modified, filename, size, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (cache_key, etag, last_modified, filename, size, time.time())
+            )
+            conn.commit()
+            self._evict()
+
+    def _evict(self):
+        conn = self.conn
+        total_bytes = conn.execute("SELECT COALESCE(SUM(size), 0) FROM files").fetchone()[0]
+        if total_bytes <= self.max_bytes:
+            return
+        rows = conn.execute("SELECT cache_key, filename, size FROM files ORDER BY last_access").fetchall()
+        for cache_key, filename, size in rows:
+            if total_bytes <= self.max_bytes:
+                break
+            conn.execute("DELETE FROM files WHERE cache_key = ?", (cache_key,))
+            try:
+                os.remove(os.path.join(self.folder, filename))
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+        conn.commit()
+
+    def download_url(self, url, target_folder):
+        """
+        下载文件到 target_folder，已缓存时使用条件请求（If-None-Match / If-Modified-Since）校验，未变化则直接使用缓存
+        :return: 文件路径
+        """
+        cache_key = self._cache_key_of_url(url)
+        row = self._lookup(cache_key)
+        headers = {}
+        if row is not None:
+            etag, last_modified, _ = row
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+
+        with requests.get(
+                url, headers=headers, stream=True, timeout=(DOWNLOAD_CONNECT_TIMEOUT, DOWNLOAD_READ_TIMEOUT)
+        ) as response:
+            if response.status_code == 304:
+                target_path = self._link_to(row[2], target_folder)
+                if target_path:
+                    self._touch(cache_key)
+                    return target_path
+                # 缓存文件已被其他进程淘汰，删除索引后重新下载
+                self._remove(cache_key)
+                return self.download_url(url, target_folder)
+            response.raise_for_status()
+            os.makedirs(target_folder, exist_ok=True)
+            file_ext = _file_ext_of(url) or _sniff_file_ext(response)
+            target_path = os.path.join(target_folder, f"{uuid.uuid4()}{file_ext}")
+            with open(target_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=1024 * 1024):
+                    f.write(chunk)
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+
+        # 没有 ETag / Last-Modified 的文件无法校验，不缓存
+        if etag or last_modified:
+            self.put(cache_key, target_path, etag=etag, last_modified=last_modified)
+        return target_path
@@ -0,0 +1,110 @@
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+
+class _EmbeddingRequest:
+    def __init__(self, texts):
+        self.texts = texts
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class EmbeddingBatcher:
+    """
+    跨请求的动态微批处理：同一个模型在短时间内收到的多个 encode 请求会被合并成一个 batch 做一次推理，
+    推理完成后再按请求切分结果返回给各个调用方。
+
+    每个模型有一个独立的队列和一个后台线程，同一个模型的推理因此也是串行的。
+    """
+
+    def __init__(self, encode_fn, max_batch_size=32, max_wait_ms=10):
+        """
+        :param encode_fn: encode_fn(model_name, texts)，返回二维的向量数组
+        :param max_batch_size: 一个 batch 最多合并的文本数
+        :param max_wait_ms: 收到第一个请求之后最多等待多久来凑 batch，为 0 时只合并已经在排队的请求
+        """
+        self.encode_fn = encode_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.lock = threading.Lock()
+        self.queues = {}
+        # fork 出来的子进程里没有这些后台线程，需要重新创建
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self.lock = threading.Lock()
+        self.queues = {}
+
+    def encode(self, model_name, texts):
+        if len(texts) == 0:
+            return np.empty((0, 0), dtype=np.float32)
+        # 大请求按 max_batch_size 切分之后同样交给后台线程，保证同一个模型的推理是串行的
+        requests = [
+            _EmbeddingRequest(texts[i: i + self.max_batch_size]) for i in range(0, len(texts), self.max_batch_size)
+        ]
+        q = self._get_queue(model_name)
+        for request in requests:
+            q.put(request)
+        for request in requests:
+            request.done.wait()
+        for request in requests:
+            if request.error is not None:
+                raise request.error
+        if len(requests) == 1:
+            return requests[0].result
+        return np.concatenate([request.result for request in requests])
+
+    def _get_queue(self, model_name):
+        with self.lock:
+            q = self.queues.get(model_name)
+            if q is None:
+                q = queue.Queue()
+                self.queues[model_name] = q
+                threading.Thread(
+                    target=self._run, args=(model_name, q), daemon=True,
+                    name=f"embedding-batcher-{model_name}"
+                ).start()
+            return q
+
+    def _collect_batch(self, q, carry=None):
+        """
+        :param carry: 上一个 batch 放不下、留到这个 batch 的请求
+        :return: (batch, 这个 batch 放不下的请求)，batch 中的文本数不超过 max_batch_size（单个请求超过时除外）
+        """
+        batch = [carry if carry is not None else q.get()]
+        size = len(batch[0].texts)
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            try:
+                remaining = deadline - time.monotonic()
+                request = q.get(timeout=remaining) if remaining > 0 else q.get_nowait()
+            except queue.Empty:
+                break
+            if size + len(request.texts) > self.max_batch_size:
+                return batch, request
+            batch.append(request)
+            size += len(request.texts)
+        return batch, None
+
+    def _run(self, model_name, q):
+        carry = None
+        while True:
+            batch, carry = self._collect_batch(q, carry)
+            texts = [text for request in batch for text in request.texts]
+            try:
+                embeddings = self.encode_fn(model_name, texts)
+                offset = 0
+                for request in batch:
+                    request.result = embeddings[offset: offset + len(request.texts)]
+                    offset += len(request.texts)
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            finally:
+                for request in batch:
+                    request.done.set()
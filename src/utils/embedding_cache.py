@@ -0,0 +1,145 @@
+import atexit
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+# 命中缓存时只在内存中记录访问时间，每隔这么多秒（或者积累了足够多的记录时）再批量写入，
+# 避免每次查询都进行一次同步的磁盘写入
+ACCESS_FLUSH_INTERVAL = 60
+ACCESS_FLUSH_MAX_PENDING = 10000
+
+class EmbeddingCache:
+    """
+    基于 SQLite 的持久化向量缓存，key 为 (模型名称, 文本 md5)，向量按 float32 存储。
+    缓存总大小超过 max_bytes 时按最近访问时间淘汰（LRU）。
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = None
+        self.total_bytes = 0
+        # (模型名称, 文本 md5) -> 最近一次访问时间，还未写入 SQLite
+        self.pending_access = {}
+        self.last_flush = time.time()
+        os.register_at_fork(after_in_child=self._reset)
+        atexit.register(self.flush)
+
+    def _reset(self):
+        # sqlite 连接不能跨进程使用，fork 之后重新打开
+        self.lock = threading.Lock()
+        self.conn = None
+        self.pending_access = {}
+
+    def _get_conn(self):
+        if self.conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "model TEXT NOT NULL, "
+                "text_hash TEXT NOT NULL, "
+                "vector BLOB NOT NULL, "
+                "size INTEGER NOT NULL, "
+                "last_access REAL NOT NULL, "
+                "PRIMARY KEY (model, text_hash))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_access ON embeddings (last_access)")
+            conn.commit()
+            self.conn = conn
+            self.total_bytes = self._sum_bytes()
+        return self.conn
+
+    def _sum_bytes(self):
+        return self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+
+    def get_many(self, model_name, text_hashes):
+        """
+        :return: dict，text_hash -> 向量，未命中的不在结果中
+        """
+        result = {}
+        if len(text_hashes) == 0:
+            return result
+        unique_hashes = list(set(text_hashes))
+        with self.lock:
+            conn = self._get_conn()
+            # SQLite 单条语句的参数个数有限制
+            for i in range(0, len(unique_hashes), 500):
+                part = unique_hashes[i: i + 500]
+                placeholders = ','.join('?' * len(part))
+                rows = conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                    [model_name] + part
+                ).fetchall()
+                for text_hash, vector in rows:
+                    result[text_hash] = np.frombuffer(vector, dtype=np.float32)
+            now = time.time()
+            for text_hash in result:
+                self.pending_access[(model_name, text_hash)] = now
+            if now - self.last_flush >= ACCESS_FLUSH_INTERVAL or len(self.pending_access) >= ACCESS_FLUSH_MAX_PENDING:
+                self._flush_access()
+        return result
+
+    def _flush_access(self):
+        """
+        把内存中记录的访问时间批量写入 SQLite，调用前需要持有 self.lock
+        """
+        self.last_flush = time.time()
+        if not self.pending_access:
+            return
+        self._get_conn().executemany(
+            "UPDATE embeddings SET last_access = MAX(last_access, ?) WHERE model = ? AND text_hash = ?",
+            [(last_access, model_name, text_hash) for (model_name, text_hash), last_access in self.pending_access.items()]
+        )
+        self.conn.commit()
+        self.pending_access = {}
+
+    def flush(self):
+        with self.lock:
+            self._flush_access()
+
+    def put_many(self, model_name, text_hashes, embeddings):
+        if len(text_hashes) == 0:
+            return
+        now = time.time()
+        rows = []
+        for text_hash, embedding in zip(text_hashes, embeddings):
+            vector = np.asarray(embedding, dtype=np.float32).tobytes()
+            rows.append((model_name, text_hash, vector, len(vector), now))
+        with self.lock:
+            conn = self._get_conn()
+            conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, vector, size, last_access) VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+            conn.commit()
+            self.total_bytes += sum(row[3] for row in rows)
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # 其他进程也会写同一个文件，淘汰前先重新统计一次
+        self.total_bytes = self._sum_bytes()
+        if self.total_bytes <= self.max_bytes:
+            return
+        # 按最近访问时间淘汰之前先写入内存中的访问记录
+        self._flush_access()
+        count, = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        if count == 0:
+            return
+        # 一次多淘汰 10%，避免每次写入都触发淘汰
+        target_bytes = self.max_bytes * 0.9
+        avg_size = self.total_bytes / count
+        evict_count = int((self.total_bytes - target_bytes) / avg_size) + 1
+        self.conn.execute(
+            "DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings ORDER BY last_access LIMIT ?)",
+            (evict_count,)
+        )
+        self.conn.commit()
+        self.total_bytes = self._sum_bytes()
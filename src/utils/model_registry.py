@@ -0,0 +1,130 @@
+import gc
+import threading
+import time
+from collections import OrderedDict
+
+import torch
+
+
+def estimate_model_memory(model):
+    """
+    估算模型占用的内存（参数 + buffer），FlagModel / FlagReranker 的 torch 模型挂在 .model 上
+    :return: (字节数, 设备类型)
+    """
+    module = getattr(model, 'model', model)
+    if not isinstance(module, torch.nn.Module):
+        return 0, 'cpu'
+    size = 0
+    device_type = 'cpu'
+    for tensor in list(module.parameters()) + list(module.buffers()):
+        size += tensor.numel() * tensor.element_size()
+        device_type = tensor.device.type
+    return size, device_type
+
+
+class ModelRegistry:
+    """
+    按内存预算管理已加载的模型，超出预算时淘汰最久未使用的模型。
+    cpu 上的模型使用 cpu 预算，cuda / npu 等加速设备上的模型使用 gpu 预算，预算为 0 表示不限制。
+    """
+
+    def __init__(self, gpu_budget_bytes=0, cpu_budget_bytes=0):
+        self.gpu_budget_bytes = gpu_budget_bytes
+        self.cpu_budget_bytes = cpu_budget_bytes
+        self.lock = threading.Lock()
+        self.load_locks = {}
+        self.models = OrderedDict()
+        # 记住每个模型上一次加载时的大小，再次加载之前可以提前腾出空间
+        self.known_sizes = {}
+
+    def _budget_of(self, device_type):
+        return self.cpu_budget_bytes if device_type == 'cpu' else self.gpu_budget_bytes
+
+    def _used_bytes(self, device_type):
+        return sum(
+            entry['size'] for entry in self.models.values()
+            if (entry['device'] == 'cpu') == (device_type == 'cpu')
+        )
+
+    def _evict_until_fits(self, device_type, incoming_bytes, keep=None):
+        budget = self._budget_of(device_type)
+        if not budget:
+            return
+        for name in list(self.models.keys()):
+            if self._used_bytes(device_type) + incoming_bytes <= budget:
+                break
+            entry = self.models[name]
+            if name == keep or (entry['device'] == 'cpu') != (device_type == 'cpu'):
+                continue
+            print(f"模型内存超出预算，卸载模型：{name}")
+            del self.models[name]
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def get(self, name, loader):
+        """
+        获取模型，未加载时调用 loader() 加载
+        :param name: 模型名称，作为缓存的 key
+        :param loader: 加载模型的函数
+        :return:
+        """
+        with self.lock:
+            if name in self.models:
+                self.models.move_to_end(name)
+                self.models[name]['last_used_at'] = time.time()
+                return self.models[name]['model']
+            load_lock = self.load_locks.setdefault(name, threading.Lock())
+
+        # 同一个模型只加载一次，不同模型的加载互不阻塞
+        with load_lock:
+            with self.lock:
+                if name in self.models:
+                    self.models.move_to_end(name)
+                    return self.models[name]['model']
+                if name in self.known_sizes:
+                    size, device_type = self.known_sizes[name]
+                    self._evict_until_fits(device_type, size)
+
+            model = loader()
+            size, device_type = estimate_model_memory(model)
+            with self.lock:
+                self.known_sizes[name] = (size, device_type)
+                self.models[name] = {
+                    "model": model,
+                    "size": size,
+                    "device": device_type,
+                    "loaded_at": time.time(),
+                    "last_used_at": time.time(),
+                }
+                self._evict_until_fits(device_type, 0, keep=name)
+            return model
+
+    def unload(self, name):
+        with self.lock:
+            self.models.pop(name, None)
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def describe(self):
+        """
+        返回当前已加载的模型，按最近使用时间倒序
+        """
+        with self.lock:
+            loaded = [
+                {
+                    "name": name,
+                    "device": entry['device'],
+                    "memoryMB": round(entry['size'] / 1024 / 1024, 2),
+                    "loadedAt": int(entry['loaded_at']),
+                    "lastUsedAt": int(entry['last_used_at']),
+                } for name, entry in reversed(self.models.items())
+            ]
+            return {
+                "models": loaded,
+                "gpuBudgetMB": round(self.gpu_budget_bytes / 1024 / 1024, 2),
+                "cpuBudgetMB": round(self.cpu_budget_bytes / 1024 / 1024, 2),
+                "gpuUsedMB": round(self._used_bytes('cuda') / 1024 / 1024, 2),
+                "cpuUsedMB": round(self._used_bytes('cpu') / 1024 / 1024, 2),
+            }
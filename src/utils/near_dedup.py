@@ -0,0 +1,120 @@
+import os
+import re
+
+import numpy as np
+
+NEAR_DEDUP_NUM_PERM = os.environ.get('NEAR_DEDUP_NUM_PERM', '128')
+NEAR_DEDUP_NUM_PERM = int(NEAR_DEDUP_NUM_PERM)
+# 按字符切分 shingle，中文没有空格分词
+NEAR_DEDUP_SHINGLE_SIZE = os.environ.get('NEAR_DEDUP_SHINGLE_SIZE', '5')
+NEAR_DEDUP_SHINGLE_SIZE = int(NEAR_DEDUP_SHINGLE_SIZE)
+
+# 去重只在一次导入的范围内进行，不会和索引中已有的片段比较：
+# file 只在同一个文件内去重；task 在一次 OSS 导入任务的所有文件之间去重（单个文件导入时和 file 相同）
+NEAR_DEDUP_SCOPES = ('file', 'task')
+
+_HASH_SHIFT = np.uint64(32)
+_UINT32_MAX = np.iinfo(np.uint32).max
+_SHINGLE_BASE = np.uint64(1000003)
+_WHITESPACE_PATTERN = re.compile(r'\s+')
+
+
+def _integrate(f, a, b, steps=100):
+    xs = np.linspace(a, b, steps + 1)
+    ys = f(xs)
+    return float(np.sum((ys[1:] + ys[:-1]) / 2) * (b - a) / steps)
+
+
+def _optimal_bands(threshold, num_perm):
+    """
+    选择 LSH 的 band 数和每个 band 的行数，使误判（相似度低于阈值却成为候选）和漏判（相似度高于阈值却没有成为候选）
+    的概率之和最小
+    """
+    best, best_error = None, None
+    for bands in range(1, num_perm + 1):
+        for rows in range(1, num_perm // bands + 1):
+            false_positive = _integrate(lambda s: 1 - (1 - s ** rows) ** bands, 0.0, threshold)
+            false_negative = _integrate(lambda s: (1 - s ** rows) ** bands, threshold, 1.0)
+            error = false_positive + false_negative
+            if best_error is None or error < best_error:
+                best, best_error = (bands, rows), error
+    return best
+
+
+class MinHasher:
+    """
+    文本的 MinHash 签名：字符 shingle 的哈希经过 num_perm 个随机的线性哈希后取最小值
+    """
+
+    def __init__(self, num_perm=NEAR_DEDUP_NUM_PERM, shingle_size=NEAR_DEDUP_SHINGLE_SIZE, seed=1):
+        self.shingle_size = shingle_size
+        random_state = np.random.RandomState(seed)
+        # (a * x + b) mod 2^32，a 为奇数，全部使用 uint32 原地计算，减少临时数组的内存带宽
+        self.a = random_state.randint(0, _UINT32_MAX, num_perm, dtype=np.uint32) | np.uint32(1)
+        self.b = random_state.randint(0, _UINT32_MAX, num_perm, dtype=np.uint32)
+
+    def signature(self, text):
+        text = _WHITESPACE_PATTERN.sub(' ', text.lower()).strip()
+        codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+        # 所有 shingle 的多项式哈希（按 2^64 取模）一次向量化算出，去重后再做 num_perm 次线性哈希
+        count = max(1, len(codes) - self.shingle_size + 1)
+        hashes = np.zeros(count, dtype=np.uint64)
+        for offset in range(min(self.shingle_size, len(codes))):
+            hashes = hashes * _SHINGLE_BASE + codes[offset:offset + count]
+        hashes = np.unique((hashes ^ (hashes >> _HASH_SHIFT)).astype(np.uint32))
+        permuted = np.multiply(hashes[:, None], self.a)
+        np.add(permuted, self.b, out=permuted)
+        return permuted.min(axis=0)
+
+
+class NearDuplicateFilter:
+    """
+    基于 MinHash + LSH 的近似重复过滤：签名按 band 分桶，同一个桶中的片段为候选，
+    再用签名估计 Jaccard 相似度，达到 threshold 的片段视为重复
+    """
+
+    def __init__(self, threshold=0.9, num_perm=NEAR_DEDUP_NUM_PERM, shingle_size=NEAR_DEDUP_SHINGLE_SIZE):
+        self.threshold = threshold
+        self.hasher = MinHasher(num_perm=num_perm, shingle_size=shingle_size)
+        self.bands, self.rows = _optimal_bands(threshold, num_perm)
+        self.dropped = 0
+        self.reset()
+
+    def reset(self):
+        """
+        清空已经见过的片段（不清空 dropped 计数）
+        """
+        self.buckets = [{} for _ in range(self.bands)]
+        self.signatures = []
+
+    def is_duplicate(self, text):
+        """
+        判断是否和之前见过的片段重复，不重复时加入索引
+        """
+        signature = self.hasher.signature(text)
+        band_keys = [signature[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+        checked = set()
+        for bucket, band_key in zip(self.buckets, band_keys):
+            for index in bucket.get(band_key, ()):
+                if index in checked:
+                    continue
+                checked.add(index)
+                if np.mean(self.signatures[index] == signature) >= self.threshold:
+                    self.dropped += 1
+                    return True
+
+        index = len(self.signatures)
+        self.signatures.append(signature)
+        for bucket, band_key in zip(self.buckets, band_keys):
+            bucket.setdefault(band_key, []).append(index)
+        return False
+
+
+def create_near_duplicate_filter(config):
+    """
+    :param config: {"threshold": 0.9, "scope": "file" | "task"}，为空时不过滤，scope 见 NEAR_DEDUP_SCOPES
+    :return: (NearDuplicateFilter 或者 None, scope)
+    """
+    if not config:
+        return None, None
+    return NearDuplicateFilter(threshold=config.get('threshold', 0.9)), config.get('scope', 'file')
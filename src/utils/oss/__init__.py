@@ -0,0 +1,113 @@
+import os
+import re
+import shutil
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+OSS_LIST_CONCURRENCY = os.environ.get('OSS_LIST_CONCURRENCY', '8')
+OSS_LIST_CONCURRENCY = int(OSS_LIST_CONCURRENCY)
+# 不超过这个大小的对象直接读到内存中，不落盘
+OSS_DOWNLOAD_MEMORY_THRESHOLD_MB = os.environ.get('OSS_DOWNLOAD_MEMORY_THRESHOLD_MB', '8')
+OSS_DOWNLOAD_MEMORY_THRESHOLD_MB = int(OSS_DOWNLOAD_MEMORY_THRESHOLD_MB)
+# 超过这个大小的对象使用多个并发的范围请求下载
+OSS_DOWNLOAD_RANGE_THRESHOLD_MB = os.environ.get('OSS_DOWNLOAD_RANGE_THRESHOLD_MB', '64')
+OSS_DOWNLOAD_RANGE_THRESHOLD_MB = int(OSS_DOWNLOAD_RANGE_THRESHOLD_MB)
+OSS_DOWNLOAD_PART_SIZE_MB = os.environ.get('OSS_DOWNLOAD_PART_SIZE_MB', '16')
+OSS_DOWNLOAD_PART_SIZE_MB = int(OSS_DOWNLOAD_PART_SIZE_MB)
+OSS_DOWNLOAD_RANGE_CONCURRENCY = os.environ.get('OSS_DOWNLOAD_RANGE_CONCURRENCY', '4')
+OSS_DOWNLOAD_RANGE_CONCURRENCY = int(OSS_DOWNLOAD_RANGE_CONCURRENCY)
+
+_READ_BLOCK_SIZE = 1024 * 1024
+
+
+class FileFilter:
+    """
+    按文件后缀和排除规则过滤 OSS 对象，后缀和正则只在创建时处理一次
+    """
+
+    def __init__(self, fileExtensions=None, excludeFileRegex=None):
+        if isinstance(fileExtensions, str):
+            fileExtensions = fileExtensions.split(',')
+        extensions = [extension.strip() for extension in fileExtensions or [] if extension.strip()]
+        self.extensions = tuple(extensions) if extensions else None
+        self.exclude_pattern = re.compile(excludeFileRegex) if excludeFileRegex else None
+
+    def match(self, file):
+        # 如果后缀不在合法的后缀中，不符合
+        if self.extensions and not file.endswith(self.extensions):
+            return False
+        if self.exclude_pattern and self.exclude_pattern.search(file):
+            return False
+        return True
+
+
+def iter_objects_concurrently(list_page, prefix, concurrency=OSS_LIST_CONCURRENCY):
+    """
+    并发列举一个目录下的所有对象，子目录和分页的请求并发进行，获取到一页就返回一页
+    :param list_page: list_page(prefix, continuation_token) -> (对象列表, 子目录列表, 下一页的 continuation_token)
+    :param prefix: 根目录
+    :return: 对象的生成器
+    """
+    with ThreadPoolExecutor(concurrency) as pool:
+        pending = {pool.submit(list_page, prefix, ''): prefix}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                current_prefix = pending.pop(future)
+                objects, sub_prefixes, next_continuation_token = future.result()
+                for sub_prefix in sub_prefixes:
+                    pending[pool.submit(list_page, sub_prefix, '')] = sub_prefix
+                if next_continuation_token:
+                    pending[pool.submit(list_page, current_prefix, next_continuation_token)] = current_prefix
+                yield from objects
+
+
+def _download_range_to_fd(open_range, fd, start, end):
+    stream = open_range(start, end)
+    offset = start
+    while True:
+        block = stream.read(_READ_BLOCK_SIZE)
+        if not block:
+            break
+        os.pwrite(fd, block, offset)
+        offset += len(block)
+    if offset != end + 1:
+        raise Exception(f"下载文件不完整：期望 {end + 1 - start} 字节，实际 {offset - start} 字节")
+
+
+def download_object(open_range, key, size, folder):
+    """
+    通过 SDK 直接下载对象：
+    - 小对象直接读到内存中，返回 bytes
+    - 大对象拆分成多个范围请求并发下载到 folder 中，返回文件路径
+    - 其余对象流式写入 folder 中，返回文件路径
+    :param open_range: open_range(start, end) 返回可 read 的流，end 为闭区间，start 和 end 为 None 时读取整个对象
+    :param key: 对象的 key，用于生成本地文件名
+    :param size: 对象大小，未知时为 None
+    :param folder: 本地目录
+    """
+    if size is not None and size <= OSS_DOWNLOAD_MEMORY_THRESHOLD_MB * 1024 * 1024:
+        return open_range(None, None).read()
+
+    # 保留文件名和后缀，加载文档时根据后缀选择 loader
+    file_path = os.path.join(folder, f"{uuid.uuid4().hex}-{os.path.basename(key)}")
+    if size is None or size <= OSS_DOWNLOAD_RANGE_THRESHOLD_MB * 1024 * 1024:
+        with open(file_path, 'wb') as f:
+            shutil.copyfileobj(open_range(None, None), f, _READ_BLOCK_SIZE)
+        return file_path
+
+    part_size = OSS_DOWNLOAD_PART_SIZE_MB * 1024 * 1024
+    ranges = [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
+    fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, size)
+        with ThreadPoolExecutor(OSS_DOWNLOAD_RANGE_CONCURRENCY) as pool:
+            futures = [pool.submit(_download_range_to_fd, open_range, fd, start, end) for start, end in ranges]
+            for future in futures:
+                future.result()
+    except Exception:
+        os.close(fd)
+        os.remove(file_path)
+        raise
+    os.close(fd)
+    return file_path
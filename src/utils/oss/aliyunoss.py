@@ -1,6 +1,5 @@
 import oss2
-import re
-import datetime
+from src.utils.oss import FileFilter, iter_objects_concurrently, download_object
 
 
 class AliyunOSSClient:
@@ -17,40 +16,69 @@ class AliyunOSSClient:
                 break
         return files
 
+    def list_page(self, prefix, continuation_token=''):
+        """
+        列举一页对象
+        :param prefix: 路径
+        :return: (对象列表, 子目录列表, 下一页的 continuation_token)
+        """
+        result = self.bucket.list_objects_v2(
+            prefix=prefix, delimiter='/', continuation_token=continuation_token, max_keys=1000
+        )
+        objects = [
+            {
+                "key": obj.key,
+                "size": obj.size,
+                "etag": obj.etag,
+                "last_modified": obj.last_modified
+            } for obj in result.object_list
+        ]
+        next_continuation_token = result.next_continuation_token if result.is_truncated else None
+        return objects, result.prefix_list, next_continuation_token
+
+    def iter_objects(self, prefix):
+        """
+        列举对象，包含对象的大小、etag 和最后修改时间，子目录并发列举
+        :param prefix: 路径
+        :return: 对象的生成器
+        """
+        return iter_objects_concurrently(self.list_page, prefix)
+
     def read_dir(self, prefix):
         """
         列举对象
         :param prefix: 路径
         :return:
         """
-        files = []
-        for obj in oss2.ObjectIterator(self.bucket, prefix=prefix):
-            files.append(obj.key)
-        return files
+        return [item['key'] for item in self.iter_objects(prefix)]
 
     def get_signed_url(self, object_name, expires=3600):
         url = self.bucket.sign_url('GET', object_name, expires)
         return url
 
-    def is_file_match_condition(self, file, fileExtensions, excludeFileRegex):
-        # 如果后缀不在合法的后缀中，不符合
-        if fileExtensions:
-            match_extension_result = [
-                file.endswith(extension) for extension in fileExtensions
-            ]
-            if True not in match_extension_result:
-                return False
+    def get_object_uri(self, key):
+        return f"oss://{self.bucket_name}/{key}"
 
-        if excludeFileRegex:
-            if re.compile("r'{}'".format(excludeFileRegex.replace("\\", "\\\\"))).search(file):
-                return False
+    def open_range(self, key, start=None, end=None):
+        if start is None:
+            return self.bucket.get_object(key)
+        return self.bucket.get_object(key, byte_range=(start, end))
+
+    def download(self, key, size, folder):
+        """
+        下载对象，小对象返回 bytes，大对象返回下载到 folder 中的文件路径
+        """
+        return download_object(
+            lambda start, end: self.open_range(key, start, end), key, size, folder
+        )
 
-        return True
+    def iter_objects_in_base_folder(self, base_folder, fileExtensions=None, excludeFileRegex=None):
+        file_filter = FileFilter(fileExtensions, excludeFileRegex)
+        for obj in self.iter_objects(base_folder):
+            if file_filter.match(obj['key']):
+                yield obj
 
     def get_all_files_in_base_folder(self, base_folder, fileExtensions=None, excludeFileRegex=None):
-        files = self.read_dir(base_folder)
-        valid_files = []
-        for file in files:
-            if self.is_file_match_condition(file, fileExtensions, excludeFileRegex):
-                valid_files.append(file)
-        return valid_files
+        return [
+            obj['key'] for obj in self.iter_objects_in_base_folder(base_folder, fileExtensions, excludeFileRegex)
+        ]
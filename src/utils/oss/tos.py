@@ -1,6 +1,6 @@
 import tos
 from tos import HttpMethodType
-import re
+from src.utils.oss import FileFilter, iter_objects_concurrently, download_object
 
 
 class TOSClient:
@@ -22,51 +22,71 @@ class TOSClient:
             "folders_in_dir": folders_in_dir
         }
 
-    def read_dir(self, tos_path, continuation_token=""):
+    def list_page(self, tos_path, continuation_token=""):
         """
-        列举对象
+        列举一页对象
         :param tos_path:
-        :return:
+        :return: (对象列表, 子目录列表, 下一页的 continuation_token)
         """
-        files = []
         out = self.client.list_objects_type2(
             self.bucket_name, delimiter="/", prefix=tos_path, continuation_token=continuation_token
         )
-        next_continuation_token = out.next_continuation_token
+        objects = [
+            {
+                "key": item.key,
+                "size": item.size,
+                "etag": item.etag.strip('"') if item.etag else None,
+                "last_modified": int(item.last_modified.timestamp()) if item.last_modified else None
+            } for item in out.contents
+        ]
         # common_prefixes中返回了fun1/目录下的子目录
-        files_in_dir = [item.key for item in out.contents]
-        files += files_in_dir
         folders_in_dir = [prefix.prefix for prefix in out.common_prefixes]
-        for folder in folders_in_dir:
-            files += self.read_dir(folder)
-        if next_continuation_token:
-            files += self.read_dir(tos_path, next_continuation_token)
-        return files
+        return objects, folders_in_dir, out.next_continuation_token
+
+    def iter_objects(self, tos_path):
+        """
+        列举对象，包含对象的大小、etag 和最后修改时间，子目录并发列举
+        :param tos_path:
+        :return: 对象的生成器
+        """
+        return iter_objects_concurrently(self.list_page, tos_path)
+
+    def read_dir(self, tos_path):
+        """
+        列举对象
+        :param tos_path:
+        :return:
+        """
+        return [item['key'] for item in self.iter_objects(tos_path)]
 
     def get_signed_url(self, key, expires=3600):
         return self.client.pre_signed_url(
             HttpMethodType.Http_Method_Get, self.bucket_name, key=key, expires=expires
         )
 
-    def is_file_match_condition(self, file, fileExtensions, excludeFileRegex):
-        # 如果后缀不在合法的后缀中，不符合
-        if fileExtensions:
-            match_extension_result = [
-                file.endswith(extension) for extension in fileExtensions
-            ]
-            if True not in match_extension_result:
-                return False
+    def get_object_uri(self, key):
+        return f"tos://{self.bucket_name}/{key}"
 
-        if excludeFileRegex:
-            if re.compile("r'{}'".format(excludeFileRegex.replace("\\", "\\\\"))).search(file):
-                return False
+    def open_range(self, key, start=None, end=None):
+        if start is None:
+            return self.client.get_object(self.bucket_name, key)
+        return self.client.get_object(self.bucket_name, key, range_start=start, range_end=end)
+
+    def download(self, key, size, folder):
+        """
+        下载对象，小对象返回 bytes，大对象返回下载到 folder 中的文件路径
+        """
+        return download_object(
+            lambda start, end: self.open_range(key, start, end), key, size, folder
+        )
 
-        return True
+    def iter_objects_in_base_folder(self, base_folder, fileExtensions=None, excludeFileRegex=None):
+        file_filter = FileFilter(fileExtensions, excludeFileRegex)
+        for obj in self.iter_objects(base_folder):
+            if file_filter.match(obj['key']):
+                yield obj
 
     def get_all_files_in_base_folder(self, base_folder, fileExtensions=None, excludeFileRegex=None):
-        files = self.read_dir(base_folder)
-        valid_files = []
-        for file in files:
-            if self.is_file_match_condition(file, fileExtensions, excludeFileRegex):
-                valid_files.append(file)
-        return valid_files
+        return [
+            obj['key'] for obj in self.iter_objects_in_base_folder(base_folder, fileExtensions, excludeFileRegex)
+        ]
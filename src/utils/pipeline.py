@@ -0,0 +1,58 @@
+import queue
+import threading
+
+_END = object()
+
+
+def batched(iterable, batch_size):
+    """
+    把可迭代对象按 batch_size 切分成多个 list，和 chunk_list 不同，不需要提前把所有元素加载到内存中
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def prefetch(iterable, maxsize=2):
+    """
+    在后台线程中提前消费 iterable，最多缓存 maxsize 个元素，使上下游两个阶段可以重叠执行。
+    生产者抛出的异常会在消费者这边重新抛出；消费者提前退出时生产者也会停止。
+    """
+    q = queue.Queue(maxsize=maxsize)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except BaseException as e:
+            put((_END, e))
+            return
+        put((_END, None))
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item, error = q.get()
+            if item is _END:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stopped.set()
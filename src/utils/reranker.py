@@ -0,0 +1,95 @@
+import os
+import threading
+from collections import OrderedDict
+
+from FlagEmbedding import FlagReranker
+
+from src.utils import ROOT_FOLDER, model_registry, generate_md5
+
+RERANKER_MODEL_NAME = 'BAAI/bge-reranker-large'
+RERANKER_BATCH_SIZE = os.environ.get('RERANKER_BATCH_SIZE', '32')
+RERANKER_BATCH_SIZE = int(RERANKER_BATCH_SIZE)
+RERANKER_MAX_LENGTH = os.environ.get('RERANKER_MAX_LENGTH', '512')
+RERANKER_MAX_LENGTH = int(RERANKER_MAX_LENGTH)
+RERANKER_SCORE_CACHE_SIZE = os.environ.get('RERANKER_SCORE_CACHE_SIZE', '10000')
+RERANKER_SCORE_CACHE_SIZE = int(RERANKER_SCORE_CACHE_SIZE)
+
+
+def load_reranker():
+    def loader():
+        model_path = os.path.join(ROOT_FOLDER, 'models/bge-reranker-large')
+        return FlagReranker(
+            model_path if os.path.exists(model_path) else RERANKER_MODEL_NAME,
+            use_fp16=True
+        )
+
+    return model_registry.get(RERANKER_MODEL_NAME, loader)
+
+
+class RerankerEngine:
+    """
+    重排序引擎：模型通过 model_registry 只加载一次，候选文档按 batch 打分，
+    相同 (query, 文档) 的分数缓存在一个小的 LRU 中
+    """
+
+    def __init__(self, batch_size=32, max_length=512, cache_size=10000):
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+        self.score_cache = OrderedDict()
+
+    def _get_cached(self, key):
+        with self.lock:
+            if key in self.score_cache:
+                self.score_cache.move_to_end(key)
+                return self.score_cache[key]
+            return None
+
+    def _set_cached(self, key, score):
+        if self.cache_size <= 0:
+            return
+        with self.lock:
+            self.score_cache[key] = score
+            self.score_cache.move_to_end(key)
+            while len(self.score_cache) > self.cache_size:
+                self.score_cache.popitem(last=False)
+
+    def compute_scores(self, query, docs):
+        """
+        计算 query 和每个文档的相关性分数
+        :param query:
+        :param docs: 文档列表
+        :return: 与 docs 顺序一致的分数列表
+        """
+        query_hash = generate_md5(query)
+        keys = [(query_hash, generate_md5(doc)) for doc in docs]
+        scores = [self._get_cached(key) for key in keys]
+
+        missed = {}
+        for index, key in enumerate(keys):
+            if scores[index] is None and key not in missed:
+                missed[key] = docs[index]
+        if missed:
+            reranker = load_reranker()
+            pairs = [[query, doc] for doc in missed.values()]
+            missed_scores = reranker.compute_score(
+                pairs, batch_size=self.batch_size, max_length=self.max_length
+            )
+            # 只有一对时 FlagReranker 返回的是单个分数
+            if not isinstance(missed_scores, list):
+                missed_scores = [missed_scores]
+            missed_scores = dict(zip(missed.keys(), missed_scores))
+            for key, score in missed_scores.items():
+                self._set_cached(key, score)
+            scores = [
+                missed_scores[key] if score is None else score for key, score in zip(keys, scores)
+            ]
+        return scores
+
+
+reranker_engine = RerankerEngine(
+    batch_size=RERANKER_BATCH_SIZE,
+    max_length=RERANKER_MAX_LENGTH,
+    cache_size=RERANKER_SCORE_CACHE_SIZE
+)
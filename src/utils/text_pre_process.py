@@ -0,0 +1,139 @@
+import re
+from collections import Counter
+from functools import lru_cache
+
+# 基于正则替换的规则：规则名 -> (正则, 替换的字符串或者 replace(match) 函数)，
+# 一个任务中选中的所有替换规则会合并成一个正则，对文本只遍历一遍
+SUBSTITUTION_RULES = {}
+# 需要同时看到多页内容的规则：规则名 -> process(texts) -> texts
+BATCH_RULES = {}
+
+URL_PATTERN = r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+'
+EMAIL_PATTERN = r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,7}\b'
+
+# 页眉页脚：在一批页面中，超过这个比例的页面的第一行 / 最后一行相同（数字视为相同）时删除
+HEADER_FOOTER_MIN_RATIO = 0.5
+HEADER_FOOTER_MIN_PAGES = 3
+_DIGITS_PATTERN = re.compile(r'\d+')
+
+
+def register_substitution_rule(name, pattern, replacement=''):
+    """
+    注册一个正则替换规则，pattern 中不能包含命名分组
+    """
+    SUBSTITUTION_RULES[name] = (pattern, replacement)
+
+
+def register_batch_rule(name):
+    def decorator(process):
+        BATCH_RULES[name] = process
+        return process
+
+    return decorator
+
+
+register_substitution_rule('replace-space-n-tab', r'[\n\t]+')
+register_substitution_rule('delete-url-and-email', f'{URL_PATTERN}|{EMAIL_PATTERN}')
+register_substitution_rule(
+    'normalize-whitespace',
+    r'[ \t\u00a0\u3000]+|\n[ \t\u00a0\u3000]*\n(?:[ \t\u00a0\u3000]*\n)+',
+    lambda match: '\n\n' if match.group().startswith('\n') else ' '
+)
+
+
+def _split_edge_lines(text):
+    """
+    返回 (第一行, 中间部分, 最后一行)，忽略首尾的空行
+    """
+    stripped = text.strip('\n')
+    first_end = stripped.find('\n')
+    if first_end == -1:
+        return stripped, '', ''
+    last_start = stripped.rfind('\n')
+    return stripped[:first_end], stripped[first_end + 1:last_start], stripped[last_start + 1:]
+
+
+@register_batch_rule('strip-header-footer')
+def strip_header_footer(texts):
+    """
+    删除一批页面中重复出现的页眉和页脚（例如文档标题、页码），只检查每页的第一行和最后一行
+    """
+    if len(texts) < HEADER_FOOTER_MIN_PAGES:
+        return texts
+    pages = [_split_edge_lines(text) for text in texts]
+    min_count = max(HEADER_FOOTER_MIN_PAGES, len(pages) * HEADER_FOOTER_MIN_RATIO)
+
+    def repeated_lines(lines):
+        counter = Counter(_DIGITS_PATTERN.sub('#', line.strip()) for line in lines if line.strip())
+        return {line for line, count in counter.items() if count >= min_count}
+
+    headers = repeated_lines(first for first, _, _ in pages)
+    footers = repeated_lines(last for _, middle, last in pages if last)
+    if not headers and not footers:
+        return texts
+
+    result = []
+    for text, (first, middle, last) in zip(texts, pages):
+        is_header = _DIGITS_PATTERN.sub('#', first.strip()) in headers
+        is_footer = last and _DIGITS_PATTERN.sub('#', last.strip()) in footers
+        if not is_header and not is_footer:
+            result.append(text)
+            continue
+        lines = [] if is_header else [first]
+        if middle or last:
+            lines.append(middle)
+        if last and not is_footer:
+            lines.append(last)
+        result.append('\n'.join(lines))
+    return result
+
+
+class TextPreProcessor:
+    """
+    把选中的预处理规则编译成一个处理器：
+    - 所有正则替换规则合并成一个正则，一次遍历完成所有替换
+    - 需要多页内容的规则（例如页眉页脚）按批处理
+    不认识的规则会被忽略
+    """
+
+    def __init__(self, rules):
+        self.rules = [rule for rule in rules if rule in SUBSTITUTION_RULES or rule in BATCH_RULES]
+        substitution_rules = [rule for rule in self.rules if rule in SUBSTITUTION_RULES]
+        self.batch_rules = [BATCH_RULES[rule] for rule in self.rules if rule in BATCH_RULES]
+        self.pattern = None
+        if substitution_rules:
+            self.pattern = re.compile('|'.join(
+                f'(?P<r{index}>{SUBSTITUTION_RULES[rule][0]})' for index, rule in enumerate(substitution_rules)
+            ))
+            replacements = {f'r{index}': SUBSTITUTION_RULES[rule][1] for index, rule in enumerate(substitution_rules)}
+            if all(replacement == '' for replacement in replacements.values()):
+                # 所有规则都是删除时不需要回调
+                self.replacement = ''
+            else:
+                def replace(match):
+                    replacement = replacements[match.lastgroup]
+                    return replacement if isinstance(replacement, str) else replacement(match)
+
+                self.replacement = replace
+
+    def process(self, text):
+        return self.process_batch([text])[0]
+
+    def process_batch(self, texts):
+        for batch_rule in self.batch_rules:
+            texts = batch_rule(texts)
+        if self.pattern is not None:
+            texts = [self.pattern.sub(self.replacement, text) for text in texts]
+        return texts
+
+
+@lru_cache(maxsize=32)
+def _get_pre_processor(rules):
+    return TextPreProcessor(rules)
+
+
+def get_pre_processor(rules):
+    """
+    相同的规则组合只编译一次
+    """
+    return _get_pre_processor(tuple(rules or []))
@@ -0,0 +1,121 @@
+import re
+from collections import deque
+
+from langchain.schema import Document
+
+
+# 按 token 计算长度时，每次批量计算长度的片段数量
+LENGTH_BATCH_SIZE = 1024
+
+
+class TextSplitter:
+    """
+    按分隔符（正则）切分文本，合并规则和 langchain 的 CharacterTextSplitter 相同：
+    相邻的片段合并到不超过 chunk_size，相邻的 chunk 之间最多重叠 chunk_overlap。
+
+    切分过程中只记录每个片段在原文中的起止位置，一次遍历完成合并，最后才从原文中截取 chunk，
+    chunk 中保留原文中的分隔符，metadata 中记录 chunk 在原文中的位置（start_index / end_index）。
+
+    默认按字符计算长度，传入 length_function 时（例如按 embedding 模型的 tokenizer 计算 token 数）
+    片段的长度由 length_function 计算，片段之间的分隔符按 separator 本身的长度计算。
+    """
+
+    def __init__(self, chunk_size=2048, chunk_overlap=0, separator='\n\n', length_function=None):
+        """
+        :param length_function: length_function(texts) -> 每个文本的长度，批量计算，为 None 时按字符计算
+        """
+        if chunk_overlap > chunk_size:
+            raise Exception(f"chunk_overlap（{chunk_overlap}）不能大于 chunk_size（{chunk_size}）")
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.separator = separator
+        self.pattern = re.compile(separator) if separator else None
+        self.length_function = length_function
+        self.separator_length = length_function([separator])[0] if length_function and separator else 0
+
+    def _iter_pieces(self, text):
+        """
+        返回分隔符之间的非空片段在原文中的 (start, end)
+        """
+        if self.pattern is None:
+            yield from ((i, i + 1) for i in range(len(text)))
+            return
+        start = 0
+        for match in self.pattern.finditer(text):
+            if match.start() > start:
+                yield start, match.start()
+            # 空匹配时 finditer 会自动前进，这里保证 start 不回退
+            start = max(start, match.end())
+        if start < len(text):
+            yield start, len(text)
+
+    def _iter_measured_pieces(self, text):
+        """
+        返回 (start, end, 片段长度, 和前一个片段之间的分隔符长度)
+        """
+        if self.length_function is None:
+            previous_end = None
+            for start, end in self._iter_pieces(text):
+                yield start, end, end - start, start - previous_end if previous_end is not None else 0
+                previous_end = end
+            return
+        pieces = self._iter_pieces(text)
+        while True:
+            batch = [piece for _, piece in zip(range(LENGTH_BATCH_SIZE), pieces)]
+            if not batch:
+                break
+            lengths = self.length_function([text[start:end] for start, end in batch])
+            for (start, end), length in zip(batch, lengths):
+                yield start, end, length, self.separator_length
+
+    def _chunk_of(self, text, start, end):
+        """
+        截取 chunk 并去掉首尾的空白，返回 (chunk, start, end)，chunk 为空时返回 None
+        """
+        chunk = text[start:end]
+        stripped = chunk.strip()
+        if not stripped:
+            return None
+        start += len(chunk) - len(chunk.lstrip())
+        return stripped, start, start + len(stripped)
+
+    def iter_chunks(self, text):
+        """
+        切分文本，逐个返回 (chunk, start, end)
+        """
+        # 当前 chunk 中的片段 (start, end, 片段长度, 到下一个片段的分隔符长度)，total 为当前 chunk 的长度
+        current = deque()
+        total = 0
+        for piece_start, piece_end, length, gap in self._iter_measured_pieces(text):
+            if current and total + gap + length > self.chunk_size:
+                chunk = self._chunk_of(text, current[0][0], current[-1][1])
+                if chunk:
+                    yield chunk
+                # 从头部移除片段，直到剩余部分不超过 chunk_overlap，并且加上新的片段之后不超过 chunk_size
+                while current and (total > self.chunk_overlap or total + gap + length > self.chunk_size):
+                    _, _, first_length, first_gap = current.popleft()
+                    total -= first_length + (first_gap if current else 0)
+                if not current:
+                    total = 0
+            if current:
+                current[-1] = current[-1][:3] + (gap,)
+                total += gap
+            current.append((piece_start, piece_end, length, 0))
+            total += length
+        if current:
+            chunk = self._chunk_of(text, current[0][0], current[-1][1])
+            if chunk:
+                yield chunk
+
+    def split_text(self, text):
+        return [chunk for chunk, _, _ in self.iter_chunks(text)]
+
+    def split_documents(self, documents):
+        chunks = []
+        for doc in documents:
+            for chunk, start, end in self.iter_chunks(doc.page_content):
+                metadata = dict(doc.metadata)
+                metadata["start_index"] = start
+                metadata["end_index"] = end
+                chunks.append(Document(page_content=chunk, metadata=metadata))
+        return chunks
@@ -1,6 +1,4 @@
-from FlagEmbedding import FlagReranker
-from src.utils import ROOT_FOLDER
-import os
+from src.utils.reranker import reranker_engine
 from vines_worker_sdk.conductor.worker import Worker
 
 
@@ -68,17 +66,7 @@ class RerankerWorker(Worker):
         array = input_data.get('array')
         top_k = input_data.get('topK')
 
-        model_or_path = os.path.join(ROOT_FOLDER, 'models/bge-reranker-large') if os.path.exists(
-            os.path.join(ROOT_FOLDER, 'models/bge-reranker-large')) else "BAAI/bge-reranker-large"
-        reranker = FlagReranker(
-            model_or_path,
-            use_fp16=True
-        )
-        args = [
-            [query, item] for item in array
-        ]
-
-        scores = reranker.compute_score(args)
+        scores = reranker_engine.compute_scores(query, array)
         sorted_array = [item for score, item in sorted(zip(scores, array), reverse=True)]
 
         if top_k != None:
@@ -0,0 +1,131 @@
+import json
+import random
+import threading
+import time
+import unittest
+
+import elasticsearch
+from elastic_transport import ApiResponseMeta, HttpHeaders, JsonSerializer
+
+from src.es.bulk_writer import BulkWriter
+
+
+class FakeTransport:
+    class serializers:
+        @staticmethod
+        def get_serializer(mimetype):
+            return JsonSerializer()
+
+
+class FakeClient:
+    """
+    记录每次 bulk 请求，rejections 中的 id 在前几次请求中返回指定的状态码
+    """
+
+    transport = FakeTransport()
+
+    def __init__(self, rejections=None, errors=None, max_delay=0.0):
+        # id -> 依次返回的状态码
+        self.rejections = {pk: list(statuses) for pk, statuses in (rejections or {}).items()}
+        # 整个请求依次抛出的异常
+        self.errors = list(errors or [])
+        self.max_delay = max_delay
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def bulk(self, operations):
+        with self.lock:
+            ids = [json.loads(line)['index']['_id'] for line in operations[::2]]
+            self.requests.append(ids)
+            error = self.errors.pop(0) if self.errors else None
+        if error is not None:
+            raise error
+        # 让并发的请求乱序完成
+        time.sleep(random.uniform(0, self.max_delay))
+        items = []
+        for pk in ids:
+            with self.lock:
+                statuses = self.rejections.get(pk)
+                status = statuses.pop(0) if statuses else 201
+            item = {"_id": pk, "status": status}
+            if status >= 300:
+                item["error"] = {"type": "rejected"}
+            items.append({"index": item})
+        return {"errors": any(item["index"]["status"] >= 300 for item in items), "items": items}
+
+
+def make_actions(count):
+    return [{"_op_type": "index", "_index": "test", "_id": str(i), "_source": {"value": i}} for i in range(count)]
+
+
+def api_error(status):
+    meta = ApiResponseMeta(status=status, http_version="1.1", headers=HttpHeaders(), duration=0.0, node=None)
+    return elasticsearch.ApiError("rejected", meta=meta, body={})
+
+
+def make_writer(client, **kwargs):
+    return BulkWriter(client, initial_backoff=0, max_backoff=0, **kwargs)
+
+
+class BulkWriterTest(unittest.TestCase):
+
+    def test_results_in_action_order(self):
+        client = FakeClient(max_delay=0.01)
+        writer = make_writer(client, chunk_size=7, thread_count=4)
+        results = list(writer.write(make_actions(100)))
+        self.assertEqual([str(i) for i in range(100)], [item['index']['_id'] for _, item in results])
+        self.assertTrue(all(ok for ok, _ in results))
+        self.assertEqual(15, len(client.requests))
+        self.assertEqual(100, writer.summary()['succeeded'])
+
+    def test_partial_retry_only_resends_rejected_items(self):
+        client = FakeClient(rejections={"3": [429], "5": [503, 429]})
+        writer = make_writer(client, chunk_size=10, thread_count=1)
+        results = list(writer.write(make_actions(10)))
+        self.assertEqual([str(i) for i in range(10)], [item['index']['_id'] for _, item in results])
+        self.assertTrue(all(ok for ok, _ in results))
+        self.assertEqual([[str(i) for i in range(10)], ["3", "5"], ["5"]], client.requests)
+        self.assertEqual(3, writer.summary()['retried'])
+
+    def test_partial_retry_keeps_order_across_chunks(self):
+        rejections = {str(i): [429] for i in range(0, 60, 7)}
+        client = FakeClient(rejections=rejections, max_delay=0.01)
+        writer = make_writer(client, chunk_size=8, thread_count=3)
+        results = list(writer.write(make_actions(60)))
+        self.assertEqual([str(i) for i in range(60)], [item['index']['_id'] for _, item in results])
+        self.assertTrue(all(ok for ok, _ in results))
+        self.assertEqual(len(rejections), writer.summary()['retried'])
+
+    def test_failed_items_after_max_retries(self):
+        client = FakeClient(rejections={"1": [429, 429, 429], "2": [400]})
+        writer = make_writer(client, chunk_size=10, max_retries=2)
+        results = list(writer.write(make_actions(4)))
+        self.assertEqual([True, False, False, True], [ok for ok, _ in results])
+        summary = writer.summary()
+        self.assertEqual(2, summary['succeeded'])
+        self.assertEqual(2, summary['failed'])
+        self.assertEqual(["1", "2"], [item['index']['_id'] for item in summary['errors']])
+
+    def test_retry_whole_request(self):
+        client = FakeClient(errors=[api_error(429), elasticsearch.ConnectionError("refused")])
+        writer = make_writer(client, chunk_size=10)
+        results = list(writer.write(make_actions(3)))
+        self.assertTrue(all(ok for ok, _ in results))
+        self.assertEqual(3, len(client.requests))
+
+    def test_raise_on_other_api_errors(self):
+        client = FakeClient(errors=[api_error(400)])
+        writer = make_writer(client, chunk_size=10)
+        with self.assertRaises(elasticsearch.ApiError):
+            list(writer.write(make_actions(3)))
+
+    def test_split_by_bytes(self):
+        client = FakeClient()
+        writer = make_writer(client, chunk_size=100, max_chunk_bytes=200, thread_count=1)
+        list(writer.write(make_actions(10)))
+        self.assertGreater(len(client.requests), 1)
+        self.assertEqual([str(i) for i in range(10)], [pk for request in client.requests for pk in request])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+import io
+import os
+import tempfile
+import unittest
+import zipfile
+from unittest import mock
+
+import fitz
+
+from src.utils import document_loader
+from src.utils.document_loader import load_single_document_from_buffer, load_documents_from_buffer, \
+    load_single_document, detect_file_type, _list_zip_members
+
+
+def make_pdf(pages):
+    with fitz.open() as pdf:
+        for text in pages:
+            pdf.new_page().insert_text((72, 72), text)
+        return pdf.tobytes()
+
+
+class NativeLoaderTest(unittest.TestCase):
+
+    def test_detect_file_type(self):
+        self.assertEqual('csv', detect_file_type('dir.v2/Rows.CSV'))
+        self.assertEqual('pdf', detect_file_type('report', b'%PDF-1.7'))
+        self.assertEqual('zip', detect_file_type('archive', b'PK\x03\x04'))
+        self.assertEqual('json', detect_file_type('records', b'  [{"id": 1}]'))
+        self.assertEqual('txt', detect_file_type('notes', 'plain text'.encode('utf-8')))
+        # 开头的内容截断在多字节字符中间时仍然是文本
+        self.assertEqual('txt', detect_file_type('notes', '中文'.encode('utf-8')[:-1]))
+        self.assertIsNone(detect_file_type('image', b'\x89PNG\r\n\x1a\n\xff\xfe\x00'))
+
+    def test_txt(self):
+        documents = load_single_document_from_buffer('第一行\n第二行'.encode('utf-8'), 'notes.txt')
+        self.assertEqual(['第一行\n第二行'], [doc.page_content for doc in documents])
+        self.assertEqual({"source": 'notes.txt'}, documents[0].metadata)
+
+    def test_csv_rows_match_csv_loader_format(self):
+        data = 'id, name \n1, 张三 \n2,李四\n'.encode('utf-8')
+        documents = load_single_document_from_buffer(data, 'rows.csv')
+        self.assertEqual(["id: 1\nname: 张三", "id: 2\nname: 李四"], [doc.page_content for doc in documents])
+        self.assertEqual([0, 1], [doc.metadata['row'] for doc in documents])
+
+    def test_json_array_items_are_records(self):
+        data = b'[{"id": 1}, "text", 3, {}]'
+        documents = load_single_document_from_buffer(data, 'records.json')
+        self.assertEqual(['{"id":1}', 'text', '3', ''],
+                         [doc.page_content.replace(' ', '') for doc in documents])
+        self.assertEqual([1, 2, 3, 4], [doc.metadata['seq_num'] for doc in documents])
+
+    def test_json_with_jq_schema(self):
+        data = b'{"items": [{"text": "a"}, {"text": "b"}]}'
+        documents = load_single_document_from_buffer(data, 'records.json', jq_schema='.items[].text')
+        self.assertEqual(['a', 'b'], [doc.page_content for doc in documents])
+
+    def test_jsonl_skips_blank_lines(self):
+        data = b'{"text": "a"}\n\n{"text": "b"}\n'
+        documents = load_single_document_from_buffer(data, 'records.jsonl', jq_schema='.text')
+        self.assertEqual(['a', 'b'], [doc.page_content for doc in documents])
+        self.assertEqual([1, 2], [doc.metadata['seq_num'] for doc in documents])
+
+    def test_file_without_extension_is_sniffed(self):
+        with tempfile.TemporaryDirectory() as folder:
+            file_path = os.path.join(folder, 'records')
+            with open(file_path, 'wb') as f:
+                f.write(b'[{"text": "a"}]')
+            documents = load_single_document(file_path, jq_schema='.[].text')
+        self.assertEqual(['a'], [doc.page_content for doc in documents])
+        self.assertEqual(file_path, documents[0].metadata['source'])
+
+
+def count_words(model_name, texts):
+    return [len(text.split()) for text in texts]
+
+
+class TokenLengthTest(unittest.TestCase):
+
+    def test_chunk_size_counts_tokens_of_the_model(self):
+        data = b"one two three\n\nfour five\n\nsix seven eight nine"
+        with mock.patch.object(document_loader, 'count_tokens_of_model', count_words):
+            chunks = load_documents_from_buffer(data, 'words.txt', chunk_size=5, tokenizer_model='word-model')
+        self.assertEqual(['one two three\n\nfour five', 'six seven eight nine'],
+                         [chunk.page_content for chunk in chunks])
+
+    def test_character_length_by_default(self):
+        data = b"one two three\n\nfour five\n\nsix seven eight nine"
+        chunks = load_documents_from_buffer(data, 'words.txt', chunk_size=5)
+        self.assertEqual(['one two three', 'four five', 'six seven eight nine'],
+                         [chunk.page_content for chunk in chunks])
+
+
+class PreProcessDocumentsTest(unittest.TestCase):
+
+    def test_header_footer_rule_skips_csv_rows(self):
+        data = b"id,name\n0,n0\n1,n1\n2,n2\n3,n3\n"
+        documents = load_single_document_from_buffer(data, 'rows.csv', pre_process_rules=['strip-header-footer'])
+        self.assertEqual(
+            [f"id: {i}\nname: n{i}" for i in range(4)],
+            [doc.page_content for doc in documents]
+        )
+
+    def test_header_footer_rule_skips_jsonl_records(self):
+        data = b"\n".join(b'{"id": %d, "name": "n%d"}' % (i, i) for i in range(4))
+        documents = load_single_document_from_buffer(data, 'records.jsonl', jq_schema='"id \\(.id)\\n\\(.name)"',
+                                                     pre_process_rules=['strip-header-footer'])
+        self.assertEqual([f"id {i}\nn{i}" for i in range(4)], [doc.page_content for doc in documents])
+
+    def test_header_footer_rule_strips_pdf_pages(self):
+        data = make_pdf([f"Manual\nBody of page {page}\nPage {page}" for page in range(1, 5)])
+        documents = load_single_document_from_buffer(data, 'manual.pdf', pre_process_rules=['strip-header-footer'])
+        self.assertEqual([f"Body of page {page}" for page in range(1, 5)],
+                         [doc.page_content.strip() for doc in documents])
+
+
+def make_zip(members):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as zip_file:
+        for filename, data in members.items():
+            zip_file.writestr(filename, data)
+    return buffer.getvalue()
+
+
+class ZipMembersTest(unittest.TestCase):
+
+    def test_members_without_extension_are_sniffed(self):
+        data = make_zip({
+            'records': b'[{"id": 1}]',
+            'notes': 'plain text notes'.encode('utf-8'),
+            'image': b'\x89PNG\r\n\x1a\n\xff\xfe\x00',
+            'readme.md': b'# readme',
+            '__MACOSX/notes': b'ignored',
+        })
+        with zipfile.ZipFile(io.BytesIO(data)) as zip_file:
+            members = [info.filename for info in _list_zip_members(zip_file)]
+        self.assertEqual(['notes', 'readme.md', 'records'], members)
+
+    def test_extensionless_text_member_is_loaded(self):
+        data = make_zip({'notes': b'plain text notes'})
+        documents = load_documents_from_buffer(data, 'archive.zip', zip_concurrency=1)
+        self.assertEqual(['plain text notes'], [doc.page_content for doc in documents])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from src.utils.embedding_batcher import EmbeddingBatcher
+
+
+class RecordingModel:
+    """
+    向量为 [文本长度, 文本中第一个数字]，记录每次推理的 batch 大小、线程和同时进行的推理数
+    """
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.batches = []
+        self.threads = set()
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, model_name, texts):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            self.batches.append(len(texts))
+            self.threads.add(threading.current_thread().name)
+        time.sleep(self.delay)
+        with self.lock:
+            self.running -= 1
+        return np.array([[len(text), int(text.split('-')[0])] for text in texts], dtype=np.float32)
+
+
+def texts_of(start, count):
+    return [f"{i}-text" for i in range(start, start + count)]
+
+
+class EmbeddingBatcherTest(unittest.TestCase):
+
+    def test_results_match_requests(self):
+        model = RecordingModel()
+        batcher = EmbeddingBatcher(model, max_batch_size=8, max_wait_ms=5)
+        embeddings = batcher.encode('m', texts_of(0, 3))
+        np.testing.assert_array_equal([0, 1, 2], embeddings[:, 1])
+
+    def test_concurrent_requests_are_merged(self):
+        model = RecordingModel(delay=0.05)
+        batcher = EmbeddingBatcher(model, max_batch_size=32, max_wait_ms=50)
+        with ThreadPoolExecutor(8) as pool:
+            futures = [pool.submit(batcher.encode, 'm', texts_of(i * 2, 2)) for i in range(8)]
+            results = [future.result() for future in futures]
+        for i, embeddings in enumerate(results):
+            np.testing.assert_array_equal([i * 2, i * 2 + 1], embeddings[:, 1])
+        self.assertLess(len(model.batches), 8)
+        self.assertEqual(1, model.max_running)
+
+    def test_large_request_goes_through_worker_in_slices(self):
+        model = RecordingModel(delay=0.01)
+        batcher = EmbeddingBatcher(model, max_batch_size=4, max_wait_ms=1)
+        with ThreadPoolExecutor(4) as pool:
+            futures = [pool.submit(batcher.encode, 'm', texts_of(i * 10, 10)) for i in range(4)]
+            results = [future.result() for future in futures]
+        for i, embeddings in enumerate(results):
+            np.testing.assert_array_equal(list(range(i * 10, i * 10 + 10)), embeddings[:, 1])
+        # 推理只在后台线程中进行，不会超过 max_batch_size，也不会和其他请求同时进行
+        self.assertEqual({'embedding-batcher-m'}, model.threads)
+        self.assertLessEqual(max(model.batches), 4)
+        self.assertEqual(40, sum(model.batches))
+        self.assertEqual(1, model.max_running)
+
+    def test_error_is_raised_to_caller(self):
+        def fail(model_name, texts):
+            raise ValueError("推理失败")
+
+        batcher = EmbeddingBatcher(fail, max_batch_size=4)
+        with self.assertRaises(ValueError):
+            batcher.encode('m', texts_of(0, 6))
+
+    def test_models_have_separate_workers(self):
+        model = RecordingModel()
+        batcher = EmbeddingBatcher(model, max_batch_size=4)
+        batcher.encode('a', texts_of(0, 1))
+        batcher.encode('b', texts_of(0, 1))
+        self.assertEqual({'embedding-batcher-a', 'embedding-batcher-b'}, model.threads)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from src.utils import embedding_cache
+from src.utils.embedding_cache import EmbeddingCache
+
+# 每个向量 4 维 float32，占 16 字节
+VECTOR_BYTES = 16
+
+
+def vectors_of(count, start=0):
+    return [[i, i + 1, i + 2, i + 3] for i in range(start, start + count)]
+
+
+class EmbeddingCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, 'cache', 'embeddings.db')
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def last_access_of(self, cache, model_name, text_hash):
+        row = cache._get_conn().execute(
+            "SELECT last_access FROM embeddings WHERE model = ? AND text_hash = ?", (model_name, text_hash)
+        ).fetchone()
+        return row[0]
+
+    def test_get_returns_stored_vectors_of_the_same_model(self):
+        cache = EmbeddingCache(self.path, max_bytes=1024 * 1024)
+        cache.put_many('model-a', ['h0', 'h1'], vectors_of(2))
+
+        result = cache.get_many('model-a', ['h0', 'h1', 'h2', 'h0'])
+        self.assertEqual({'h0', 'h1'}, set(result))
+        np.testing.assert_array_equal(np.array([1, 2, 3, 4], dtype=np.float32), result['h1'])
+        self.assertEqual({}, cache.get_many('model-b', ['h0']))
+
+    def test_vectors_persist_across_instances(self):
+        EmbeddingCache(self.path, max_bytes=1024 * 1024).put_many('model-a', ['h0'], vectors_of(1))
+
+        result = EmbeddingCache(self.path, max_bytes=1024 * 1024).get_many('model-a', ['h0'])
+        np.testing.assert_array_equal(np.array([0, 1, 2, 3], dtype=np.float32), result['h0'])
+
+    def test_hits_are_buffered_until_flush(self):
+        cache = EmbeddingCache(self.path, max_bytes=1024 * 1024)
+        cache.put_many('model-a', ['h0'], vectors_of(1))
+        stored = self.last_access_of(cache, 'model-a', 'h0')
+
+        time.sleep(0.01)
+        cache.get_many('model-a', ['h0'])
+        self.assertEqual(stored, self.last_access_of(cache, 'model-a', 'h0'))
+        self.assertIn(('model-a', 'h0'), cache.pending_access)
+
+        cache.flush()
+        self.assertGreater(self.last_access_of(cache, 'model-a', 'h0'), stored)
+        self.assertEqual({}, cache.pending_access)
+
+    def test_too_many_pending_hits_are_flushed(self):
+        cache = EmbeddingCache(self.path, max_bytes=1024 * 1024)
+        cache.put_many('model-a', ['h0', 'h1'], vectors_of(2))
+        with mock.patch.object(embedding_cache, 'ACCESS_FLUSH_MAX_PENDING', 2):
+            cache.get_many('model-a', ['h0'])
+            self.assertEqual(1, len(cache.pending_access))
+            cache.get_many('model-a', ['h1'])
+        self.assertEqual({}, cache.pending_access)
+
+    def test_least_recently_accessed_vectors_are_evicted(self):
+        cache = EmbeddingCache(self.path, max_bytes=VECTOR_BYTES * 10)
+        hashes = [f"h{i}" for i in range(10)]
+        cache.put_many('model-a', hashes, vectors_of(10))
+        # 前两个刚被访问过，访问时间还在内存中，淘汰前会先写入
+        time.sleep(0.01)
+        cache.get_many('model-a', ['h0', 'h1'])
+
+        time.sleep(0.01)
+        cache.put_many('model-a', ['h10'], vectors_of(1, start=10))
+
+        self.assertLessEqual(cache.total_bytes, VECTOR_BYTES * 10)
+        remaining = set(cache.get_many('model-a', hashes + ['h10']))
+        self.assertTrue({'h0', 'h1', 'h10'} <= remaining)
+        self.assertLess(len(remaining), 11)
+
+
+if __name__ == '__main__':
+    unittest.main()
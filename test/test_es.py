@@ -0,0 +1,313 @@
+import os
+import time
+import unittest
+from unittest import mock
+
+import elasticsearch
+
+import src.es
+from src.es import ESClient, source_hash_of
+
+
+class FakeIndices:
+
+    def __init__(self):
+        self.settings = {}
+        self.meta = {}
+        self.calls = []
+
+    def get_settings(self, index, flat_settings=True):
+        return {index: {"settings": {f"index.{key}": value for key, value in self.settings.items()}}}
+
+    def put_settings(self, index, settings):
+        self.calls.append(('put_settings', settings['index']))
+        for key, value in settings['index'].items():
+            if value is None:
+                self.settings.pop(key, None)
+            else:
+                self.settings[key] = value
+
+    def get_mapping(self, index):
+        return {index: {"mappings": {"_meta": dict(self.meta)}}}
+
+    def put_mapping(self, index, meta):
+        self.meta = dict(meta)
+
+    def refresh(self, index):
+        self.calls.append(('refresh',))
+
+    def forcemerge(self, index, **kwargs):
+        self.calls.append(('forcemerge',))
+
+
+class FakeEs:
+    """
+    只实现用到的接口：按 id 查询文档是否存在、按条件删除、索引设置和 _meta
+    """
+
+    def __init__(self, existing_ids=(), missing_index=False):
+        self.existing_ids = set(existing_ids)
+        self.missing_index = missing_index
+        self.mget_calls = []
+        self.delete_queries = []
+        self.indices = FakeIndices()
+
+    def mget(self, index, ids, _source=False):
+        if self.missing_index:
+            raise elasticsearch.NotFoundError("index_not_found_exception", mock.Mock(status=404), {})
+        self.mget_calls.append(sorted(ids))
+        return {"docs": [{"_id": _id, "found": _id in self.existing_ids} for _id in ids]}
+
+    def delete_by_query(self, index, query, **kwargs):
+        self.delete_queries.append(query)
+        return {"deleted": 1}
+
+
+class FakeEmbedding:
+
+    def __init__(self):
+        self.texts = []
+
+    def __call__(self, model_name, texts):
+        self.texts.extend(texts)
+        return [[float(len(text))] for text in texts]
+
+
+def chunk_of(_id, text, **metadata):
+    return {"_id": _id, "page_content": text, "metadata": metadata}
+
+
+class ESTestCase(unittest.TestCase):
+
+    def use_es(self, fake_es):
+        patcher = mock.patch.object(src.es, 'es', fake_es)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return fake_es
+
+    def use_embedding(self):
+        embedding = FakeEmbedding()
+        patcher = mock.patch.object(src.es, 'generate_embedding_of_model', embedding)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return embedding
+
+
+class SkipExistingTest(ESTestCase):
+
+    def test_get_existing_ids(self):
+        fake_es = self.use_es(FakeEs(existing_ids={'a', 'c'}))
+        client = ESClient('app', 'index')
+        self.assertEqual({'a', 'c'}, client.get_existing_ids(['a', 'b', 'c', 'a']))
+        self.assertEqual([['a', 'b', 'c']], fake_es.mget_calls)
+        self.assertEqual(set(), client.get_existing_ids([]))
+        self.assertEqual(1, len(fake_es.mget_calls))
+
+    def test_missing_index_has_no_existing_ids(self):
+        self.use_es(FakeEs(missing_index=True))
+        self.assertEqual(set(), ESClient('app', 'index').get_existing_ids(['a']))
+
+    def test_existing_chunks_are_not_embedded(self):
+        self.use_es(FakeEs(existing_ids={'a'}))
+        embedding = self.use_embedding()
+        stats = {}
+        chunks = [chunk_of('a', 'old'), chunk_of('b', 'new text')]
+        documents = list(ESClient('app', 'index').embed_chunks('model', chunks, skip_existing=True,
+                                                              update_existing_metadata=True, stats=stats))
+
+        self.assertEqual(['new text'], embedding.texts)
+        self.assertEqual({"existing": 1}, stats)
+        self.assertEqual(['a', 'b'], [document['_id'] for document in documents])
+        self.assertEqual('update', documents[0]['_op_type'])
+        self.assertNotIn('embeddings', documents[0]['_source'])
+        self.assertEqual([8.0], documents[1]['_source']['embeddings'])
+        self.assertNotIn('_op_type', documents[1])
+
+    def test_existing_chunks_are_left_alone_without_metadata_update(self):
+        self.use_es(FakeEs(existing_ids={'a'}))
+        self.use_embedding()
+        documents = list(ESClient('app', 'index').embed_chunks('model', [chunk_of('a', 'old')], skip_existing=True,
+                                                              update_existing_metadata=False))
+        self.assertEqual(['none'], [document['_op_type'] for document in documents])
+
+    def test_all_chunks_are_embedded_without_skip_existing(self):
+        fake_es = self.use_es(FakeEs(existing_ids={'a'}))
+        embedding = self.use_embedding()
+        chunks = [chunk_of('a', 'old'), chunk_of('b', 'new text')]
+        documents = list(ESClient('app', 'index').embed_chunks('model', chunks, skip_existing=False))
+        self.assertEqual(['old', 'new text'], embedding.texts)
+        self.assertEqual([], fake_es.mget_calls)
+        self.assertTrue(all('_op_type' not in document for document in documents))
+
+
+class ReindexDiffTest(ESTestCase):
+
+    def test_source_query_matches_hash_and_legacy_keyword(self):
+        fake_es = self.use_es(FakeEs())
+        url = 'https://bucket.oss.example.com/a.txt?' + 'x' * 300
+        ESClient('app', 'index').delete_documents_by_source([url])
+        should = fake_es.delete_queries[0]['bool']['should']
+        self.assertIn({"terms": {"sourceHash": [source_hash_of(url)]}}, should)
+        self.assertIn({"terms": {"metadata.source.keyword": [url]}}, should)
+        self.assertEqual(1, fake_es.delete_queries[0]['bool']['minimum_should_match'])
+
+    def test_chunks_store_source_hash(self):
+        self.use_es(FakeEs(existing_ids={'a'}))
+        self.use_embedding()
+        chunks = [chunk_of('a', 'old', source='file.txt'), chunk_of('b', 'new', source='file.txt'),
+                  chunk_of('c', 'no source')]
+        documents = list(ESClient('app', 'index').embed_chunks('model', chunks, skip_existing=True))
+        self.assertEqual([source_hash_of('file.txt')] * 2,
+                         [document['_source']['sourceHash'] for document in documents[:2]])
+        self.assertNotIn('sourceHash', documents[2]['_source'])
+
+    def test_diff_deletes_chunks_missing_from_new_version(self):
+        kept_id = src.es.generate_md5('kept')
+        fake_es = self.use_es(FakeEs(existing_ids={kept_id}))
+        self.use_embedding()
+        written = []
+
+        def download_file(url, folder):
+            os.makedirs(folder, exist_ok=True)
+            file_path = os.path.join(folder, 'file.txt')
+            with open(file_path, 'w') as f:
+                f.write('kept\n\nnew')
+            return file_path
+
+        def upsert_documents_stream(documents, on_progress=None, on_failed=None):
+            written.extend(documents)
+            return len(written)
+
+        file_record = mock.Mock()
+        scan = mock.Mock(return_value=[{"_id": kept_id}, {"_id": 'stale'}])
+        with mock.patch.object(src.es, 'oss_client', mock.Mock(download_file=download_file)), \
+                mock.patch.object(src.es, 'download_cache', None), \
+                mock.patch.object(src.es, 'FileProcessProgressTable', mock.Mock()), \
+                mock.patch.object(src.es, 'FileRecord', mock.Mock(return_value=file_record)), \
+                mock.patch.object(src.es.helpers, 'scan', scan), \
+                mock.patch.object(ESClient, 'upsert_documents_stream', side_effect=upsert_documents_stream):
+            indexed = ESClient('app', 'index').insert_vector_from_file(
+                'team', 'model', 'https://example.com/file.txt', {}, task_id='test-reindex-diff', chunk_size=4,
+                reindex_mode='diff'
+            )
+
+        self.assertEqual(2, indexed)
+        self.assertEqual([kept_id, src.es.generate_md5('new')], [document['_id'] for document in written])
+        self.assertEqual([{"ids": {"values": ['stale']}}], fake_es.delete_queries)
+        self.assertEqual({"terms": {"sourceHash": [source_hash_of('https://example.com/file.txt')]}},
+                         scan.call_args.kwargs['query']['query']['bool']['should'][0])
+        file_record.upsert_record.assert_called_once()
+
+    def test_append_keeps_previous_chunks(self):
+        fake_es = self.use_es(FakeEs())
+        self.use_embedding()
+
+        def download_file(url, folder):
+            os.makedirs(folder, exist_ok=True)
+            file_path = os.path.join(folder, 'file.txt')
+            with open(file_path, 'w') as f:
+                f.write('new')
+            return file_path
+
+        file_record = mock.Mock()
+        scan = mock.Mock(return_value=[{"_id": 'stale'}])
+        with mock.patch.object(src.es, 'oss_client', mock.Mock(download_file=download_file)), \
+                mock.patch.object(src.es, 'download_cache', None), \
+                mock.patch.object(src.es, 'FileProcessProgressTable', mock.Mock()), \
+                mock.patch.object(src.es, 'FileRecord', mock.Mock(return_value=file_record)), \
+                mock.patch.object(src.es.helpers, 'scan', scan), \
+                mock.patch.object(ESClient, 'upsert_documents_stream',
+                                  side_effect=lambda documents, *args: len(list(documents))):
+            ESClient('app', 'index').insert_vector_from_file(
+                'team', 'model', 'https://example.com/file.txt', {}, task_id='test-reindex-append', reindex_mode='append'
+            )
+
+        scan.assert_not_called()
+        self.assertEqual([], fake_es.delete_queries)
+        file_record.create_record.assert_called_once()
+
+
+
+class BulkIngestModeTest(ESTestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(src.es, 'ELASTICSEARCH_BULK_INGEST_MODE', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.fake_es = self.use_es(FakeEs())
+        self.indices = self.fake_es.indices
+        self.client = ESClient('app', 'index')
+
+    def state_of(self, owner, expires_in, original):
+        return {"owner": owner, "leaseExpiresAt": time.time() + expires_in, "original": original}
+
+    def test_refresh_is_disabled_during_import_and_restored(self):
+        self.indices.settings = {"refresh_interval": "5s", "number_of_replicas": "1"}
+        self.indices.meta = {"other": "kept"}
+        with self.client.bulk_ingest_mode():
+            self.assertEqual({"refresh_interval": "-1", "number_of_replicas": "1"}, self.indices.settings)
+            state = self.indices.meta[src.es.BULK_INGEST_META_KEY]
+            self.assertEqual({"refresh_interval": "5s"}, state['original'])
+            self.assertGreater(state['leaseExpiresAt'], time.time())
+        self.assertEqual({"refresh_interval": "5s", "number_of_replicas": "1"}, self.indices.settings)
+        self.assertEqual({"other": "kept"}, self.indices.meta)
+        self.assertIn(('refresh',), self.indices.calls)
+
+    def test_settings_are_restored_when_import_fails(self):
+        with self.assertRaises(ValueError):
+            with self.client.bulk_ingest_mode():
+                raise ValueError()
+        self.assertEqual({}, self.indices.settings)
+        self.assertEqual({}, self.indices.meta)
+
+    def test_live_lease_of_another_import_is_left_alone(self):
+        self.indices.settings = {"refresh_interval": "-1"}
+        state = self.state_of('other', 60, {"refresh_interval": "5s"})
+        self.indices.meta = {src.es.BULK_INGEST_META_KEY: state}
+        with self.client.bulk_ingest_mode():
+            pass
+        self.assertEqual({"refresh_interval": "-1"}, self.indices.settings)
+        self.assertEqual(state, self.indices.meta[src.es.BULK_INGEST_META_KEY])
+        self.assertEqual([], self.indices.calls)
+
+    def test_expired_lease_is_taken_over(self):
+        self.indices.settings = {"refresh_interval": "-1"}
+        self.indices.meta = {src.es.BULK_INGEST_META_KEY: self.state_of('dead', -1, {"refresh_interval": "5s"})}
+        with self.client.bulk_ingest_mode():
+            self.assertNotEqual('dead', self.indices.meta[src.es.BULK_INGEST_META_KEY]['owner'])
+        self.assertEqual({"refresh_interval": "5s"}, self.indices.settings)
+        self.assertEqual({}, self.indices.meta)
+
+    def test_manual_refresh_setting_is_left_alone(self):
+        self.indices.settings = {"refresh_interval": "-1"}
+        with self.client.bulk_ingest_mode():
+            pass
+        self.assertEqual({"refresh_interval": "-1"}, self.indices.settings)
+        self.assertEqual([], self.indices.calls)
+
+    def test_expired_settings_are_restored_by_later_imports(self):
+        self.indices.settings = {"refresh_interval": "-1", "number_of_replicas": "0"}
+        self.indices.meta = {src.es.BULK_INGEST_META_KEY: self.state_of(
+            'dead', -1, {"refresh_interval": None, "number_of_replicas": "1"}
+        )}
+        self.client.restore_expired_bulk_ingest_settings()
+        # 之前的版本保存的状态中还有副本数
+        self.assertEqual({"number_of_replicas": "1"}, self.indices.settings)
+        self.assertEqual({}, self.indices.meta)
+
+    def test_live_settings_are_not_restored_by_later_imports(self):
+        self.indices.settings = {"refresh_interval": "-1"}
+        self.indices.meta = {src.es.BULK_INGEST_META_KEY: self.state_of('other', 60, {"refresh_interval": "5s"})}
+        self.client.restore_expired_bulk_ingest_settings()
+        self.assertEqual({"refresh_interval": "-1"}, self.indices.settings)
+
+    def test_disabled_by_default(self):
+        self.indices.settings = {"refresh_interval": "5s"}
+        with mock.patch.object(src.es, 'ELASTICSEARCH_BULK_INGEST_MODE', False):
+            with self.client.bulk_ingest_mode():
+                self.assertEqual({"refresh_interval": "5s"}, self.indices.settings)
+        self.assertEqual([], self.indices.calls)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+from src.utils import model_registry
+from src.utils.model_registry import ModelRegistry
+
+MB = 1024 * 1024
+
+
+class FakeModel:
+
+    def __init__(self, name, size, device='cpu'):
+        self.name = name
+        self.size = size
+        self.device = device
+
+
+def fake_estimate(model):
+    return model.size, model.device
+
+
+class ModelRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(model_registry, 'estimate_model_memory', fake_estimate)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def loader_of(self, name, size, device='cpu', calls=None):
+        def loader():
+            if calls is not None:
+                calls.append(name)
+            return FakeModel(name, size, device)
+
+        return loader
+
+    def test_loaded_model_is_reused(self):
+        registry = ModelRegistry()
+        calls = []
+        first = registry.get('a', self.loader_of('a', MB, calls=calls))
+        second = registry.get('a', self.loader_of('a', MB, calls=calls))
+        self.assertIs(first, second)
+        self.assertEqual(['a'], calls)
+
+    def test_least_recently_used_model_is_evicted_over_budget(self):
+        registry = ModelRegistry(cpu_budget_bytes=3 * MB)
+        registry.get('a', self.loader_of('a', MB))
+        registry.get('b', self.loader_of('b', MB))
+        registry.get('c', self.loader_of('c', MB))
+        # a 最近被使用过，超出预算时淘汰 b
+        registry.get('a', self.loader_of('a', MB))
+        registry.get('d', self.loader_of('d', MB))
+        self.assertEqual(['c', 'a', 'd'], list(registry.models))
+
+    def test_budgets_are_per_device(self):
+        registry = ModelRegistry(gpu_budget_bytes=2 * MB, cpu_budget_bytes=2 * MB)
+        registry.get('cpu-a', self.loader_of('cpu-a', 2 * MB))
+        registry.get('gpu-a', self.loader_of('gpu-a', 2 * MB, 'cuda'))
+        registry.get('gpu-b', self.loader_of('gpu-b', 2 * MB, 'cuda'))
+        self.assertEqual(['cpu-a', 'gpu-b'], list(registry.models))
+
+    def test_model_larger_than_budget_is_kept(self):
+        registry = ModelRegistry(cpu_budget_bytes=MB)
+        registry.get('a', self.loader_of('a', MB))
+        registry.get('big', self.loader_of('big', 4 * MB))
+        self.assertEqual(['big'], list(registry.models))
+
+    def test_known_size_frees_space_before_reloading(self):
+        registry = ModelRegistry(cpu_budget_bytes=2 * MB)
+        registry.get('a', self.loader_of('a', 2 * MB))
+        registry.unload('a')
+        registry.get('b', self.loader_of('b', MB))
+        loaded_before_a = []
+
+        def loader():
+            loaded_before_a.extend(registry.models)
+            return FakeModel('a', 2 * MB)
+
+        registry.get('a', loader)
+        self.assertEqual([], loaded_before_a)
+        self.assertEqual(['a'], list(registry.models))
+
+    def test_concurrent_gets_load_once(self):
+        registry = ModelRegistry()
+        calls = []
+
+        def loader():
+            calls.append('a')
+            time.sleep(0.05)
+            return FakeModel('a', MB)
+
+        threads = [threading.Thread(target=registry.get, args=('a', loader)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(['a'], calls)
+
+    def test_describe_reports_usage_per_device(self):
+        registry = ModelRegistry(gpu_budget_bytes=8 * MB)
+        registry.get('a', self.loader_of('a', MB))
+        registry.get('b', self.loader_of('b', 2 * MB, 'cuda'))
+        description = registry.describe()
+        self.assertEqual(['b', 'a'], [model['name'] for model in description['models']])
+        self.assertEqual(2, description['gpuUsedMB'])
+        self.assertEqual(1, description['cpuUsedMB'])
+        self.assertEqual(8, description['gpuBudgetMB'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import random
+import unittest
+
+import numpy as np
+
+from src.utils.near_dedup import MinHasher, NearDuplicateFilter, create_near_duplicate_filter
+
+
+def random_text(rng, length):
+    return ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz知识库向量检索文本片段') for _ in range(length))
+
+
+class MinHasherTest(unittest.TestCase):
+
+    def test_signature_ignores_case_and_whitespace(self):
+        hasher = MinHasher(num_perm=64)
+        np.testing.assert_array_equal(
+            hasher.signature('Hello   World\n知识库'),
+            hasher.signature('hello world 知识库')
+        )
+
+    def test_short_text(self):
+        hasher = MinHasher(num_perm=64, shingle_size=5)
+        self.assertEqual(64, len(hasher.signature('ab')))
+        self.assertEqual(64, len(hasher.signature('')))
+
+
+class NearDuplicateFilterTest(unittest.TestCase):
+
+    def test_exact_duplicate(self):
+        dedup_filter = NearDuplicateFilter(threshold=0.9)
+        text = random_text(random.Random(1), 500)
+        self.assertFalse(dedup_filter.is_duplicate(text))
+        self.assertTrue(dedup_filter.is_duplicate(text))
+        self.assertEqual(1, dedup_filter.dropped)
+
+    def test_near_duplicate(self):
+        rng = random.Random(2)
+        text = random_text(rng, 2000)
+        # 只修改末尾的几个字符
+        edited = text[:-5] + random_text(rng, 5)
+        dedup_filter = NearDuplicateFilter(threshold=0.8)
+        self.assertFalse(dedup_filter.is_duplicate(text))
+        self.assertTrue(dedup_filter.is_duplicate(edited))
+
+    def test_different_texts_are_kept(self):
+        rng = random.Random(3)
+        dedup_filter = NearDuplicateFilter(threshold=0.9)
+        texts = [random_text(rng, 300) for _ in range(200)]
+        self.assertEqual([False] * len(texts), [dedup_filter.is_duplicate(text) for text in texts])
+        self.assertEqual(0, dedup_filter.dropped)
+
+    def test_reset(self):
+        dedup_filter = NearDuplicateFilter(threshold=0.9)
+        text = random_text(random.Random(4), 300)
+        dedup_filter.is_duplicate(text)
+        self.assertTrue(dedup_filter.is_duplicate(text))
+        dedup_filter.reset()
+        self.assertFalse(dedup_filter.is_duplicate(text))
+        # reset 不清空 dropped 计数
+        self.assertEqual(1, dedup_filter.dropped)
+
+    def test_create_near_duplicate_filter(self):
+        self.assertEqual((None, None), create_near_duplicate_filter(None))
+        dedup_filter, scope = create_near_duplicate_filter({"threshold": 0.8, "scope": "task"})
+        self.assertEqual(0.8, dedup_filter.threshold)
+        self.assertEqual('task', scope)
+        self.assertEqual('file', create_near_duplicate_filter({"threshold": 0.8})[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
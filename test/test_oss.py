@@ -0,0 +1,115 @@
+import io
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from src.utils import oss
+from src.utils.oss import FileFilter, download_object, iter_objects_concurrently
+
+
+class FakeObjectStore:
+    """
+    open_range(start, end) 返回对象内容的流，记录每次请求的范围
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.ranges = []
+        self.lock = threading.Lock()
+
+    def open_range(self, start, end):
+        with self.lock:
+            self.ranges.append((start, end))
+        if start is None:
+            return io.BytesIO(self.data)
+        return io.BytesIO(self.data[start:end + 1])
+
+
+class DownloadObjectTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.data = os.urandom(5 * 1024 * 1024 + 123)
+
+    def test_small_object_in_memory(self):
+        store = FakeObjectStore(self.data)
+        with mock.patch.object(oss, 'OSS_DOWNLOAD_MEMORY_THRESHOLD_MB', 8):
+            result = download_object(store.open_range, 'dir/a.pdf', len(self.data), self.folder)
+        self.assertEqual(self.data, result)
+        self.assertEqual([], os.listdir(self.folder))
+
+    def test_streamed_to_file_when_size_unknown(self):
+        store = FakeObjectStore(self.data)
+        path = download_object(store.open_range, 'dir/a.pdf', None, self.folder)
+        self.assertTrue(path.endswith('-a.pdf'))
+        with open(path, 'rb') as f:
+            self.assertEqual(self.data, f.read())
+        self.assertEqual([(None, None)], store.ranges)
+
+    def test_large_object_ranged(self):
+        store = FakeObjectStore(self.data)
+        with mock.patch.object(oss, 'OSS_DOWNLOAD_MEMORY_THRESHOLD_MB', 1), \
+                mock.patch.object(oss, 'OSS_DOWNLOAD_RANGE_THRESHOLD_MB', 2), \
+                mock.patch.object(oss, 'OSS_DOWNLOAD_PART_SIZE_MB', 1):
+            path = download_object(store.open_range, 'a.pdf', len(self.data), self.folder)
+        with open(path, 'rb') as f:
+            self.assertEqual(self.data, f.read())
+        # 6 个闭区间的范围请求，覆盖整个对象
+        self.assertEqual(6, len(store.ranges))
+        self.assertEqual(len(self.data) - 1, max(end for _, end in store.ranges))
+
+    def test_incomplete_range_removes_file(self):
+        store = FakeObjectStore(self.data)
+        truncated = lambda start, end: io.BytesIO(self.data[start:end])
+        with mock.patch.object(oss, 'OSS_DOWNLOAD_MEMORY_THRESHOLD_MB', 1), \
+                mock.patch.object(oss, 'OSS_DOWNLOAD_RANGE_THRESHOLD_MB', 2), \
+                mock.patch.object(oss, 'OSS_DOWNLOAD_PART_SIZE_MB', 1):
+            with self.assertRaises(Exception):
+                download_object(truncated, 'a.pdf', len(self.data), self.folder)
+        self.assertEqual([], os.listdir(self.folder))
+
+
+class IterObjectsConcurrentlyTest(unittest.TestCase):
+
+    def test_lists_all_pages_and_sub_prefixes(self):
+        # prefix -> [(对象列表, 子目录列表)]，每个元素是一页
+        tree = {
+            'root/': [(['root/a.txt'], ['root/x/', 'root/y/']), (['root/b.txt'], [])],
+            'root/x/': [(['root/x/c.txt'], [])],
+            'root/y/': [([], ['root/y/z/'])],
+            'root/y/z/': [(['root/y/z/d.txt'], []), (['root/y/z/e.txt'], []), (['root/y/z/f.txt'], [])],
+        }
+        requests = []
+        lock = threading.Lock()
+
+        def list_page(prefix, continuation_token):
+            with lock:
+                requests.append((prefix, continuation_token))
+            page = int(continuation_token or 0)
+            keys, sub_prefixes = tree[prefix][page]
+            next_token = str(page + 1) if page + 1 < len(tree[prefix]) else ''
+            return [{"key": key} for key in keys], sub_prefixes, next_token
+
+        keys = [obj['key'] for obj in iter_objects_concurrently(list_page, 'root/', concurrency=4)]
+        self.assertEqual(
+            sorted(['root/a.txt', 'root/b.txt', 'root/x/c.txt', 'root/y/z/d.txt', 'root/y/z/e.txt', 'root/y/z/f.txt']),
+            sorted(keys)
+        )
+        self.assertEqual(len(keys), len(set(keys)))
+        self.assertEqual(7, len(requests))
+
+
+class FileFilterTest(unittest.TestCase):
+
+    def test_match(self):
+        file_filter = FileFilter('pdf, txt', r'^tmp/')
+        self.assertTrue(file_filter.match('docs/a.pdf'))
+        self.assertFalse(file_filter.match('docs/a.docx'))
+        self.assertFalse(file_filter.match('tmp/a.pdf'))
+        self.assertTrue(FileFilter().match('anything'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,186 @@
+import unittest
+
+from src.queue.reliable_queue import ReliableQueue
+
+
+class FakeRedis:
+    """
+    内存中的 Redis，只实现 ReliableQueue 用到的命令，脚本按 RETRY_OR_DEAD_LETTER_SCRIPT 的逻辑执行
+    """
+
+    def __init__(self):
+        self.lists = {}
+        self.hashes = {}
+        self.sets = {}
+        self.keys = {}
+
+    def register_script(self, script):
+        def retry_or_dead_letter(keys, args):
+            processing, queue, dead_letter, attempts_key = keys
+            payload, payload_id, max_attempts = args
+            if self.lrem(processing, 1, payload) == 0:
+                return -1
+            attempts = self.hincrby(attempts_key, payload_id, 1)
+            if attempts >= int(max_attempts):
+                self.rpush(dead_letter, payload)
+                self.hdel(attempts_key, payload_id)
+            else:
+                self.lpush(queue, payload)
+            return attempts
+
+        return retry_or_dead_letter
+
+    def set(self, key, value, ex=None):
+        self.keys[key] = value
+
+    def exists(self, key):
+        return int(key in self.keys)
+
+    def delete(self, key):
+        self.keys.pop(key, None)
+
+    def sadd(self, key, member):
+        self.sets.setdefault(key, set()).add(member)
+
+    def srem(self, key, member):
+        self.sets.get(key, set()).discard(member)
+
+    def smembers(self, key):
+        return set(self.sets.get(key, set()))
+
+    def lpush(self, key, value):
+        self.lists.setdefault(key, []).insert(0, value)
+
+    def rpush(self, key, value):
+        self.lists.setdefault(key, []).append(value)
+
+    def lrem(self, key, count, value):
+        values = self.lists.get(key, [])
+        if value in values:
+            values.remove(value)
+            return 1
+        return 0
+
+    def lrange(self, key, start, end):
+        return list(self.lists.get(key, []))
+
+    def llen(self, key):
+        return len(self.lists.get(key, []))
+
+    def blmove(self, source, destination, timeout, src, dest):
+        values = self.lists.get(source)
+        if not values:
+            return None
+        value = values.pop(0)
+        self.lists.setdefault(destination, []).append(value)
+        return value
+
+    def hincrby(self, key, field, amount):
+        values = self.hashes.setdefault(key, {})
+        values[field] = values.get(field, 0) + amount
+        return values[field]
+
+    def hdel(self, key, field):
+        self.hashes.get(key, {}).pop(field, None)
+
+
+class ReliableQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = FakeRedis()
+        self.queue = ReliableQueue(self.redis, 'tasks', visibility_timeout=30, max_attempts=3)
+
+    def test_pop_and_ack(self):
+        self.redis.rpush('tasks', 'a')
+        self.assertEqual('a', self.queue.pop())
+        self.assertEqual(['a'], self.redis.lrange(self.queue.processing_queue_name, 0, -1))
+        self.queue.ack('a')
+        self.assertEqual(0, self.redis.llen(self.queue.processing_queue_name))
+        self.assertIsNone(self.queue.pop())
+
+    def test_nack_requeues_to_head(self):
+        self.redis.rpush('tasks', 'a')
+        self.redis.rpush('tasks', 'b')
+        payload = self.queue.pop()
+        self.queue.nack(payload)
+        self.assertEqual(['a', 'b'], self.redis.lrange('tasks', 0, -1))
+        self.assertEqual(0, self.redis.llen(self.queue.processing_queue_name))
+
+    def test_dead_letter_after_max_attempts(self):
+        dead_letters = []
+        self.redis.rpush('tasks', 'a')
+        for _ in range(3):
+            self.queue.nack(self.queue.pop(), on_dead_letter=dead_letters.append)
+        self.assertEqual(['a'], dead_letters)
+        self.assertEqual(['a'], self.redis.lrange('tasks:dead-letter', 0, -1))
+        self.assertEqual(0, self.redis.llen('tasks'))
+        # 进入死信队列之后清空失败次数
+        self.assertEqual({}, self.redis.hashes.get('tasks:attempts'))
+
+    def test_ack_resets_attempts(self):
+        self.redis.rpush('tasks', 'a')
+        self.queue.nack(self.queue.pop())
+        self.queue.ack(self.queue.pop())
+        self.assertEqual({}, self.redis.hashes.get('tasks:attempts'))
+
+    def test_requeue_expired(self):
+        crashed = ReliableQueue(self.redis, 'tasks', max_attempts=3)
+        crashed.start_heartbeat()
+        crashed.heartbeat_stopped.set()
+        self.redis.rpush('tasks', 'a')
+        self.assertEqual('a', crashed.pop())
+
+        self.queue.start_heartbeat()
+        self.addCleanup(self.queue.heartbeat_stopped.set)
+        # 心跳未过期时不重新入队
+        self.queue.requeue_expired()
+        self.assertEqual(0, self.redis.llen('tasks'))
+
+        self.redis.delete(crashed._heartbeat_key_of(crashed.consumer_id))
+        self.queue.requeue_expired()
+        self.assertEqual(['a'], self.redis.lrange('tasks', 0, -1))
+        self.assertEqual(0, self.redis.llen(crashed.processing_queue_name))
+        self.assertNotIn(crashed.consumer_id, self.redis.smembers('tasks:consumers'))
+        self.assertIn(self.queue.consumer_id, self.redis.smembers('tasks:consumers'))
+        self.assertEqual(1, self.redis.hashes['tasks:attempts'][self.queue._payload_id('a')])
+
+    def test_recovered_consumer_registers_again(self):
+        stalled = ReliableQueue(self.redis, 'tasks')
+        stalled.start_heartbeat()
+        stalled.heartbeat_stopped.set()
+        self.redis.delete(stalled._heartbeat_key_of(stalled.consumer_id))
+        self.queue.requeue_expired()
+        self.assertNotIn(stalled.consumer_id, self.redis.smembers('tasks:consumers'))
+
+        # 心跳恢复之后重新注册，之后崩溃时仍然可以回收其 processing 列表中的任务
+        stalled._beat()
+        self.assertIn(stalled.consumer_id, self.redis.smembers('tasks:consumers'))
+        self.redis.rpush('tasks', 'a')
+        stalled.pop()
+        self.redis.delete(stalled._heartbeat_key_of(stalled.consumer_id))
+        self.queue.requeue_expired()
+        self.assertEqual(['a'], self.redis.lrange('tasks', 0, -1))
+
+    def test_requeue_expired_dead_letter(self):
+        dead_letters = []
+        crashed = ReliableQueue(self.redis, 'tasks', max_attempts=1)
+        crashed.start_heartbeat()
+        crashed.heartbeat_stopped.set()
+        self.redis.rpush('tasks', 'a')
+        crashed.pop()
+        self.redis.delete(crashed._heartbeat_key_of(crashed.consumer_id))
+        crashed.requeue_expired(on_dead_letter=dead_letters.append)
+        self.assertEqual(['a'], dead_letters)
+        self.assertEqual(['a'], self.redis.lrange('tasks:dead-letter', 0, -1))
+
+    def test_stop_heartbeat_requeues_own_tasks(self):
+        self.queue.start_heartbeat()
+        self.redis.rpush('tasks', 'a')
+        self.queue.pop()
+        self.queue.stop_heartbeat()
+        self.assertEqual(['a'], self.redis.lrange('tasks', 0, -1))
+        self.assertNotIn(self.queue.consumer_id, self.redis.smembers('tasks:consumers'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import unittest
+
+from src.utils.text_pre_process import TextPreProcessor, get_pre_processor, strip_header_footer
+
+
+class TextPreProcessorTest(unittest.TestCase):
+
+    def test_replace_space_n_tab(self):
+        processor = TextPreProcessor(['replace-space-n-tab'])
+        self.assertEqual('第一行第二行 第三行', processor.process('第一行\n\t第二行 第三行\n'))
+
+    def test_delete_url_and_email(self):
+        processor = TextPreProcessor(['delete-url-and-email'])
+        self.assertEqual(
+            '访问  或者联系 。',
+            processor.process('访问 https://example.com/a?b=1 或者联系 someone@example.com。')
+        )
+
+    def test_normalize_whitespace(self):
+        processor = TextPreProcessor(['normalize-whitespace'])
+        self.assertEqual('a b\nc\n\nd', processor.process('a \t　b\nc\n  \n\n \nd'))
+
+    def test_combined_rules_same_as_sequential(self):
+        # 合并后的正则只遍历一遍，删除之后新相邻的空白不会再被合并，这里的匹配之间互不相邻
+        text = '第一段  访问https://example.com，\n\n\n第二段\t\t联系someone@example.com。\n \n \n结尾'
+        rules = ['delete-url-and-email', 'normalize-whitespace']
+        expected = text
+        for rule in rules:
+            expected = TextPreProcessor([rule]).process(expected)
+        self.assertEqual(expected, TextPreProcessor(rules).process(text))
+
+    def test_unknown_rules_are_ignored(self):
+        processor = TextPreProcessor(['unknown-rule'])
+        self.assertEqual([], processor.rules)
+        self.assertEqual('a\n b', processor.process('a\n b'))
+
+    def test_get_pre_processor_is_cached(self):
+        self.assertIs(
+            get_pre_processor(['replace-space-n-tab']),
+            get_pre_processor(['replace-space-n-tab'])
+        )
+        self.assertEqual([], get_pre_processor(None).rules)
+
+
+class StripHeaderFooterTest(unittest.TestCase):
+
+    def test_strip_repeated_header_and_footer(self):
+        pages = [f"产品手册\n第 {page} 页的正文\n- {page} -" for page in range(1, 6)]
+        self.assertEqual(
+            [f"第 {page} 页的正文" for page in range(1, 6)],
+            strip_header_footer(pages)
+        )
+
+    def test_keep_lines_that_are_not_repeated(self):
+        pages = [f"标题 {chr(ord('A') + page)}\n正文 {page}\n结尾 {chr(ord('A') + page)}" for page in range(5)]
+        self.assertEqual(pages, strip_header_footer(pages))
+
+    def test_too_few_pages(self):
+        pages = ["页眉\n正文\n页脚", "页眉\n正文\n页脚"]
+        self.assertEqual(pages, strip_header_footer(pages))
+
+    def test_process_batch(self):
+        processor = TextPreProcessor(['strip-header-footer', 'replace-space-n-tab'])
+        pages = [f"页眉\n正文 {page}\n第 {page} 页" for page in range(4)]
+        self.assertEqual([f"正文 {page}" for page in range(4)], processor.process_batch(pages))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import logging
+import random
+import unittest
+
+from langchain.text_splitter import CharacterTextSplitter
+
+from src.utils.text_splitter import TextSplitter
+
+SEPARATORS = ['\n\n', '\n', ' ', '。']
+WORD_CHARACTERS = 'abcdefghij中文切分测试'
+
+# 单个片段超过 chunk_size 时 CharacterTextSplitter 会打印警告
+logging.getLogger('langchain_text_splitters').setLevel(logging.ERROR)
+
+
+def random_text(rng, separator, max_pieces=60):
+    """
+    随机长度的片段用单个分隔符连接，连续的分隔符在 CharacterTextSplitter 中会被合并，不在比较范围内
+    """
+    pieces = [
+        ''.join(rng.choice(WORD_CHARACTERS) for _ in range(rng.randint(1, 30)))
+        for _ in range(rng.randint(0, max_pieces))
+    ]
+    return separator.join(pieces)
+
+
+class TextSplitterTest(unittest.TestCase):
+
+    def test_same_chunks_as_character_text_splitter(self):
+        rng = random.Random(20240601)
+        for _ in range(500):
+            separator = rng.choice(SEPARATORS)
+            chunk_size = rng.randint(1, 200)
+            chunk_overlap = rng.randint(0, chunk_size)
+            text = random_text(rng, separator)
+            expected = CharacterTextSplitter(
+                separator=separator, chunk_size=chunk_size, chunk_overlap=chunk_overlap
+            ).split_text(text)
+            actual = TextSplitter(
+                chunk_size=chunk_size, chunk_overlap=chunk_overlap, separator=separator
+            ).split_text(text)
+            self.assertEqual(expected, actual, msg=f"{separator=} {chunk_size=} {chunk_overlap=} {text=}")
+
+    def test_offsets_point_into_source_text(self):
+        rng = random.Random(7)
+        for _ in range(200):
+            separator = rng.choice(SEPARATORS)
+            # 包含连续的分隔符和首尾的空白
+            text = '  ' + random_text(rng, separator) + separator * rng.randint(1, 3) + random_text(rng, separator)
+            splitter = TextSplitter(chunk_size=rng.randint(10, 100), chunk_overlap=rng.randint(0, 10),
+                                    separator=separator)
+            for chunk, start, end in splitter.iter_chunks(text):
+                self.assertEqual(text[start:end], chunk)
+                self.assertEqual(chunk, chunk.strip())
+
+    def test_length_function(self):
+        # 每个片段按 1 计算长度，分隔符的长度由 length_function 计算
+        splitter = TextSplitter(chunk_size=3, chunk_overlap=1, separator=' ',
+                                length_function=lambda texts: [1 if text != ' ' else 0 for text in texts])
+        self.assertEqual(
+            ['a b c', 'c d e', 'e f'],
+            splitter.split_text('a b c d e f')
+        )
+
+    def test_split_documents_metadata(self):
+        from langchain.schema import Document
+
+        text = 'aaaa\n\nbbbb\n\ncccc'
+        chunks = TextSplitter(chunk_size=10, separator='\n\n').split_documents(
+            [Document(page_content=text, metadata={"page": 1})]
+        )
+        self.assertEqual(['aaaa\n\nbbbb', 'cccc'], [chunk.page_content for chunk in chunks])
+        for chunk in chunks:
+            self.assertEqual(1, chunk.metadata['page'])
+            self.assertEqual(chunk.page_content, text[chunk.metadata['start_index']:chunk.metadata['end_index']])
+
+    def test_overlap_larger_than_chunk_size(self):
+        with self.assertRaises(Exception):
+            TextSplitter(chunk_size=10, chunk_overlap=20)
+
+
+if __name__ == '__main__':
+    unittest.main()